@@ -0,0 +1,106 @@
+"""
+Throughput comparison between the per-request path and `AsyncLLM(use_batch=True)`.
+
+The OpenAI client is replaced by an in-process simulator with a fixed per-request
+latency and a bounded number of server-side slots, so the numbers only reflect the
+client-side dispatch strategy.
+
+Usage:
+    python benchmarks/bench_batching.py --requests 512 --latency 0.2 --duplicates 0.2
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+from openai.types.chat import ChatCompletion
+
+from strucdoc import AsyncLLM
+
+
+class SimulatedCompletions:
+    def __init__(self, latency: float, slots: int):
+        self.latency = latency
+        self.slots = asyncio.Semaphore(slots)
+        self.calls = 0
+
+    async def create(self, model: str, messages: list, **kwargs) -> ChatCompletion:
+        async with self.slots:
+            self.calls += 1
+            await asyncio.sleep(self.latency * random.uniform(0.8, 1.2))
+        return ChatCompletion(
+            id=f"chatcmpl-{self.calls}",
+            object="chat.completion",
+            created=int(time.time()),
+            model=model,
+            choices=[
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": "{}"},
+                }
+            ],
+        )
+
+    parse = create
+
+
+def simulated_llm(args, use_batch: bool) -> tuple[AsyncLLM, SimulatedCompletions]:
+    llm = AsyncLLM(
+        model="simulated",
+        api_key="benchmark",
+        use_batch=use_batch,
+        batch_size=args.batch_size,
+        batch_window=args.batch_window,
+    )
+    completions = SimulatedCompletions(args.latency, args.slots)
+    llm.client = SimpleNamespace(
+        chat=SimpleNamespace(completions=completions),
+        beta=SimpleNamespace(chat=SimpleNamespace(completions=completions)),
+    )
+    return llm, completions
+
+
+async def run(args, use_batch: bool) -> dict:
+    random.seed(args.seed)
+    llm, completions = simulated_llm(args, use_batch)
+    num_unique = max(1, int(args.requests * (1 - args.duplicates)))
+    prompts = [f"chunk {random.randrange(num_unique)}" for _ in range(args.requests)]
+    start = time.perf_counter()
+    await asyncio.gather(*(llm(prompt) for prompt in prompts))
+    elapsed = time.perf_counter() - start
+    return {
+        "mode": "batched" if use_batch else "per-request",
+        "seconds": elapsed,
+        "req/s": args.requests / elapsed,
+        "api calls": completions.calls,
+        "mean batch": llm.batch.stats.mean_batch_size if use_batch else 1.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=512)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--slots", type=int, default=64)
+    parser.add_argument("--duplicates", type=float, default=0.2)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--batch-window", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rows = [asyncio.run(run(args, use_batch)) for use_batch in (False, True)]
+    print(" | ".join(f"{k:>12}" for k in rows[0]))
+    for row in rows:
+        print(
+            " | ".join(
+                f"{v:>12.2f}" if isinstance(v, float) else f"{v:>12}"
+                for v in row.values()
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
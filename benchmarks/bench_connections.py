@@ -0,0 +1,109 @@
+"""
+Connection setup overhead of per-instance OpenAI clients versus the shared client registry.
+
+Requests are sent in waves to the local mock server, every wave unpickles fresh
+copies of the LLM as worker processes and batch jobs do. With per-instance clients
+each copy opens its own connection pool, as `__setstate__` used to rebuild the
+client; with the registry all copies pointing at the same base_url reuse one pool
+of warm connections.
+
+Usage:
+    python benchmarks/bench_connections.py --waves 8 --requests 500 --instances 16 --concurrency 128 --latency constant:0.05
+"""
+
+import argparse
+import asyncio
+import os
+import pickle
+import sys
+import time
+
+from openai import AsyncOpenAI
+
+from strucdoc import AsyncLLM, configure_http
+from strucdoc.tracing import percentile
+
+sys.path.insert(0, os.path.dirname(__file__))
+from mock_server import LatencyModel, MockServer  # noqa: E402
+
+
+def make_llms(template: AsyncLLM, instances: int, shared: bool) -> list[AsyncLLM]:
+    llms = [pickle.loads(pickle.dumps(template)) for _ in range(instances)]
+    if not shared:
+        for llm in llms:
+            llm.client = AsyncOpenAI(base_url=llm.base_url, api_key=llm.api_key)
+    return llms
+
+
+async def run(server: MockServer, args, shared: bool) -> dict:
+    configure_http(
+        max_connections=args.max_connections,
+        max_keepalive_connections=args.max_connections,
+        http2=args.http2,
+    )
+    template = AsyncLLM(model="mock", base_url=server.url, api_key="mock")
+    server.reset_stats()
+    limiter = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def request(llm: AsyncLLM, i: int):
+        async with limiter:
+            start = time.perf_counter()
+            await llm(f"request {i}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(args.waves):
+        llms = make_llms(template, args.instances, shared)
+        await asyncio.gather(
+            *(request(llms[i % len(llms)], i) for i in range(args.requests))
+        )
+        if not shared:
+            await asyncio.gather(*(llm.client.close() for llm in llms))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "clients": "shared" if shared else "per-instance",
+        "seconds": elapsed,
+        "req/s": len(latencies) / elapsed,
+        "p50(ms)": percentile(latencies, 50) * 1000,
+        "p99(ms)": percentile(latencies, 99) * 1000,
+        "connections": server.stats["connections"],
+    }
+
+
+def print_table(rows: list[dict]):
+    print(" | ".join(f"{k:>12}" for k in rows[0]))
+    for row in rows:
+        print(
+            " | ".join(
+                f"{v:>12.2f}" if isinstance(v, float) else f"{v!s:>12}"
+                for v in row.values()
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--waves", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=500, help="requests per wave")
+    parser.add_argument("--instances", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--max-connections", type=int, default=256)
+    parser.add_argument("--http2", action="store_true", help="requires the h2 package")
+    parser.add_argument("--latency", default="constant:0.05")
+    args = parser.parse_args()
+
+    server = MockServer(latency=LatencyModel.parse(args.latency)).start_in_thread()
+    try:
+        rows = [asyncio.run(run(server, args, shared)) for shared in (False, True)]
+    finally:
+        server.stop_thread()
+    print(
+        f"{args.waves} waves of {args.requests} requests from {args.instances} instances, concurrency {args.concurrency}, latency {args.latency}"
+    )
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
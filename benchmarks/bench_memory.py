@@ -0,0 +1,133 @@
+"""
+Memory held by a parsed corpus as pydantic documents versus compact documents.
+
+Synthetic documents are saved as JSON the way `Document.save` writes them, with
+subsection contents and tables taken verbatim from the markdown of their section as
+the extractor does, then loaded back with `Document.load` and `CompactDocument.load`.
+
+Usage:
+    python benchmarks/bench_memory.py --documents 500 --sections 30
+"""
+
+import argparse
+import gc
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from PIL import Image
+
+from strucdoc import (
+    CompactDocument,
+    Document,
+    Language,
+    Media,
+    Section,
+    SubSection,
+    Table,
+)
+
+WORDS = "document structure section model language table figure method result analysis data system evaluation".split()
+
+
+def synthetic_section(rng: random.Random, image_dir: str, i: int) -> Section:
+    blocks, markdown = [], [f"## {i}. {rng.choice(WORDS).title()}"]
+    for j in range(rng.randint(2, 5)):
+        content = " ".join(rng.choices(WORDS, k=rng.randint(60, 240))) + "."
+        markdown += [f"### {i}.{j} {rng.choice(WORDS).title()}", content]
+        blocks.append(
+            SubSection(title=f"{rng.choice(WORDS).title()} {j}", content=content)
+        )
+    if rng.random() < 0.3:
+        rows = [[rng.choice(WORDS) for _ in range(4)] for _ in range(6)]
+        table = "\n".join(
+            ["|" + "|".join(row) + "|" for row in rows[:1]]
+            + ["|-|-|-|-|"]
+            + ["|" + "|".join(row) + "|" for row in rows[1:]]
+        )
+        markdown.append(table)
+        blocks.append(
+            Table(
+                markdown_content=table,
+                near_chunks=(markdown[-2], ""),
+                path=os.path.join(image_dir, "table.png"),
+                caption=f"Table: {' '.join(rng.choices(WORDS, k=12))}",
+                cells=rows,
+                merge_area=[],
+            )
+        )
+    if rng.random() < 0.3:
+        markdown.append("![](figure.png)")
+        blocks.append(
+            Media(
+                markdown_content="![](figure.png)",
+                near_chunks=(markdown[-2], ""),
+                path=os.path.join(image_dir, "figure.png"),
+                caption=f"Figure: {' '.join(rng.choices(WORDS, k=12))}",
+            )
+        )
+    return Section(
+        title=f"{rng.choice(WORDS).title()} {i}",
+        summary=" ".join(rng.choices(WORDS, k=60)),
+        blocks=blocks,
+        markdown_content="\n\n".join(markdown),
+        language=Language.LATIN,
+    )
+
+
+def measure(load, paths: list[str]) -> tuple[list, float, float]:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    documents = [load(path) for path in paths]
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return documents, current / 2**20, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--documents", type=int, default=500)
+    parser.add_argument("--sections", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        Image.new("RGB", (8, 8)).save(os.path.join(workdir, "figure.png"))
+        Image.new("RGB", (8, 8)).save(os.path.join(workdir, "table.png"))
+        paths = []
+        for i in range(args.documents):
+            document = Document(
+                image_dir=workdir,
+                blocks=[
+                    synthetic_section(rng, workdir, j) for j in range(args.sections)
+                ],
+                metadata={"title": f"Document {i}"},
+                language=Language.LATIN,
+            )
+            paths.append(os.path.join(workdir, f"document_{i}.json"))
+            document.save(paths[-1])
+        size = sum(os.path.getsize(path) for path in paths) / 2**20
+
+        pydantic_docs, pydantic_mib, pydantic_s = measure(Document.load, paths)
+        del pydantic_docs
+        compact_docs, compact_mib, compact_s = measure(CompactDocument.load, paths)
+
+    print(
+        f"{args.documents} documents x {args.sections} sections, {size:.1f} MiB of JSON"
+    )
+    print(f"{'':>10} | {'MiB':>8} | {'load(s)':>8}")
+    print(f"{'pydantic':>10} | {pydantic_mib:>8.1f} | {pydantic_s:>8.2f}")
+    print(f"{'compact':>10} | {compact_mib:>8.1f} | {compact_s:>8.2f}")
+    print(
+        f"{len(compact_docs)} compact documents kept, {pydantic_mib / compact_mib:.1f}x less memory"
+    )
+
+
+if __name__ == "__main__":
+    main()
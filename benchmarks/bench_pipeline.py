@@ -0,0 +1,309 @@
+"""
+End-to-end throughput benchmark of `Document.from_markdown` against the local mock server.
+
+Runs the example document and synthetic large documents for each `max_at_once`
+setting and reports docs/min, p50/p99 document latency, request counts, event-loop lag
+and peak memory.
+
+Usage:
+    python benchmarks/bench_pipeline.py --synthetic 8 --sections 40 --max-at-once 1 4 16 0 --latency lognormal:0.3,0.5
+
+    # sections with at least two sub-headings built without an extraction request
+    python benchmarks/bench_pipeline.py --max-at-once 8 --rule-extraction
+
+    # chunks parsed while a 5 s heading extraction is in flight, 10% of the guessed sections are merged by it
+    python benchmarks/bench_pipeline.py --max-at-once 8 --speculative --heading-latency 5 --heading-drop-rate 0.1
+
+    # sections tried on a 4x faster model first, 10% of its answers fail validation and are escalated
+    python benchmarks/bench_pipeline.py --max-at-once 8 --token-latency 0.0005 --fast-model --fast-speedup 4 --fast-failure-rate 0.1
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from PIL import Image
+
+from strucdoc import (
+    AsyncLLM,
+    Document,
+    LoopLagMonitor,
+    RuleCriteria,
+    configure_executors,
+    package_join,
+)
+from strucdoc.agent import reset_route_stats, route_stats
+from strucdoc.tracing import percentile
+
+sys.path.insert(0, os.path.dirname(__file__))
+from mock_server import LatencyModel, MockServer  # noqa: E402
+
+EXAMPLE_DIR = package_join("..", "Example-PPTAgent-MinerU")
+TABLE_REGEX = re.compile(r"^(<html><body>)?<table>.*$|^\|.*\|$", re.MULTILINE)
+WORDS = "document structure section model language table figure method result analysis data system evaluation".split()
+
+
+def synthetic_document(
+    image_dir: str,
+    sections: int,
+    rng: random.Random,
+    with_images: bool = True,
+    appendix: int = 0,
+) -> str:
+    """
+    Generate a markdown document with numbered sections, subsections and figures, and optionally one long appendix.
+    """
+    image_path = os.path.join(image_dir, "synthetic.png")
+    if with_images and not os.path.exists(image_path):
+        Image.new("RGB", (256, 128), "white").save(image_path)
+    lines = ["# A Synthetic Document for Benchmarking", ""]
+    for i in range(1, sections + 1):
+        lines += [f"## {i}. {rng.choice(WORDS).title()} {i}", ""]
+        for j in range(1, rng.randint(2, 4)):
+            lines += [f"### {i}.{j} {rng.choice(WORDS).title()}", ""]
+            for _ in range(rng.randint(1, 3)):
+                lines += [
+                    " ".join(rng.choices(WORDS, k=rng.randint(40, 120))) + ".",
+                    "",
+                ]
+        if with_images and rng.random() < 0.3:
+            lines += ["![](synthetic.png)", "", f"Figure {i}: a synthetic figure.", ""]
+    if appendix > 0:
+        lines += ["## Appendix", ""]
+        for j in range(1, appendix + 1):
+            lines += [f"### A.{j} {rng.choice(WORDS).title()}", ""]
+            for _ in range(3):
+                lines += [" ".join(rng.choices(WORDS, k=120)) + ".", ""]
+    return "\n".join(lines)
+
+
+def load_inputs(args, workdir: str) -> list[tuple[str, str, str]]:
+    rng = random.Random(args.seed)
+    inputs = []
+    if args.example:
+        with open(os.path.join(EXAMPLE_DIR, "source.md")) as f:
+            inputs.append(("example", f.read(), EXAMPLE_DIR))
+    for i in range(args.synthetic):
+        inputs.append(
+            (
+                f"synthetic-{i}",
+                synthetic_document(workdir, args.sections, rng, appendix=args.appendix),
+                workdir,
+            )
+        )
+    if args.no_tables:
+        inputs = [(n, TABLE_REGEX.sub("", md), d) for n, md, d in inputs]
+    return inputs
+
+
+async def run_config(server: MockServer, inputs: list, max_at_once: int, args) -> dict:
+    language_model = AsyncLLM(
+        model="mock-language", base_url=server.url, api_key="mock"
+    )
+    vision_model = AsyncLLM(model="mock-vision", base_url=server.url, api_key="mock")
+    fast_model = None
+    if args.fast_model:
+        fast_model = AsyncLLM(model="mock-fast", base_url=server.url, api_key="mock")
+    server.reset_stats()
+    reset_route_stats()
+    latencies = []
+    failures = 0
+
+    async def process(markdown: str, image_dir: str):
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            await Document.from_markdown(
+                markdown,
+                language_model,
+                vision_model,
+                image_dir,
+                max_at_once=max_at_once or None,
+                pack_tokens=args.pack_tokens,
+                map_tokens=args.map_tokens,
+                fast_model=fast_model,
+                rule_criteria=RuleCriteria() if args.rule_extraction else None,
+                speculative=args.speculative,
+            )
+        except Exception as e:
+            failures += 1
+            print(f"document failed: {e!r}", file=sys.stderr)
+            return
+        latencies.append(time.perf_counter() - start)
+
+    doc_limiter = asyncio.Semaphore(args.docs_at_once)
+
+    async def limited(markdown: str, image_dir: str):
+        async with doc_limiter:
+            await process(markdown, image_dir)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    async with LoopLagMonitor() as monitor:
+        await asyncio.gather(*(limited(md, d) for _, md, d in inputs))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    stats = server.stats
+    return {
+        "max_at_once": max_at_once or "inf",
+        "docs/min": len(latencies) / elapsed * 60,
+        "p50(s)": percentile(latencies, 50),
+        "p99(s)": percentile(latencies, 99),
+        "requests": sum(v for k, v in stats.items() if k.startswith("POST")),
+        "prompt tok": stats["prompt_tokens"],
+        "429/500": f"{stats['status 429']}/{stats['status 500']}",
+        "connections": stats["connections"],
+        "lag p99(ms)": monitor.summary()["p99"],
+        "peak MiB": peak / 2**20,
+        "failed": failures,
+    }
+
+
+def print_table(rows: list[dict]):
+    print(" | ".join(f"{k:>11}" for k in rows[0]))
+    for row in rows:
+        print(
+            " | ".join(
+                f"{v:>11.2f}" if isinstance(v, float) else f"{v!s:>11}"
+                for v in row.values()
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--max-at-once",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16, 0],
+        help="0 means unlimited",
+    )
+    parser.add_argument(
+        "--synthetic", type=int, default=4, help="number of synthetic documents"
+    )
+    parser.add_argument(
+        "--sections", type=int, default=30, help="sections per synthetic document"
+    )
+    parser.add_argument(
+        "--no-example",
+        dest="example",
+        action="store_false",
+        help="skip Example-PPTAgent-MinerU",
+    )
+    parser.add_argument(
+        "--no-tables",
+        action="store_true",
+        help="drop tables, rendering them requires Chromium",
+    )
+    parser.add_argument("--docs-at-once", type=int, default=4)
+    parser.add_argument("--latency", default="lognormal:0.3,0.5")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--process-workers",
+        type=int,
+        default=0,
+        help="processes for CPU-bound parsing, 0 uses threads",
+    )
+    parser.add_argument(
+        "--pack-tokens",
+        type=int,
+        default=None,
+        help="extract adjacent small sections together up to this many tokens",
+    )
+    parser.add_argument(
+        "--map-tokens",
+        type=int,
+        default=None,
+        help="split sections over this many tokens into parts extracted in parallel",
+    )
+    parser.add_argument(
+        "--appendix",
+        type=int,
+        default=0,
+        help="subsections of an oversized appendix appended to each synthetic document",
+    )
+    parser.add_argument(
+        "--token-latency",
+        type=float,
+        default=0.0,
+        help="extra seconds per completion token, models decoding time",
+    )
+    parser.add_argument(
+        "--fast-model",
+        action="store_true",
+        help="try section extraction on a faster mock model first, see the cascade of the extractor roles",
+    )
+    parser.add_argument("--fast-speedup", type=float, default=4.0)
+    parser.add_argument(
+        "--fast-failure-rate",
+        type=float,
+        default=0.1,
+        help="rate of fast model sections without blocks, which are escalated",
+    )
+    parser.add_argument(
+        "--rule-extraction",
+        action="store_true",
+        help="build sections with sub-headings from the markdown, see RuleCriteria",
+    )
+    parser.add_argument(
+        "--speculative",
+        action="store_true",
+        help="parse the chunks of the guessed top-level headings while the headings are extracted",
+    )
+    parser.add_argument(
+        "--heading-latency",
+        type=float,
+        default=0.0,
+        help="extra seconds of the heading extraction request",
+    )
+    parser.add_argument(
+        "--heading-drop-rate",
+        type=float,
+        default=0.0,
+        help="rate of top-level headings merged into the previous section by the heading extraction",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    configure_executors(process_workers=args.process_workers)
+
+    server = MockServer(
+        latency=LatencyModel.parse(args.latency),
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        token_latency=args.token_latency,
+        seed=args.seed,
+        fast_speedup=args.fast_speedup,
+        fast_failure_rate=args.fast_failure_rate,
+        heading_latency=args.heading_latency,
+        heading_drop_rate=args.heading_drop_rate,
+    ).start_in_thread()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            inputs = load_inputs(args, workdir)
+            rows = []
+            for max_at_once in args.max_at_once:
+                rows.append(asyncio.run(run_config(server, inputs, max_at_once, args)))
+                if args.fast_model:
+                    for name, stats in route_stats().items():
+                        print(
+                            f"max_at_once {max_at_once or 'inf'} route {name}: {stats}"
+                        )
+    finally:
+        server.stop_thread()
+    print(f"{len(inputs)} documents, latency {args.latency}")
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Build and query latency of the BM25 full-text index over synthetic documents.
+
+Documents are built directly from sections, so no server is needed. The index is
+built over all documents as one corpus, then queried with random words, and saved
+and loaded again to measure persistence. With --embeddings, the embedding index of
+one document is also built against the local mock server, one text per request
+versus batched requests.
+
+Usage:
+    python benchmarks/bench_search.py --documents 200 --sections 40 --queries 1000 --embeddings
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from strucdoc import AsyncLLM, BM25Index, Document, Language, Section, SubSection
+from strucdoc.tracing import percentile
+
+sys.path.insert(0, os.path.dirname(__file__))
+from mock_server import LatencyModel, MockServer  # noqa: E402
+
+WORDS = "document structure section model language table figure method result analysis data system evaluation".split()
+CJK_WORDS = "文档 结构 章节 模型 语言 表格 图片 方法 结果 分析 数据 系统 评估".split()
+
+
+def synthetic_document(image_dir: str, sections: int, rng: random.Random) -> Document:
+    def text(k: int) -> str:
+        words = CJK_WORDS if rng.random() < 0.2 else WORDS
+        return " ".join(rng.choices(words, k=k)) + f" {rng.randrange(10**6)}"
+
+    return Document(
+        image_dir=image_dir,
+        blocks=[
+            Section(
+                title=text(3),
+                summary=text(40),
+                blocks=[
+                    SubSection(title=text(3), content=text(rng.randint(60, 240)))
+                    for _ in range(rng.randint(2, 5))
+                ],
+            )
+            for _ in range(sections)
+        ],
+        metadata={"title": text(5)},
+        language=Language.LATIN,
+    )
+
+
+async def bench_embeddings(document: Document, args) -> list[str]:
+    server = MockServer(latency=LatencyModel.parse(args.latency)).start_in_thread()
+    lines = []
+    try:
+        text_model = AsyncLLM(
+            model="mock-embedding", base_url=server.url, api_key="mock"
+        )
+        for batch_size in (1, args.batch_size):
+            server.reset_stats()
+            start = time.perf_counter()
+            await document.build_embedding_index(text_model, batch_size)
+            build = time.perf_counter() - start
+            lines.append(
+                f"embedding batch_size {batch_size}: {server.stats['POST /v1/embeddings']} requests, build {build:.2f}s"
+            )
+        latencies = []
+        for _ in range(100):
+            start = time.perf_counter()
+            await document.search(" ".join(random.choices(WORDS, k=3)), args.k)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        lines.append(
+            f"embedding query p50 {percentile(latencies, 50) * 1000:.2f}ms including the query embedding request"
+        )
+    finally:
+        server.stop_thread()
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--sections", type=int, default=40)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--embeddings", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--latency", default="constant:0.05")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        Image.new("RGB", (8, 8)).save(os.path.join(workdir, "unused.png"))
+        documents = [
+            synthetic_document(workdir, args.sections, rng)
+            for _ in range(args.documents)
+        ]
+
+        start = time.perf_counter()
+        index = BM25Index()
+        for i, document in enumerate(documents):
+            index.add_document(document, str(i))
+        build = time.perf_counter() - start
+
+        latencies = []
+        for _ in range(args.queries):
+            query = " ".join(rng.choices(WORDS + CJK_WORDS, k=rng.randint(1, 4)))
+            start = time.perf_counter()
+            index.search(query, args.k)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+
+        path = os.path.join(workdir, "corpus.bm25.json")
+        start = time.perf_counter()
+        index.save(path)
+        save = time.perf_counter() - start
+        start = time.perf_counter()
+        BM25Index.load(path)
+        load = time.perf_counter() - start
+        size = os.path.getsize(path)
+        embedding_lines = (
+            asyncio.run(bench_embeddings(documents[0], args)) if args.embeddings else []
+        )
+
+    print(
+        f"{args.documents} documents, {len(index)} entries, {len(index.postings)} terms"
+    )
+    print(
+        f"build {build:.2f}s, save {save:.2f}s, load {load:.2f}s, {size / 2**20:.1f} MiB"
+    )
+    print(
+        f"query p50 {percentile(latencies, 50) * 1000:.2f}ms, p99 {percentile(latencies, 99) * 1000:.2f}ms"
+    )
+    for line in embedding_lines:
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+"""
+A local mock of an OpenAI-compatible chat/embeddings server for benchmarks.
+
+Responses are canned but schema-valid for every request StrucDoc issues: heading
+extraction picks the shallowest repeated headings allowed by the schema, section extraction
+mirrors the markdown chunk (or each chunk of a multi-section request), captions,
+section reduces and metadata merges return short fixed text.
+Latency follows a configurable distribution plus an optional time per completion token, and a fraction of requests can fail
+with 500 or be rate limited with 429.
+
+Usage:
+    python benchmarks/mock_server.py --port 8000 --latency lognormal:0.5,0.5 --rate-limit-rate 0.02
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional
+
+HEADING_REGEX = re.compile(r"^(#{1,6})\s+(.*)")
+SECTION_TAG_REGEX = re.compile(r'<section index="\d+">\n(.*?)\n</section>', re.DOTALL)
+
+
+@dataclass
+class LatencyModel:
+    """
+    A latency distribution in seconds.
+
+    Specs:
+        constant:<seconds>
+        uniform:<low>,<high>
+        exponential:<mean>
+        lognormal:<median>,<sigma>
+    """
+
+    kind: str = "constant"
+    params: tuple[float, ...] = (0.0,)
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyModel":
+        kind, _, params = spec.partition(":")
+        assert kind in (
+            "constant",
+            "uniform",
+            "exponential",
+            "lognormal",
+        ), f"unknown latency distribution: {kind}"
+        return cls(kind, tuple(float(p) for p in params.split(",") if p))
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "constant":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+        if self.kind == "exponential":
+            return rng.expovariate(1 / self.params[0])
+        median, sigma = self.params
+        return median * math.exp(sigma * rng.gauss(0, 1))
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def find_enum(schema) -> Optional[list[str]]:
+    if isinstance(schema, dict):
+        if "enum" in schema:
+            return schema["enum"]
+        values = schema.values()
+    elif isinstance(schema, list):
+        values = schema
+    else:
+        return None
+    for value in values:
+        found = find_enum(value)
+        if found is not None:
+            return found
+    return None
+
+
+def heading_response(schema: dict) -> dict:
+    headings = find_enum(schema) or []
+    if len(headings) == 0:
+        return {"headings": []}
+    levels = [len(HEADING_REGEX.match(h).group(1)) for h in headings]
+    # Split by the shallowest level with several headings, a lone H1 is usually the document title
+    top = min(
+        (level for level in set(levels) if levels.count(level) > 1), default=min(levels)
+    )
+    return {"headings": [h for h, level in zip(headings, levels) if level == top]}
+
+
+def section_response(markdown: str) -> dict:
+    title = "Section"
+    blocks = []
+    current = None
+    for para in markdown.split("\n\n"):
+        para = para.strip()
+        if (
+            not para
+            or para.startswith("![")
+            or para.startswith("<html")
+            or para.startswith("|")
+        ):
+            continue
+        match = HEADING_REGEX.match(para.splitlines()[0])
+        if match is not None:
+            if len(blocks) == 0 and current is None:
+                title = match.group(2).strip()
+            current = {"title": match.group(2).strip()[:40], "content": ""}
+            blocks.append(current)
+            para = "\n".join(para.splitlines()[1:]).strip()
+            if not para:
+                continue
+        if current is None:
+            current = {"title": title[:40], "content": ""}
+            blocks.append(current)
+        current["content"] = (current["content"] + "\n\n" + para).strip()
+    blocks = [b for b in blocks if b["content"]] or [
+        {"title": title, "content": markdown[:200]}
+    ]
+    return {
+        "metadata": {"title": title},
+        "title": title,
+        "summary": " ".join(b["content"] for b in blocks)[:200],
+        "blocks": blocks,
+    }
+
+
+def prompt_text(messages: list[dict]) -> str:
+    content = messages[-1]["content"]
+    if isinstance(content, str):
+        return content
+    return "\n".join(
+        part.get("text", "") for part in content if part.get("type") == "text"
+    )
+
+
+def chat_response(body: dict) -> str:
+    """
+    Produce a canned, schema-valid assistant response for a request.
+    """
+    prompt = prompt_text(body["messages"])
+    response_format = body.get("response_format") or {}
+    json_schema = response_format.get("json_schema") or {}
+    name = json_schema.get("name", "")
+    if name == "LogicHeadings":
+        return json.dumps(heading_response(json_schema.get("schema", {})))
+    if name == "Sections":
+        sections = [
+            section_response(markdown.strip())
+            for markdown in SECTION_TAG_REGEX.findall(prompt)
+        ]
+        return json.dumps(
+            {
+                "metadata": sections[0]["metadata"] if sections else {},
+                "sections": [
+                    {k: v for k, v in section.items() if k != "metadata"}
+                    for section in sections
+                ],
+            },
+            ensure_ascii=False,
+        )
+    if name == "Section" or "Markdown Document:" in prompt:
+        start = prompt.find("Markdown Document:")
+        end = prompt.rfind("\n\nOutput:")
+        markdown = prompt[
+            start + len("Markdown Document:") : end if end != -1 else None
+        ]
+        return json.dumps(section_response(markdown.strip()), ensure_ascii=False)
+    if "title and summary of the whole section" in prompt:
+        titles = re.findall(r"^Part \d+: (.*)$", prompt, re.MULTILINE)
+        return json.dumps(
+            {
+                "title": titles[0] if titles else "Section",
+                "summary": "a mocked summary of the section",
+            }
+        )
+    if "summary of each section" in prompt:
+        sections = re.findall(r"^Section \d+: ", prompt, re.MULTILINE)
+        return json.dumps(
+            {"summaries": ["a mocked summary of the section"] * len(sections)}
+        )
+    if "merge and refine this metadata" in prompt:
+        return json.dumps({"title": "Mock Document"})
+    if "Markdown table" in prompt:
+        return "Table: a mocked caption of the table"
+    if "image" in prompt:
+        return "Picture: a mocked caption of the image"
+    return "ok"
+
+
+def embedding(text: str, dim: int) -> list[float]:
+    rng = random.Random(hashlib.md5(text.encode()).digest())
+    vector = [rng.gauss(0, 1) for _ in range(dim)]
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector]
+
+
+class MockServer:
+    """
+    An asyncio HTTP/1.1 server mimicking the OpenAI chat completions and embeddings endpoints.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: LatencyModel = LatencyModel(),
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        embedding_dim: int = 256,
+        token_latency: float = 0.0,
+        seed: int = 0,
+        fast_speedup: float = 1.0,
+        fast_failure_rate: float = 0.0,
+        heading_latency: float = 0.0,
+        heading_drop_rate: float = 0.0,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.embedding_dim = embedding_dim
+        self.token_latency = token_latency
+        # Models named "*-fast" answer `fast_speedup` times faster, and drop the blocks of a section at `fast_failure_rate`
+        self.fast_speedup = fast_speedup
+        self.fast_failure_rate = fast_failure_rate
+        # Heading extraction reads the whole tree, it takes `heading_latency` more seconds and merges
+        # a section into the previous one at `heading_drop_rate`, as when a heading is judged not top-level
+        self.heading_latency = heading_latency
+        self.heading_drop_rate = heading_drop_rate
+        self.rng = random.Random(seed)
+        self.stats = Counter()
+        self.inflight = 0
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._handlers: set[asyncio.Task] = set()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def reset_stats(self):
+        self.stats = Counter()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        for handler in self._handlers:
+            handler.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def start_in_thread(self) -> "MockServer":
+        """
+        Serve from a background thread with its own event loop, so that the server does not share the client's loop.
+        """
+        started = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, name="mock-server", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop_thread(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats["connections"] += 1
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    key, _, value = line.decode().partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload, extra = await self._route(method, path, body)
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                head = [
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'ERROR'}",
+                    "content-type: application/json",
+                    f"content-length: {len(data)}",
+                    *(f"{k}: {v}" for k, v in extra.items()),
+                ]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + data)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (
+            ConnectionError,
+            asyncio.IncompleteReadError,
+            asyncio.CancelledError,
+            ValueError,
+        ):
+            # Cancellation only happens on shutdown, end the connection quietly
+            pass
+        finally:
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def _route(self, method: str, path: str, body: bytes):
+        path = path.split("?")[0].rstrip("/")
+        self.stats[f"{method} {path}"] += 1
+        if method == "GET" and path.endswith("/models"):
+            return (
+                200,
+                {"object": "list", "data": [{"id": "mock", "object": "model"}]},
+                {},
+            )
+
+        request = json.loads(body or b"{}")
+        fast = str(request.get("model", "")).endswith("-fast")
+        speedup = self.fast_speedup if fast else 1.0
+        self.inflight += 1
+        self.stats["max_inflight"] = max(self.stats["max_inflight"], self.inflight)
+        try:
+            await asyncio.sleep(self.latency.sample(self.rng) / speedup)
+        finally:
+            self.inflight -= 1
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            self.stats["status 429"] += 1
+            return (
+                429,
+                {"error": {"message": "rate limited", "type": "rate_limit"}},
+                {"retry-after": "0.1"},
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.stats["status 500"] += 1
+            return (
+                500,
+                {"error": {"message": "mocked failure", "type": "server_error"}},
+                {},
+            )
+
+        self.stats["status 200"] += 1
+        if path.endswith("/embeddings"):
+            inputs = request["input"]
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            return (
+                200,
+                {
+                    "object": "list",
+                    "model": request.get("model", "mock"),
+                    "data": [
+                        {
+                            "object": "embedding",
+                            "index": i,
+                            "embedding": embedding(text, self.embedding_dim),
+                        }
+                        for i, text in enumerate(inputs)
+                    ],
+                    "usage": {
+                        "prompt_tokens": sum(map(count_tokens, inputs)),
+                        "total_tokens": sum(map(count_tokens, inputs)),
+                    },
+                },
+                {},
+            )
+        if path.endswith("/chat/completions"):
+            content = chat_response(request)
+            if '"LogicHeadings"' in json.dumps(request.get("response_format")):
+                await asyncio.sleep(self.heading_latency)
+                headings = json.loads(content)["headings"]
+                content = json.dumps(
+                    {
+                        "headings": headings[:1]
+                        + [
+                            h
+                            for h in headings[1:]
+                            if self.rng.random() >= self.heading_drop_rate
+                        ]
+                    },
+                    ensure_ascii=False,
+                )
+            if fast and self.rng.random() < self.fast_failure_rate:
+                self.stats["fast failures"] += 1
+                content = json.dumps({"title": "Section", "summary": "", "blocks": []})
+            prompt_tokens = count_tokens(
+                json.dumps(request["messages"], ensure_ascii=False)
+            )
+            completion_tokens = count_tokens(content)
+            # Decoding time grows with the output, so the longest response is the long pole of a document
+            await asyncio.sleep(completion_tokens * self.token_latency / speedup)
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += completion_tokens
+            return (
+                200,
+                {
+                    "id": f"chatcmpl-mock-{self.stats['status 200']}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "mock"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": content},
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                },
+                {},
+            )
+        return 404, {"error": {"message": f"unknown endpoint: {path}"}}, {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", default="constant:0.1")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--token-latency",
+        type=float,
+        default=0.0,
+        help="extra seconds per completion token",
+    )
+    args = parser.parse_args()
+
+    async def serve():
+        server = MockServer(
+            args.host,
+            args.port,
+            LatencyModel.parse(args.latency),
+            args.error_rate,
+            args.rate_limit_rate,
+            token_latency=args.token_latency,
+        )
+        await server.start()
+        print(f"Mock server listening on {server.url}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
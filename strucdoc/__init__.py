@@ -1,23 +1,45 @@
 from .agent import Agent
-from .doc_utils import get_tree_structure
+from .batch_job import BatchJob, LocalBatchService, OpenAIBatchService
+from .compact import CompactDocument
+from .doc_utils import RuleCriteria, get_tree_structure
 from .document import Document
-from .element import Media, Section, SubSection, Table
-from .llms import LLM, AsyncLLM
+from .element import ImageDeduplicator, Media, Section, SubSection, Table
+from .executors import LoopLagMonitor, configure_executors
+from .llms import LLM, AsyncLLM, configure_http
+from .search import BM25Index, EmbeddingIndex
+from .store import DocumentStore
+from .tracing import Tracer, trace
+from .usage import track_usage
 from .utils import Language, get_logger, package_join
 
 __version__ = "0.0.1"
 
 __all__ = [
     "Document",
+    "CompactDocument",
     "Media",
     "Section",
     "SubSection",
     "Table",
+    "ImageDeduplicator",
+    "BM25Index",
+    "EmbeddingIndex",
+    "DocumentStore",
     "AsyncLLM",
     "LLM",
+    "configure_http",
+    "configure_executors",
+    "LoopLagMonitor",
     "Agent",
+    "BatchJob",
+    "LocalBatchService",
+    "OpenAIBatchService",
     "get_logger",
     "package_join",
     "Language",
     "get_tree_structure",
+    "RuleCriteria",
+    "track_usage",
+    "Tracer",
+    "trace",
 ]
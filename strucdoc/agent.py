@@ -1,19 +1,32 @@
-from dataclasses import asdict, dataclass
-from functools import partial
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache, partial
 from math import ceil
-from typing import Optional
+from typing import Any, Callable, Iterator, Optional
 
-import tiktoken
 import yaml
 from jinja2 import Environment, StrictUndefined, Template
 from PIL import Image
 from pydantic import BaseModel
 from torch import Tensor, cosine_similarity
 
-from .llms import AsyncLLM
-from .utils import get_json_from_response, package_join
+from .executors import run_cpu, run_in_thread
+from .llms import AsyncLLM, image_part
+from .tracing import percentile, span
+from .usage import Usage, pop_last_usage
+from .utils import (
+    ENCODING,
+    count_tokens,
+    get_json_from_response,
+    get_logger,
+    package_join,
+)
+
+logger = get_logger(__name__)
 
-ENCODING = tiktoken.encoding_for_model("gpt-4o")
 RETRY_TEMPLATE = Template(
     """The previous output is invalid, please carefully analyze the traceback and feedback information, correct errors happened before.
             feedback:
@@ -23,6 +36,11 @@ RETRY_TEMPLATE = Template(
             Give your corrected output in the same format without including the previous output:
             """
 )
+# The default token budget of the history sent with a call, overridden by `history_tokens` in the role config
+HISTORY_TOKENS = 8192
+IMAGE_PLACEHOLDER = "[image omitted from history]"
+# The default number of turns kept in memory, overridden by `max_history_turns` in the role config
+MAX_HISTORY_TURNS = 256
 
 
 @dataclass
@@ -39,15 +57,44 @@ class Turn:
     images: list[str] = None
     input_tokens: int = 0
     output_tokens: int = 0
+    latency: float = 0.0
+    usage: Optional[Usage] = None
     embedding: Tensor = None
+    # The message sent as history of later turns, with images replaced by placeholders, and its tokens
+    history_message: list = None
+    history_tokens: int = 0
 
     def to_dict(self):
-        return {k: v for k, v in asdict(self).items() if k != "embedding"}
+        return {
+            k: v
+            for k, v in asdict(self).items()
+            if k not in ("embedding", "history_message", "history_tokens")
+        }
+
+    def compacted(self) -> tuple[list, int]:
+        """
+        Get the message of the turn as history and its tokens, computed once.
+        """
+        if self.history_message is None:
+            self.history_message = compact_message(self.message)
+            self.history_tokens = message_tokens(self.history_message)
+        return self.history_message, self.history_tokens
+
+    def request_message(self) -> list:
+        """
+        Get the message of the turn with its image references read back as base64.
+        """
+        return resolve_images(self.message)
 
     def calc_token(self):
         """
         Calculate the number of tokens for the turn.
+        Use the usage returned by the API if available, otherwise estimate it locally.
         """
+        if self.usage is not None:
+            self.input_tokens = self.usage.prompt_tokens
+            self.output_tokens = self.usage.completion_tokens
+            return
         if self.images is not None:
             self.input_tokens += calc_image_tokens(self.images)
         self.input_tokens += len(ENCODING.encode(self.prompt))
@@ -57,6 +104,163 @@ class Turn:
         return self is other
 
 
+@dataclass
+class RouteStats:
+    """
+    Calls of one route of a cascade, and how many of them were accepted.
+    """
+
+    calls: int = 0
+    accepted: int = 0
+    # The latencies of the most recent calls
+    latencies: deque = field(default_factory=lambda: deque(maxlen=1024))
+
+    def record(self, latency: float, accepted: bool):
+        self.calls += 1
+        self.accepted += accepted
+        self.latencies.append(latency)
+
+    def summary(self) -> dict[str, Any]:
+        latencies = sorted(self.latencies)
+        return {
+            "calls": self.calls,
+            "accepted": self.accepted,
+            "acceptance_rate": (
+                round(self.accepted / self.calls, 3) if self.calls else 0.0
+            ),
+            "p50_latency": round(percentile(latencies, 50), 3),
+            "p95_latency": round(percentile(latencies, 95), 3),
+        }
+
+
+def argument_tokens(value: Any) -> int:
+    """
+    Count the tokens of a prompt argument, the items of a list argument are counted without the list syntax.
+    """
+    if isinstance(value, (list, tuple)):
+        return sum(argument_tokens(item) for item in value)
+    return count_tokens(str(value))
+
+
+# "{role}:{model}" -> stats of the route, shared by all agents of the process
+_ROUTE_STATS: dict[str, RouteStats] = {}
+
+
+def route_stats() -> dict[str, dict[str, Any]]:
+    """
+    Get the latency and acceptance of every cascade route called in this process, to tune the `cascade` of the roles.
+    """
+    return {name: stats.summary() for name, stats in _ROUTE_STATS.items()}
+
+
+def reset_route_stats():
+    _ROUTE_STATS.clear()
+
+
+@dataclass
+class Route:
+    """
+    A cheaper model tried before the model of the role, from an entry of `cascade` in the role config.
+
+    Args:
+        name (str): "{role}:{model}", the key of its stats.
+        llm (AsyncLLM): The model.
+        max_input_tokens (Optional[int]): Only prompt arguments of up to this many tokens are routed to the model.
+        min_output_ratio (Optional[float]): Responses shorter than this ratio of the prompt arguments are escalated, as the model likely dropped content.
+    """
+
+    name: str
+    llm: AsyncLLM
+    max_input_tokens: Optional[int] = None
+    min_output_ratio: Optional[float] = None
+
+    @property
+    def stats(self) -> RouteStats:
+        return _ROUTE_STATS.setdefault(self.name, RouteStats())
+
+
+class HistoryStore:
+    """
+    The turns of an agent, indexed by turn id and bounded in memory.
+
+    Turns are grouped by id with their retries. When more than `max_turns` turns are held, the oldest
+    turn ids are evicted, and appended as JSON lines to `spill_path` if it is given.
+    """
+
+    def __init__(
+        self, max_turns: int = MAX_HISTORY_TURNS, spill_path: Optional[str] = None
+    ):
+        self.max_turns = max_turns
+        self.spill_path = spill_path
+        self.next_id = 0
+        # The number of turns ever added and evicted
+        self.total = 0
+        self.evicted = 0
+        # turn id -> attempts of the turn in the order they were added
+        self._attempts: OrderedDict[int, list[Turn]] = OrderedDict()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[Turn]:
+        for attempts in self._attempts.values():
+            yield from attempts
+
+    def allocate_id(self) -> int:
+        turn_id = self.next_id
+        self.next_id += 1
+        return turn_id
+
+    def append(self, turn: Turn):
+        self._attempts.setdefault(turn.id, []).append(turn)
+        self._size += 1
+        self.total += 1
+        evicted = []
+        while self._size > self.max_turns and len(self._attempts) > 1:
+            _, attempts = self._attempts.popitem(last=False)
+            self._size -= len(attempts)
+            evicted.extend(attempts)
+        if evicted:
+            self.evicted += len(evicted)
+            self.spill(evicted)
+
+    def spill(self, turns: list[Turn]):
+        if self.spill_path is None:
+            return
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for turn in turns:
+                f.write(json.dumps(turn.to_dict(), ensure_ascii=False) + "\n")
+
+    def attempts(self, turn_id: int) -> list[Turn]:
+        """
+        Get the attempts of a turn, the original call first.
+        """
+        assert (
+            turn_id in self._attempts
+        ), f"turn {turn_id} is not in the history, it may have been evicted"
+        return sorted(self._attempts[turn_id], key=lambda t: t.retry)
+
+    def recent(self, n: int) -> list[Turn]:
+        """
+        Get the last `n` turns added, oldest first.
+        """
+        turns = []
+        for attempts in reversed(self._attempts.values()):
+            for turn in reversed(attempts):
+                if len(turns) == n:
+                    return turns[::-1]
+                turns.append(turn)
+        return turns[::-1]
+
+    def sorted(self) -> list[Turn]:
+        return [
+            turn
+            for turn_id in sorted(self._attempts)
+            for turn in sorted(self._attempts[turn_id], key=lambda t: t.retry)
+        ]
+
+
 class Agent:
     """
     An agent, defined by its instruction template and model.
@@ -70,6 +274,7 @@ class Agent:
         record_cost: bool = False,
         config: Optional[dict] = None,
         env: Optional[Environment] = None,
+        history_dir: Optional[str] = None,
     ):
         """
         Initialize the Agent.
@@ -81,6 +286,7 @@ class Agent:
             llm (LLM): The language model.
             config (dict): The configuration.
             text_model (LLM): The text embedding model.
+            history_dir (str): The directory where turns evicted from the history are saved as `{name}.jsonl`, they are dropped by default.
         """
         self.name = name
         self.config = config
@@ -100,49 +306,108 @@ class Agent:
         if self.env is None:
             self.env = Environment(undefined=StrictUndefined)
         self.template = self.env.from_string(self.config["template"])
-        self.input_tokens = 0
-        self.output_tokens = 0
-        self._history: list[Turn] = []
+        self.usage = Usage()
+        self._history = HistoryStore(
+            self.config.get("max_history_turns", MAX_HISTORY_TURNS),
+            None if history_dir is None else os.path.join(history_dir, f"{name}.jsonl"),
+        )
         run_args = self.config.get("run_args", {})
         self.llm.__call__ = partial(self.llm.__call__, **run_args)
         self.system_tokens = len(ENCODING.encode(self.system_message))
+        self.history_tokens = self.config.get("history_tokens", HISTORY_TOKENS)
+        # Routes of models missing from llm_mapping are skipped, so a role without a cheap model uses its own model only
+        self.routes = [
+            Route(
+                f"{name}:{route['use_model']}",
+                llm_mapping[route["use_model"]],
+                route.get("max_input_tokens"),
+                route.get("min_output_ratio"),
+            )
+            for route in self.config.get("cascade", [])
+            if route["use_model"] in llm_mapping
+        ]
+
+    def calc_cost(self, turn: Turn, history_tokens: int):
+        """
+        Add the cost of a turn, sent with `history_tokens` tokens of history, to the running totals.
+        """
+        input_tokens = turn.input_tokens
+        if turn.usage is None:
+            input_tokens += self.system_tokens + history_tokens
+        self.usage += Usage(
+            requests=1 if turn.usage is None else turn.usage.requests,
+            prompt_tokens=input_tokens,
+            completion_tokens=turn.output_tokens,
+            latency=turn.latency,
+        )
+
+    @property
+    def input_tokens(self) -> int:
+        return self.usage.prompt_tokens
 
-    def calc_cost(self, turns: list[Turn]):
+    @property
+    def output_tokens(self) -> int:
+        return self.usage.completion_tokens
+
+    def cost_summary(self) -> dict:
         """
-        Calculate the cost of a list of turns.
+        Get the token cost and latency of this agent, requires `record_cost=True`.
         """
-        for turn in turns[:-1]:
-            self.input_tokens += turn.input_tokens
-            self.input_tokens += turn.output_tokens
-        self.input_tokens += turns[-1].input_tokens
-        self.output_tokens += turns[-1].output_tokens
-        self.input_tokens += self.system_tokens
+        return {
+            "name": self.name,
+            "model": self.model,
+            "turns": self._history.total,
+            **self.usage.summary(),
+        }
 
     @property
     def next_turn_id(self):
-        if len(self._history) == 0:
-            return 0
-        return max(t.id for t in self._history) + 1
+        return self._history.next_id
 
     @property
     def history(self):
-        return sorted(self._history, key=lambda x: (x.id, x.retry))
+        return self._history.sorted()
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(name={self.name}, model={self.model})"
 
+    def build_history(self, turns: list[Turn]) -> tuple[list, int]:
+        """
+        Assemble the messages of history turns within the token budget of the agent.
+
+        Images are replaced by placeholders, and the oldest turns that do not fit in the budget are dropped.
+
+        Returns:
+            tuple[list, int]: The messages and their tokens.
+        """
+        kept, tokens = [], 0
+        for turn in reversed(turns):
+            message, turn_tokens = turn.compacted()
+            if tokens + turn_tokens > self.history_tokens:
+                break
+            kept.append(message)
+            tokens += turn_tokens
+        return [msg for message in reversed(kept) for msg in message], tokens
+
     async def retry(self, feedback: str, traceback: str, turn_id: int, error_idx: int):
         """
         Retry a failed turn with feedback and traceback.
+
+        Only the original prompt and the latest failed output are sent, not every previous attempt.
         """
         assert error_idx > 0, "error_idx must be greater than 0"
         prompt = RETRY_TEMPLATE.render(feedback=feedback, traceback=traceback)
-        history = [t for t in self._history if t.id == turn_id]
-        history_msg = []
-        for turn in history:
-            history_msg.extend(turn.message)
+        attempts = self._history.attempts(turn_id)
+        original = attempts[0]
+        # The images of the original prompt are kept, they are the input being corrected
+        history_msg = [original.request_message()[0], attempts[-1].message[-1]]
+        history_tokens = message_tokens(history_msg)
+        if self.record_cost and original.images is not None:
+            history_tokens += calc_image_tokens(original.images)
+        start = time.perf_counter()
         response, message = await self.llm(
             prompt,
+            system_message=self.system_message,
             history=history_msg,
             return_message=True,
         )
@@ -152,8 +417,10 @@ class Agent:
             response=response,
             message=message,
             retry=error_idx,
+            latency=time.perf_counter() - start,
+            usage=pop_last_usage(),
         )
-        return await self.__post_process__(response, history, turn)
+        return await self.__post_process__(response, history_tokens, turn)
 
     async def __call__(
         self,
@@ -161,15 +428,19 @@ class Agent:
         recent: int = 0,
         similar: int = 0,
         response_format: Optional[BaseModel] = None,
+        validate: Optional[Callable[[Any], bool]] = None,
         **jinja_args,
     ):
         """
         Call the agent with prompt arguments.
 
+        With a `cascade` in the role config, the cheaper models are tried first, see `route`.
+
         Args:
             images (list[str]): A list of image file paths.
             recent (int): The number of recent turns to include.
             similar (int): The number of similar turns to include.
+            validate (Optional[Callable[[Any], bool]]): Check the parsed response of a cheaper model, it is escalated if False.
             **jinja_args: Additional arguments for the Jinja2 template.
 
         Returns:
@@ -181,12 +452,14 @@ class Agent:
             jinja_args.keys()
         ), f"Invalid arguments, expected: {self.prompt_args}, got: {jinja_args.keys()}"
         prompt = self.template.render(**jinja_args)
+        turn_id = self._history.allocate_id()
         history = await self.get_history(similar, recent, prompt)
-        history_msg = []
-        for turn in history:
-            history_msg.extend(turn.message)
+        history_msg, history_tokens = self.build_history(history)
 
-        response, message = await self.llm(
+        start = time.perf_counter()
+        response, message, usage = await self.route(
+            jinja_args,
+            validate,
             prompt,
             system_message=self.system_message,
             history=history_msg,
@@ -195,32 +468,131 @@ class Agent:
             response_format=response_format,
         )
         turn = Turn(
-            id=self.next_turn_id,
+            id=turn_id,
             prompt=prompt,
             response=response,
-            message=message,
+            message=reference_images(message, images),
             images=images,
+            latency=time.perf_counter() - start,
+            usage=usage,
+        )
+        return turn.id, await self.__post_process__(
+            response, history_tokens, turn, similar
+        )
+
+    async def route(
+        self,
+        jinja_args: dict[str, Any],
+        validate: Optional[Callable[[Any], bool]],
+        prompt: str,
+        **kwargs,
+    ) -> tuple[str, list, Optional[Usage]]:
+        """
+        Send the prompt through the cascade: the first cheaper model whose response passes the checks answers it, and the model of the role otherwise.
+
+        A response is escalated if the request fails, the JSON of a `return_json` role cannot be parsed, `validate` returns False,
+        or it is shorter than `min_output_ratio` of the prompt arguments.
+
+        Returns:
+            tuple[str, list, Optional[Usage]]: The response, its message, and the usage of every request made, including the escalated ones.
+        """
+        usage = None
+
+        def collect():
+            nonlocal usage
+            attempt = pop_last_usage()
+            if attempt is not None:
+                if usage is None:
+                    usage = Usage()
+                usage += attempt
+
+        pop_last_usage()
+        input_tokens = None
+        for route in self.routes:
+            if input_tokens is None:
+                input_tokens = await run_in_thread(
+                    lambda: sum(argument_tokens(v) for v in jinja_args.values())
+                )
+            if (
+                route.max_input_tokens is not None
+                and input_tokens > route.max_input_tokens
+            ):
+                continue
+            start = time.perf_counter()
+            accepted = False
+            with span("route", route=route.name, input_tokens=input_tokens):
+                try:
+                    # A failure escalates at once instead of waiting for the retries of the cheaper model
+                    response, message = await route.llm(prompt, retry=False, **kwargs)
+                    collect()
+                    # Counting, parsing and validating large responses is kept off the event loop
+                    accepted = await run_in_thread(
+                        self.accept, route, response, input_tokens, validate
+                    )
+                except Exception as e:
+                    logger.warning("route %s failed, escalating: %s", route.name, e)
+            route.stats.record(time.perf_counter() - start, accepted)
+            if accepted:
+                return response, message, usage
+        if not self.routes:
+            response, message = await self.llm(prompt, **kwargs)
+            collect()
+            return response, message, usage
+        start = time.perf_counter()
+        final = _ROUTE_STATS.setdefault(
+            f"{self.name}:{self.config['use_model']}", RouteStats()
         )
-        return turn.id, await self.__post_process__(response, history, turn, similar)
+        try:
+            response, message = await self.llm(prompt, **kwargs)
+        except Exception:
+            final.record(time.perf_counter() - start, False)
+            raise
+        collect()
+        final.record(time.perf_counter() - start, True)
+        return response, message, usage
+
+    def accept(
+        self,
+        route: Route,
+        response: str,
+        input_tokens: int,
+        validate: Optional[Callable[[Any], bool]],
+    ) -> bool:
+        if (
+            route.min_output_ratio is not None
+            and count_tokens(response) < route.min_output_ratio * input_tokens
+        ):
+            return False
+        if not self.return_json:
+            return validate is None or validate(response)
+        try:
+            parsed = get_json_from_response(response)
+        except Exception:
+            return False
+        return validate is None or validate(parsed)
 
     async def get_history(self, similar: int, recent: int, prompt: str):
         """
         Get the conversation history.
         """
-        history = self._history[-recent:] if recent > 0 else []
+        history = self._history.recent(recent) if recent > 0 else []
         if similar > 0:
             embedding = await self.text_model.get_embedding(prompt)
-            history.sort(key=lambda x: cosine_similarity(embedding, x.embedding))
-            for turn in history:
-                if len(history) > similar + recent:
-                    break
-                if turn not in history:
-                    history.append(turn)
-        history.sort(key=lambda x: x.id)
+            candidates = [
+                turn
+                for turn in self._history
+                if turn.embedding is not None and turn not in history
+            ]
+            candidates.sort(
+                key=lambda x: float(cosine_similarity(embedding, x.embedding)),
+                reverse=True,
+            )
+            history.extend(candidates[:similar])
+        history.sort(key=lambda x: (x.id, x.retry))
         return history
 
     async def __post_process__(
-        self, response: str, history: list[Turn], turn: Turn, similar: int = 0
+        self, response: str, history_tokens: int, turn: Turn, similar: int = 0
     ):
         """
         Post-process the response from the agent.
@@ -230,20 +602,95 @@ class Agent:
             turn.embedding = await self.text_model.get_embedding(turn.prompt)
         if self.record_cost:
             turn.calc_token()
-            self.calc_cost(history + [turn])
+            self.calc_cost(turn, history_tokens)
         if self.return_json:
-            response = get_json_from_response(response)
+            response = await run_cpu(get_json_from_response, response)
         return response
 
 
+def compact_message(message: list) -> list:
+    """
+    Copy chat messages with their images replaced by a short text placeholder.
+    """
+    compacted = []
+    for msg in message:
+        content = msg["content"]
+        if isinstance(content, list):
+            content = [
+                (
+                    {"type": "text", "text": IMAGE_PLACEHOLDER}
+                    if part["type"] in ("image_url", "image_ref")
+                    else part
+                )
+                for part in content
+            ]
+        compacted.append({**msg, "content": content})
+    return compacted
+
+
+def reference_images(message: list, images: Optional[list[str]]) -> list:
+    """
+    Replace the base64 images of a user message by references to their files, see `resolve_images`.
+    """
+    if images is None or isinstance(message[0]["content"], str):
+        return message
+    image_parts = [
+        i for i, part in enumerate(message[0]["content"]) if part["type"] == "image_url"
+    ]
+    if not image_parts:
+        return message
+    content = list(message[0]["content"])
+    # Images that failed to load are missing from the message, the references would be misaligned
+    if len(images) != len(image_parts):
+        for i in image_parts:
+            content[i] = {"type": "text", "text": IMAGE_PLACEHOLDER}
+    else:
+        for i, image in zip(image_parts, images):
+            content[i] = {"type": "image_ref", "path": image}
+    return [{**message[0], "content": content}, *message[1:]]
+
+
+def resolve_images(message: list) -> list:
+    """
+    Read the image references of messages back as base64 image parts.
+    """
+    resolved = []
+    for msg in message:
+        content = msg["content"]
+        if isinstance(content, list) and any(
+            part["type"] == "image_ref" for part in content
+        ):
+            content = [
+                image_part(part["path"]) if part["type"] == "image_ref" else part
+                for part in content
+            ]
+        resolved.append({**msg, "content": content})
+    return resolved
+
+
+def message_tokens(message: list) -> int:
+    """
+    Count the text tokens of chat messages.
+    """
+    tokens = 0
+    for msg in message:
+        content = msg["content"]
+        if isinstance(content, str):
+            tokens += count_tokens(content)
+        else:
+            tokens += sum(
+                count_tokens(part["text"]) for part in content if part["type"] == "text"
+            )
+    return tokens
+
+
 def calc_image_tokens(images: list[str]):
     """
     Calculate the number of tokens for a list of images.
     """
     tokens = 0
     for image in images:
-        with open(image, "rb") as f:
-            width, height = Image.open(f).size
+        width, height = image_size(image)
         if width > 1024 or height > 1024:
             if width > height:
                 height = int(height * 1024 / width)
@@ -255,3 +702,12 @@ def calc_image_tokens(images: list[str]):
         w = ceil(width / 512)
         tokens += 85 + 170 * h * w
     return tokens
+
+
+@lru_cache(maxsize=4096)
+def image_size(image: str) -> tuple[int, int]:
+    """
+    Get the size of an image, cached by path.
+    """
+    with open(image, "rb") as f:
+        return Image.open(f).size
@@ -0,0 +1,490 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional, Union
+
+from openai.lib._parsing._completions import type_to_response_format_param
+from pydantic import BaseModel
+
+from .agent import Agent
+from .doc_utils import detect_languages
+from .document import Document
+from .element import Section
+from .executors import run_in_thread
+from .llms import AsyncLLM, request_key, structured_output_kwargs
+from .usage import record_usage
+from .utils import Language, get_logger, pexists, pjoin
+
+logger = get_logger(__name__)
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+
+
+class BatchPending(Exception):
+    """
+    Raised when the result of a request is not available yet.
+    """
+
+
+class BatchRequestFailed(Exception):
+    """
+    Raised when a request was issued `max_attempts` times without a result.
+    """
+
+
+class BatchLedger:
+    """
+    Bookkeeping of batch requests and their results, persisted in a work directory.
+
+    Results are stored in `results.jsonl`, requests of each round are written to `round_<n>.jsonl`,
+    and the number of rounds each request was issued in to `attempts.json`.
+
+    Args:
+        workdir (str): The work directory.
+        max_attempts (int): A request failing in this many rounds is given up on, see `BatchRequestFailed`.
+    """
+
+    def __init__(self, workdir: str, max_attempts: int = 3):
+        self.workdir = workdir
+        self.max_attempts = max_attempts
+        os.makedirs(self.workdir, exist_ok=True)
+        self.results: dict[str, dict] = {}
+        self.pending: dict[str, dict] = {}
+        self.errors: dict[str, str] = {}
+        self.results_path = pjoin(self.workdir, "results.jsonl")
+        self.attempts_path = pjoin(self.workdir, "attempts.json")
+        if pexists(self.results_path):
+            with open(self.results_path, encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.results[record["custom_id"]] = record["body"]
+        self.attempts: dict[str, int] = {}
+        if pexists(self.attempts_path):
+            with open(self.attempts_path, encoding="utf-8") as f:
+                self.attempts = json.load(f)
+
+    @staticmethod
+    def custom_id(body: dict) -> str:
+        return hashlib.sha256(request_key(body).encode()).hexdigest()[:32]
+
+    def lookup(self, body: dict) -> dict:
+        """
+        Get the completion of a request, or record it for the next round.
+
+        Raises:
+            BatchPending: If the result of the request is not available yet.
+            BatchRequestFailed: If the request failed in `max_attempts` rounds.
+        """
+        custom_id = self.custom_id(body)
+        if custom_id in self.results:
+            return self.results[custom_id]
+        if self.attempts.get(custom_id, 0) >= self.max_attempts:
+            raise BatchRequestFailed(
+                f"batch request {custom_id} failed {self.max_attempts} times: {self.errors.get(custom_id, 'no result')}"
+            )
+        self.pending[custom_id] = body
+        raise BatchPending(custom_id)
+
+    def write_requests(self) -> Optional[str]:
+        """
+        Write the pending requests as OpenAI batch-format JSONL.
+
+        Returns:
+            Optional[str]: The path of the request file, None if nothing is pending.
+        """
+        if len(self.pending) == 0:
+            return None
+        round_idx = 0
+        while pexists(pjoin(self.workdir, f"round_{round_idx}.jsonl")):
+            round_idx += 1
+        path = pjoin(self.workdir, f"round_{round_idx}.jsonl")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            for custom_id, body in self.pending.items():
+                request = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": CHAT_COMPLETIONS_URL,
+                    "body": body,
+                }
+                f.write(json.dumps(request, ensure_ascii=False) + "\n")
+                self.attempts[custom_id] = self.attempts.get(custom_id, 0) + 1
+        os.replace(path + ".tmp", path)
+        with open(self.attempts_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.attempts, f)
+        os.replace(self.attempts_path + ".tmp", self.attempts_path)
+        logger.info("%d requests written to %s", len(self.pending), path)
+        self.pending = {}
+        return path
+
+    def ingest(self, result_path: str) -> int:
+        """
+        Ingest an OpenAI batch-format result file, failed requests will be issued again in the next round.
+
+        Returns:
+            int: The number of successful results ingested.
+        """
+        succeeded = 0
+        with (
+            open(result_path, encoding="utf-8") as f,
+            open(self.results_path, "a", encoding="utf-8") as out,
+        ):
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    self.errors[record["custom_id"]] = str(
+                        record.get("error") or response
+                    )
+                    logger.warning(
+                        "batch request %s failed: %s",
+                        record["custom_id"],
+                        record.get("error") or response,
+                    )
+                    continue
+                self.results[record["custom_id"]] = response["body"]
+                out.write(
+                    json.dumps(
+                        {"custom_id": record["custom_id"], "body": response["body"]},
+                        ensure_ascii=False,
+                    )
+                    + "\n"
+                )
+                succeeded += 1
+        return succeeded
+
+
+class DeferredLLM(AsyncLLM):
+    """
+    An `AsyncLLM` that answers from a `BatchLedger` instead of calling the API.
+
+    Unanswered calls are recorded in the ledger and raise `BatchPending`.
+    """
+
+    def __init__(self, llm: AsyncLLM, ledger: BatchLedger):
+        super().__init__(
+            model=llm.model,
+            base_url=llm.base_url,
+            api_key=llm.api_key,
+            timeout=llm.timeout,
+            use_batch=False,
+        )
+        self.ledger = ledger
+
+    async def __call__(
+        self,
+        content: str,
+        images: Optional[Union[str, list[str]]] = None,
+        system_message: Optional[str] = None,
+        history: Optional[list] = None,
+        return_json: bool = False,
+        return_message: bool = False,
+        response_format: Optional[Union[type[BaseModel], dict]] = None,
+        retry: bool = True,
+        **client_kwargs,
+    ) -> Union[str, dict, tuple]:
+        if history is None:
+            history = []
+        system, message = self.format_message(content, images, system_message)
+        body = {
+            "model": self.model,
+            "messages": system + history + message,
+            **client_kwargs,
+        }
+        if isinstance(response_format, type):
+            body["response_format"] = type_to_response_format_param(response_format)
+        else:
+            body.update(structured_output_kwargs(response_format))
+        completion = self.ledger.lookup(body)
+        record_usage(self.model, completion.get("usage"), 0.0)
+        response = completion["choices"][0]["message"]["content"]
+        message.append({"role": "assistant", "content": response})
+        return await self.__post_process__(
+            response, message, return_json, return_message
+        )
+
+
+@dataclass
+class BatchDocument:
+    name: str
+    markdown_content: str
+    image_dir: str
+    document: Optional[Document] = None
+    stage: str = field(default="headings", init=False)
+    error: Optional[str] = field(default=None, init=False)
+    # State kept between rounds so that finished steps are not replayed
+    chunks: Optional[list[str]] = field(default=None, init=False)
+    extracted: list[Optional[tuple[dict, Section]]] = field(
+        default_factory=list, init=False
+    )
+    language: Optional[Language] = field(default=None, init=False)
+    metadata: Optional[dict[str, str]] = field(default=None, init=False)
+
+
+async def _gather_pending(coroutines) -> tuple[list, bool]:
+    """
+    Run coroutines concurrently so that every request of a round is recorded.
+
+    Returns:
+        tuple[list, bool]: The results, and whether any of them is still pending.
+    """
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    pending = False
+    for result in results:
+        if isinstance(result, BatchPending):
+            pending = True
+        elif isinstance(result, BaseException):
+            raise result
+    return results, pending
+
+
+class BatchJob:
+    """
+    Process documents in rounds through an asynchronous batch endpoint.
+
+    Each round replays the pipeline of `Document.from_markdown` against the results
+    ingested so far and writes the requests it could not answer: heading extraction,
+    then chunk extraction, then captions together with the metadata merge.
+    The chunks, extracted sections and merged metadata of a document are kept between
+    rounds, so a step that finished is neither requested nor parsed again.
+
+    A request failing in `max_attempts` rounds, e.g. over the context limit, fails its document, see `failed`.
+
+    Example:
+        job = BatchJob("batch_workdir", language_model, vision_model)
+        job.add("paper", markdown_content, image_dir)
+        while (request_path := await job.prepare()) is not None:
+            await service.process(request_path, result_path)
+            job.ingest(result_path)
+    """
+
+    def __init__(
+        self,
+        workdir: str,
+        language_model: AsyncLLM,
+        vision_model: AsyncLLM,
+        max_attempts: int = 3,
+    ):
+        self.ledger = BatchLedger(workdir, max_attempts)
+        self.language_model = DeferredLLM(language_model, self.ledger)
+        self.vision_model = DeferredLLM(vision_model, self.ledger)
+        self.docs: dict[str, BatchDocument] = {}
+
+    def add(self, name: str, markdown_content: str, image_dir: str):
+        assert name not in self.docs, f"document already added: {name}"
+        self.docs[name] = BatchDocument(name, markdown_content, image_dir)
+
+    @property
+    def documents(self) -> dict[str, Document]:
+        return {
+            name: doc.document
+            for name, doc in self.docs.items()
+            if doc.document is not None
+        }
+
+    @property
+    def failed(self) -> dict[str, str]:
+        """
+        The documents given up on, with the error that failed them.
+        """
+        return {
+            name: doc.error for name, doc in self.docs.items() if doc.stage == "failed"
+        }
+
+    async def prepare(self) -> Optional[str]:
+        """
+        Phase one of a round: advance every document as far as the ingested results allow.
+
+        Returns:
+            Optional[str]: The path of the request file to submit, None once all documents are assembled.
+        """
+        docs = [
+            doc for doc in self.docs.values() if doc.stage not in ("done", "failed")
+        ]
+        results = await asyncio.gather(
+            *(self._advance(doc) for doc in docs), return_exceptions=True
+        )
+        for doc, result in zip(docs, results):
+            if isinstance(result, Exception):
+                logger.warning("failed to process document %s: %s", doc.name, result)
+                doc.stage = "failed"
+                doc.error = repr(result)
+        return self.ledger.write_requests()
+
+    def ingest(self, result_path: str) -> int:
+        """
+        Phase two of a round: ingest the result file of the batch service.
+        """
+        return self.ledger.ingest(result_path)
+
+    async def run(self, service: "LocalBatchService", poll_interval: float = 60):
+        """
+        Run rounds until every document is assembled or failed, see `failed`.
+        """
+        while (request_path := await self.prepare()) is not None:
+            result_path = request_path.replace(".jsonl", ".results.jsonl")
+            await service.process(request_path, result_path, poll_interval)
+            self.ingest(result_path)
+        return self.documents
+
+    async def _advance(self, doc: BatchDocument):
+        extractor = Agent(
+            "doc_extractor",
+            llm_mapping={"language": self.language_model, "vision": self.vision_model},
+        )
+        if doc.chunks is None:
+            try:
+                doc.chunks = await Document._split_chunks(
+                    doc.markdown_content, self.language_model
+                )
+            except BatchPending:
+                doc.stage = "headings"
+                return
+            doc.extracted = [None] * len(doc.chunks)
+
+        missing = [idx for idx, result in enumerate(doc.extracted) if result is None]
+        results, pending = await _gather_pending(
+            Document._extract_section(extractor, doc.chunks[idx], doc.image_dir)
+            for idx in missing
+        )
+        for idx, result in zip(missing, results):
+            if not isinstance(result, BatchPending):
+                doc.extracted[idx] = result
+        if pending:
+            doc.stage = "extraction"
+            return
+
+        sections: list[Section] = [section for _, section in doc.extracted]
+        if doc.language is None:
+            doc.language, chunk_languages = await run_in_thread(
+                detect_languages, doc.chunks
+            )
+            for section, chunk_language in zip(sections, chunk_languages):
+                section.language = chunk_language
+        captions = [
+            Document._caption_medias(section, self.language_model, self.vision_model)
+            for section in sections
+        ]
+        if doc.metadata is None:
+            results, pending = await _gather_pending(
+                [
+                    Document._merge_metadata(
+                        [meta for meta, _ in doc.extracted], self.language_model
+                    ),
+                    *captions,
+                ]
+            )
+            if not isinstance(results[0], BatchPending):
+                doc.metadata = results[0]
+        else:
+            _, pending = await _gather_pending(captions)
+        if pending:
+            doc.stage = "captions"
+            return
+
+        doc.stage = "done"
+        doc.document = Document(
+            image_dir=doc.image_dir,
+            metadata=doc.metadata,
+            blocks=sections,
+            language=doc.language,
+        )
+
+
+class LocalBatchService:
+    """
+    A local, file-based stand-in for an asynchronous batch endpoint.
+
+    Every request of the input file is answered by `responder`, which receives the request body and
+    returns either the assistant content or a full chat completion dict.
+    """
+
+    def __init__(
+        self,
+        responder: Callable[[dict], Awaitable[Union[str, dict]]],
+        max_at_once: int = 16,
+    ):
+        self.responder = responder
+        self.max_at_once = max_at_once
+
+    async def process(
+        self, input_path: str, output_path: str, poll_interval: float = 0
+    ):
+        with open(input_path, encoding="utf-8") as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        limiter = asyncio.Semaphore(self.max_at_once)
+
+        async def answer(request: dict) -> dict:
+            async with limiter:
+                try:
+                    completion = await self.responder(request["body"])
+                except Exception as e:
+                    return {
+                        "id": f"batch_req_{request['custom_id']}",
+                        "custom_id": request["custom_id"],
+                        "response": None,
+                        "error": {"message": str(e)},
+                    }
+            if isinstance(completion, str):
+                completion = {
+                    "id": f"chatcmpl-{request['custom_id']}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request["body"]["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": completion},
+                        }
+                    ],
+                }
+            return {
+                "id": f"batch_req_{request['custom_id']}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": completion},
+                "error": None,
+            }
+
+        results = await asyncio.gather(*(answer(request) for request in requests))
+        with open(output_path + ".tmp", "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        os.replace(output_path + ".tmp", output_path)
+
+
+class OpenAIBatchService:
+    """
+    Submit request files to the OpenAI Batch API and download the results.
+    """
+
+    def __init__(self, llm: AsyncLLM, completion_window: str = "24h"):
+        self.llm = llm
+        self.completion_window = completion_window
+
+    async def process(
+        self, input_path: str, output_path: str, poll_interval: float = 60
+    ):
+        with open(input_path, "rb") as f:
+            input_file = await self.llm.client.files.create(file=f, purpose="batch")
+        batch = await self.llm.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=CHAT_COMPLETIONS_URL,
+            completion_window=self.completion_window,
+        )
+        logger.info("batch %s submitted from %s", batch.id, input_path)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(poll_interval)
+            batch = await self.llm.client.batches.retrieve(batch.id)
+        if batch.status != "completed":
+            logger.warning("batch %s finished with status %s", batch.id, batch.status)
+        with open(output_path + ".tmp", "wb") as f:
+            # Failed requests are left out and will be issued again in the next round
+            if batch.output_file_id is not None:
+                content = await self.llm.client.files.content(batch.output_file_id)
+                f.write(content.read())
+        os.replace(output_path + ".tmp", output_path)
@@ -0,0 +1,70 @@
+import json
+import os
+from typing import Any, Optional
+
+from .doc_utils import chunk_hash
+from .element import Section
+from .utils import get_logger, pexists, pjoin
+
+logger = get_logger(__name__)
+
+
+class Checkpoint:
+    """
+    Persist the completed stages of a document parse, so that a rerun only issues the missing LLM calls.
+
+    Files are stored under `<directory>/<document hash>/`:
+        headings.json: the adjusted headings
+        section_<chunk hash>.json: the metadata and section extracted from a chunk
+        captions_<chunk hash>.json: the captions of the medias in a chunk
+        metadata.json: the merged metadata
+    """
+
+    def __init__(self, directory: str, markdown_content: str):
+        self.directory = pjoin(directory, chunk_hash(markdown_content))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def load(self, key: str) -> Optional[Any]:
+        path = pjoin(self.directory, f"{key}.json")
+        if not pexists(path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except json.JSONDecodeError as e:
+            logger.warning("ignoring corrupted checkpoint %s: %s", path, e)
+            return None
+
+    def save(self, key: str, value: Any):
+        """
+        Write a stage result, the file is replaced atomically so a crash never leaves a partial checkpoint.
+        """
+        path = pjoin(self.directory, f"{key}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def load_section(self, markdown_chunk: str) -> Optional[tuple[dict, Section]]:
+        saved = self.load(f"section_{chunk_hash(markdown_chunk)}")
+        if saved is None:
+            return None
+        section = Section.from_dict(saved["section"])
+        captions = self.load(f"captions_{chunk_hash(markdown_chunk)}") or []
+        for media, caption in zip(section.iter_medias(), captions):
+            media.caption = caption
+        return saved["metadata"], section
+
+    def save_section(self, metadata: dict, section: Section):
+        self.save(
+            f"section_{chunk_hash(section.markdown_content)}",
+            {
+                "metadata": metadata,
+                "section": section.model_dump(mode="json", serialize_as_any=True),
+            },
+        )
+
+    def save_captions(self, section: Section):
+        self.save(
+            f"captions_{chunk_hash(section.markdown_content)}",
+            [media.caption for media in section.iter_medias()],
+        )
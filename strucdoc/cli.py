@@ -0,0 +1,551 @@
+"""
+Command line interface of StrucDoc.
+
+Usage:
+    strucdoc parse ./mineru_outputs --workers 64 --docs-at-once 4 --max-at-once 8 --model gpt-4o
+
+    # on several machines sharing the storage, the first submits the jobs and all of them process the queue
+    strucdoc parse /shared/mineru_outputs --queue /shared/queue --workers 16 --model gpt-4o
+    strucdoc worker /shared/queue --workers 16 --model gpt-4o
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Optional, Union
+
+from .doc_utils import RuleCriteria
+from .document import Document
+from .element import ImageDeduplicator
+from .executors import configure_executors
+from .job_queue import Job, JobQueue, serve
+from .llms import AsyncLLM
+from .utils import get_logger, pjoin
+
+logger = get_logger(__name__)
+
+CHECKPOINT_DIRNAME = ".checkpoint"
+
+
+def discover(
+    root: str,
+    input_name: str = "source.md",
+    output_name: str = "document.json",
+    overwrite: bool = False,
+) -> tuple[list[str], list[str]]:
+    """
+    Find the document directories under `root`.
+
+    Returns:
+        tuple[list[str], list[str]]: The directories to process, largest input first, and the already completed ones.
+    """
+    pending, completed = [], []
+    for dirpath, _, filenames in os.walk(root):
+        if input_name not in filenames:
+            continue
+        if not overwrite and output_name in filenames:
+            completed.append(dirpath)
+        else:
+            pending.append(dirpath)
+    # Start the largest documents first so that they do not become the tail of the run
+    pending.sort(key=lambda d: os.path.getsize(pjoin(d, input_name)), reverse=True)
+    return pending, sorted(completed)
+
+
+async def parse_directory(
+    doc_dir: str,
+    language_model: AsyncLLM,
+    vision_model: AsyncLLM,
+    max_at_once: Optional[int],
+    input_name: str = "source.md",
+    output_name: str = "document.json",
+    checkpoint: bool = False,
+    image_dedup: Union[bool, ImageDeduplicator] = False,
+    pack_tokens: Optional[int] = None,
+    map_tokens: Optional[int] = None,
+    fast_model: Optional[AsyncLLM] = None,
+    rule_criteria: Optional[RuleCriteria] = None,
+    speculative: bool = False,
+) -> dict[str, Any]:
+    """
+    Parse the markdown file in `doc_dir` and save the document next to it.
+
+    With `checkpoint`, completed stages are kept in `doc_dir/.checkpoint` until the document is saved.
+    """
+    checkpoint_dir = pjoin(doc_dir, CHECKPOINT_DIRNAME) if checkpoint else None
+    start = time.perf_counter()
+    result = {"dir": doc_dir, "ok": False, "tokens": 0, "error": None}
+    try:
+        with open(pjoin(doc_dir, input_name), encoding="utf-8") as f:
+            markdown_content = f.read()
+        document = await Document.from_markdown(
+            markdown_content,
+            language_model,
+            vision_model,
+            doc_dir,
+            max_at_once=max_at_once,
+            checkpoint_dir=checkpoint_dir,
+            image_dedup=image_dedup,
+            pack_tokens=pack_tokens,
+            map_tokens=map_tokens,
+            fast_model=fast_model,
+            rule_criteria=rule_criteria,
+            speculative=speculative,
+        )
+        document.save(pjoin(doc_dir, output_name))
+        if checkpoint_dir is not None:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        result["ok"] = True
+        result["tokens"] = document.usage.total.total_tokens
+    except Exception as e:
+        result["error"] = repr(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+async def _serve(
+    tasks: multiprocessing.Queue,
+    results: multiprocessing.Queue,
+    language_model: AsyncLLM,
+    vision_model: AsyncLLM,
+    args: argparse.Namespace,
+):
+    image_dedup = build_image_dedup(args)
+    fast_model = build_fast_model(args)
+    rule_criteria = build_rule_criteria(args)
+
+    async def consume():
+        while (doc_dir := await asyncio.to_thread(tasks.get)) is not None:
+            results.put(
+                await parse_directory(
+                    doc_dir,
+                    language_model,
+                    vision_model,
+                    args.max_at_once,
+                    args.input_name,
+                    args.output_name,
+                    args.checkpoint,
+                    image_dedup,
+                    args.pack_tokens,
+                    args.map_tokens,
+                    fast_model,
+                    rule_criteria,
+                    args.speculative,
+                )
+            )
+
+    await asyncio.gather(*(consume() for _ in range(args.docs_at_once)))
+
+
+async def _serve_queue(
+    queue_dir: str,
+    results: multiprocessing.Queue,
+    language_model: AsyncLLM,
+    vision_model: AsyncLLM,
+    args: argparse.Namespace,
+):
+    image_dedup = build_image_dedup(args)
+    fast_model = build_fast_model(args)
+    rule_criteria = build_rule_criteria(args)
+
+    async def handle(job: Job) -> dict[str, Any]:
+        return await parse_directory(
+            job.dir,
+            language_model,
+            vision_model,
+            args.max_at_once,
+            args.input_name,
+            args.output_name,
+            args.checkpoint,
+            image_dedup,
+            args.pack_tokens,
+            args.map_tokens,
+            fast_model,
+            rule_criteria,
+            args.speculative,
+        )
+
+    await serve(
+        JobQueue(queue_dir, args.lease_seconds, args.max_attempts),
+        handle,
+        args.docs_at_once,
+        args.poll_seconds,
+        on_result=results.put,
+    )
+
+
+def _queue_worker(
+    queue_dir: str,
+    results: multiprocessing.Queue,
+    language_model: AsyncLLM,
+    vision_model: AsyncLLM,
+    args: argparse.Namespace,
+):
+    """
+    Entry of a worker process claiming documents from a shared job queue.
+    """
+    configure_executors(
+        thread_workers=args.thread_workers,
+        process_workers=args.process_workers,
+        render_workers=args.render_workers,
+    )
+    asyncio.run(_serve_queue(queue_dir, results, language_model, vision_model, args))
+
+
+def _worker(
+    tasks: multiprocessing.Queue,
+    results: multiprocessing.Queue,
+    language_model: AsyncLLM,
+    vision_model: AsyncLLM,
+    args: argparse.Namespace,
+):
+    """
+    Entry of a worker process, which has its own event loop, connection pool and concurrency budget.
+    """
+    configure_executors(
+        thread_workers=args.thread_workers,
+        process_workers=args.process_workers,
+        render_workers=args.render_workers,
+    )
+    asyncio.run(_serve(tasks, results, language_model, vision_model, args))
+
+
+@dataclass
+class Progress:
+    total: int
+    done: int = 0
+    failed: int = 0
+    tokens: int = 0
+    start: float = 0.0
+
+    def __post_init__(self):
+        self.start = time.perf_counter()
+
+    def update(self, result: dict[str, Any]):
+        self.done += 1
+        self.failed += not result["ok"]
+        self.tokens += result["tokens"]
+
+    def line(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed * 60 if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate * 60 if rate > 0 else float("inf")
+        return (
+            f"[{self.done}/{self.total}] {rate:.2f} docs/min, {self.tokens / max(elapsed, 1e-9):.0f} tokens/s, "
+            f"ETA {format_seconds(eta)}, {self.failed} failed"
+        )
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds == float("inf"):
+        return "--:--:--"
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def build_models(args: argparse.Namespace) -> tuple[AsyncLLM, AsyncLLM]:
+    assert (
+        args.model
+    ), "a language model is required, pass --model or set LANGUAGE_MODEL"
+    language_model = AsyncLLM(
+        model=args.model,
+        base_url=args.base_url,
+        api_key=args.api_key,
+        use_batch=args.use_batch,
+    )
+    vision_model = AsyncLLM(
+        model=args.vision_model or args.model,
+        base_url=args.base_url,
+        api_key=args.api_key,
+        use_batch=args.use_batch,
+    )
+    return language_model, vision_model
+
+
+def build_fast_model(args: argparse.Namespace) -> Optional[AsyncLLM]:
+    if args.fast_model is None:
+        return None
+    return AsyncLLM(
+        model=args.fast_model,
+        base_url=args.base_url,
+        api_key=args.api_key,
+        use_batch=args.use_batch,
+    )
+
+
+def build_image_dedup(args: argparse.Namespace) -> Union[bool, ImageDeduplicator]:
+    # Near-duplicate images are captioned once per document, or once per worker with --corpus-dedup
+    if args.corpus_dedup:
+        return ImageDeduplicator()
+    return args.image_dedup
+
+
+def build_rule_criteria(args: argparse.Namespace) -> Optional[RuleCriteria]:
+    if not args.rule_extraction:
+        return None
+    return RuleCriteria(min_subsections=args.rule_min_subsections)
+
+
+def run_parse(args: argparse.Namespace) -> int:
+    pending, completed = discover(
+        args.root, args.input_name, args.output_name, args.overwrite
+    )
+    logger.info(
+        "%d documents to process, %d already completed", len(pending), len(completed)
+    )
+    if args.queue is not None:
+        added = JobQueue(args.queue, args.lease_seconds, args.max_attempts).submit(
+            pending
+        )
+        logger.info("%d jobs submitted to %s", added, args.queue)
+        return run_worker(args)
+    if len(pending) == 0:
+        return 0
+    language_model, vision_model = build_models(args)
+
+    context = multiprocessing.get_context("spawn")
+    tasks, results = context.Queue(), context.Queue()
+    workers = min(args.workers, len(pending))
+    for doc_dir in pending:
+        tasks.put(doc_dir)
+    for _ in range(workers * args.docs_at_once):
+        tasks.put(None)
+    processes = [
+        context.Process(
+            target=_worker,
+            args=(tasks, results, language_model, vision_model, args),
+            name=f"strucdoc-worker-{i}",
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    progress = Progress(len(pending))
+    try:
+        while progress.done < progress.total:
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    logger.error("all workers exited before finishing the documents")
+                    break
+                continue
+            progress.update(result)
+            if not result["ok"]:
+                logger.warning("failed to parse %s: %s", result["dir"], result["error"])
+            logger.info("%s %s", progress.line(), result["dir"])
+    finally:
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+    return int(progress.failed > 0 or progress.done < progress.total)
+
+
+def run_worker(args: argparse.Namespace) -> int:
+    """
+    Process the jobs of a shared queue with local worker processes, until no job is pending or claimed.
+    """
+    job_queue = JobQueue(args.queue, args.lease_seconds, args.max_attempts)
+    counts = job_queue.counts()
+    logger.info("queue %s: %s", args.queue, counts)
+    if counts["pending"] == 0 and counts["claimed"] == 0:
+        return 0
+    language_model, vision_model = build_models(args)
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=_queue_worker,
+            args=(args.queue, results, language_model, vision_model, args),
+            name=f"strucdoc-worker-{i}",
+        )
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    # Other machines process the same queue, so the total is only an estimate
+    progress = Progress(counts["pending"] + counts["claimed"])
+    try:
+        while any(process.is_alive() for process in processes) or not results.empty():
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                continue
+            progress.update(result)
+            if not result["ok"]:
+                logger.warning("failed to parse %s: %s", result["dir"], result["error"])
+            logger.info("%s %s", progress.line(), result["dir"])
+    finally:
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+    return int(job_queue.counts()["failed"] > 0)
+
+
+def add_processing_arguments(parser: argparse.ArgumentParser):
+    """
+    Add the arguments shared by the commands processing documents.
+    """
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="number of worker processes"
+    )
+    parser.add_argument(
+        "--docs-at-once",
+        type=int,
+        default=2,
+        help="documents processed concurrently by each worker",
+    )
+    parser.add_argument(
+        "--max-at-once",
+        type=int,
+        default=None,
+        help="chunks processed concurrently per document",
+    )
+    parser.add_argument(
+        "--thread-workers",
+        type=int,
+        default=None,
+        help="threads per worker for blocking work such as table rendering",
+    )
+    parser.add_argument(
+        "--process-workers",
+        type=int,
+        default=0,
+        help="processes per worker for CPU-bound parsing, 0 uses the threads",
+    )
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=2,
+        help="tables rendered at once per worker, each one runs a headless Chromium",
+    )
+    parser.add_argument("--model", default=os.environ.get("LANGUAGE_MODEL"))
+    parser.add_argument("--vision-model", default=os.environ.get("VISION_MODEL"))
+    parser.add_argument(
+        "--fast-model",
+        default=os.environ.get("FAST_MODEL"),
+        help="a cheaper model extracting sections first, escalated to --model when its output fails validation",
+    )
+    parser.add_argument("--base-url", default=os.environ.get("API_BASE"))
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"))
+    parser.add_argument(
+        "--use-batch",
+        action="store_true",
+        help="group concurrent requests, see AsyncLLM",
+    )
+    parser.add_argument("--input-name", default="source.md")
+    parser.add_argument("--output-name", default="document.json")
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="persist completed stages so that an interrupted document resumes where it stopped",
+    )
+    parser.add_argument(
+        "--image-dedup",
+        action="store_true",
+        help="caption near-duplicate images of a document once, similar but distinct images may share a caption",
+    )
+    parser.add_argument(
+        "--corpus-dedup",
+        action="store_true",
+        help="share caption deduplication of near-duplicate images across the documents of a worker, implies --image-dedup",
+    )
+    parser.add_argument(
+        "--pack-tokens",
+        type=int,
+        default=None,
+        help="extract adjacent small sections together in requests of up to this many tokens",
+    )
+    parser.add_argument(
+        "--map-tokens",
+        type=int,
+        default=None,
+        help="split sections over this many tokens into parts extracted in parallel",
+    )
+    parser.add_argument(
+        "--rule-extraction",
+        action="store_true",
+        help="build sections with clean sub-headings from the markdown without an extraction request",
+    )
+    parser.add_argument(
+        "--rule-min-subsections",
+        type=int,
+        default=RuleCriteria.min_subsections,
+        help="with --rule-extraction, the sub-headings a section needs to skip the extraction request",
+    )
+    parser.add_argument(
+        "--speculative",
+        action="store_true",
+        help="parse sections by their guessed top-level headings while the headings are extracted, re-parsing those whose boundaries change",
+    )
+    parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=300.0,
+        help="with a queue, a document without a heartbeat of its worker for this long is given to another worker",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="with a queue, a document failing this many times is moved to failed/",
+    )
+    parser.add_argument(
+        "--poll-seconds",
+        type=float,
+        default=5.0,
+        help="with a queue, the interval to look for documents released by expired leases",
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="strucdoc", description="StrucDoc, structure documents with LLMs."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parse = subparsers.add_parser(
+        "parse", help="parse every source.md under a directory tree"
+    )
+    parse.add_argument("root", help="directory tree of MinerU outputs")
+    parse.add_argument(
+        "--overwrite", action="store_true", help="reprocess completed documents"
+    )
+    parse.add_argument(
+        "--queue",
+        default=None,
+        help="submit the documents to a job queue directory on shared storage and process it, see `strucdoc worker`",
+    )
+    add_processing_arguments(parse)
+    parse.set_defaults(func=run_parse)
+
+    worker = subparsers.add_parser(
+        "worker",
+        help="process the documents of a job queue shared with workers on other machines",
+    )
+    worker.add_argument(
+        "queue", help="job queue directory created by `strucdoc parse --queue`"
+    )
+    add_processing_arguments(worker)
+    worker.set_defaults(func=run_worker)
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
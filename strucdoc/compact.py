@@ -0,0 +1,331 @@
+"""
+A compact, read-only representation of parsed documents for holding large corpora in memory.
+
+The texts of a document live in one UTF-8 buffer, and the records only keep offsets into it.
+Texts extracted verbatim from the source, such as subsection contents, table cells and the
+context of medias, are found inside the markdown of their section and not stored twice.
+Pydantic models are only built by `to_document`.
+"""
+
+import json
+import sys
+from array import array
+from typing import Iterator, Optional, Union
+
+from .document import Document
+from .element import Media, Section, SubSection, Table
+from .utils import Language, pdirname
+
+
+class BufferBuilder:
+    """
+    Accumulate the texts of a document into one UTF-8 buffer.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def add(self, text: str) -> tuple[int, int]:
+        start = len(self.data)
+        self.data += text.encode()
+        return start, len(self.data)
+
+    def find_or_add(self, text: str, start: int, end: int) -> tuple[int, int]:
+        """
+        Get the span of `text` within `data[start:end]`, the text is appended if it is not found there.
+        """
+        encoded = text.encode()
+        found = self.data.find(encoded, start, end)
+        if found == -1:
+            return self.add(text)
+        return found, found + len(encoded)
+
+    def build(self) -> bytes:
+        return bytes(self.data)
+
+
+def decode(buffer: bytes, start: int, end: int) -> str:
+    return buffer[start:end].decode()
+
+
+class CompactSubSection:
+    __slots__ = ("buffer", "title", "start", "end")
+
+    def __init__(self, buffer: bytes, title: str, start: int, end: int):
+        self.buffer = buffer
+        self.title = title
+        self.start = start
+        self.end = end
+
+    @property
+    def content(self) -> str:
+        return decode(self.buffer, self.start, self.end)
+
+    def to_model(self) -> SubSection:
+        return SubSection(title=self.title, content=self.content)
+
+
+class CompactMedia:
+    # spans holds the (start, end) offsets of the markdown content, both near chunks and the caption
+    __slots__ = ("buffer", "path", "spans")
+
+    def __init__(self, buffer: bytes, path: Optional[str], spans: array):
+        self.buffer = buffer
+        self.path = path
+        self.spans = spans
+
+    def _text(self, i: int) -> str:
+        return decode(self.buffer, self.spans[2 * i], self.spans[2 * i + 1])
+
+    @property
+    def markdown_content(self) -> str:
+        return self._text(0)
+
+    @property
+    def near_chunks(self) -> tuple[str, str]:
+        return self._text(1), self._text(2)
+
+    @property
+    def caption(self) -> Optional[str]:
+        # A missing caption is stored as an empty span starting at -1
+        if self.spans[6] == -1:
+            return None
+        return self._text(3)
+
+    def _fields(self) -> dict:
+        return {
+            "markdown_content": self.markdown_content,
+            "near_chunks": self.near_chunks,
+            "path": self.path,
+            "caption": self.caption,
+        }
+
+    def to_model(self) -> Media:
+        return Media(**self._fields())
+
+
+class CompactTable(CompactMedia):
+    # cell_spans holds the (start, end) offsets of every cell, row_lengths the number of cells of every row
+    __slots__ = ("cell_spans", "row_lengths", "merge_area")
+
+    def __init__(
+        self,
+        buffer: bytes,
+        path: Optional[str],
+        spans: array,
+        cell_spans: Optional[array],
+        row_lengths: Optional[array],
+        merge_area: Optional[tuple[tuple[int, int, int, int], ...]],
+    ):
+        super().__init__(buffer, path, spans)
+        self.cell_spans = cell_spans
+        self.row_lengths = row_lengths
+        self.merge_area = merge_area
+
+    @property
+    def cells(self) -> Optional[list[list[str]]]:
+        if self.cell_spans is None:
+            return None
+        cells, i = [], 0
+        for length in self.row_lengths:
+            cells.append(
+                [
+                    decode(self.buffer, self.cell_spans[j], self.cell_spans[j + 1])
+                    for j in range(i, i + 2 * length, 2)
+                ]
+            )
+            i += 2 * length
+        return cells
+
+    def to_model(self) -> Table:
+        return Table(
+            **self._fields(),
+            cells=self.cells,
+            merge_area=None if self.merge_area is None else list(self.merge_area),
+        )
+
+
+class CompactSection:
+    __slots__ = ("buffer", "title", "spans", "language", "blocks")
+
+    def __init__(
+        self,
+        buffer: bytes,
+        title: str,
+        spans: array,
+        language: Optional[Language],
+        blocks: tuple[Union[CompactSubSection, CompactMedia], ...],
+    ):
+        self.buffer = buffer
+        self.title = title
+        # (start, end) offsets of the summary and the markdown content, -1 if there is no markdown content
+        self.spans = spans
+        self.language = language
+        self.blocks = blocks
+
+    @property
+    def summary(self) -> str:
+        return decode(self.buffer, self.spans[0], self.spans[1])
+
+    @property
+    def markdown_content(self) -> Optional[str]:
+        if self.spans[2] == -1:
+            return None
+        return decode(self.buffer, self.spans[2], self.spans[3])
+
+    def iter_medias(self) -> Iterator[CompactMedia]:
+        for block in self.blocks:
+            if isinstance(block, CompactMedia):
+                yield block
+
+    def to_model(self) -> Section:
+        return Section(
+            title=self.title,
+            summary=self.summary,
+            blocks=[block.to_model() for block in self.blocks],
+            markdown_content=self.markdown_content,
+            language=self.language,
+        )
+
+
+class CompactDocument:
+    """
+    A read-only document whose texts share one buffer, built from a `Document` or directly from its saved JSON.
+
+    Example:
+        corpus = [CompactDocument.load(path) for path in paths]
+        document = corpus[0].to_document()
+    """
+
+    __slots__ = ("image_dir", "buffer", "blocks", "metadata", "language")
+
+    def __init__(
+        self,
+        image_dir: str,
+        buffer: bytes,
+        blocks: tuple[CompactSection, ...],
+        metadata: dict[str, str],
+        language: Language,
+    ):
+        self.image_dir = image_dir
+        self.buffer = buffer
+        self.blocks = blocks
+        self.metadata = metadata
+        self.language = language
+
+    @classmethod
+    def from_dict(cls, data: dict, image_dir: str) -> "CompactDocument":
+        """
+        Build from the output of `Document.dict` without validating it.
+        """
+        builder = BufferBuilder()
+        pending = []
+        for section in data["blocks"]:
+            summary = builder.add(section["summary"])
+            if section.get("markdown_content") is None:
+                chunk = (-1, -1)
+                scope = (0, 0)
+            else:
+                chunk = scope = builder.add(section["markdown_content"])
+            blocks = []
+            for block in section["blocks"]:
+                if "markdown_content" not in block:
+                    blocks.append(
+                        (
+                            "subsection",
+                            sys.intern(block["title"]),
+                            builder.find_or_add(block["content"], *scope),
+                        )
+                    )
+                    continue
+                spans = array("q")
+                spans.extend(builder.find_or_add(block["markdown_content"], *scope))
+                for near_chunk in block["near_chunks"]:
+                    spans.extend(builder.find_or_add(near_chunk, *scope))
+                if block.get("caption") is None:
+                    spans.extend((-1, -1))
+                else:
+                    spans.extend(builder.add(block["caption"]))
+                if "cells" not in block:
+                    blocks.append(("media", block.get("path"), spans))
+                    continue
+                cell_spans = row_lengths = None
+                if block["cells"] is not None:
+                    table_scope = spans[0], spans[1]
+                    cell_spans, row_lengths = array("q"), array("I")
+                    for row in block["cells"]:
+                        row_lengths.append(len(row))
+                        for cell in row:
+                            cell_spans.extend(builder.find_or_add(cell, *table_scope))
+                merge_area = block.get("merge_area")
+                if merge_area is not None:
+                    merge_area = tuple(tuple(area) for area in merge_area)
+                blocks.append(
+                    (
+                        "table",
+                        block.get("path"),
+                        spans,
+                        cell_spans,
+                        row_lengths,
+                        merge_area,
+                    )
+                )
+            language = section.get("language")
+            pending.append(
+                (
+                    sys.intern(section["title"]),
+                    array("q", (*summary, *chunk)),
+                    None if language is None else Language(language),
+                    blocks,
+                )
+            )
+
+        buffer = builder.build()
+        sections = []
+        for title, spans, language, blocks in pending:
+            records = []
+            for kind, *fields in blocks:
+                if kind == "subsection":
+                    records.append(CompactSubSection(buffer, fields[0], *fields[1]))
+                elif kind == "media":
+                    records.append(CompactMedia(buffer, *fields))
+                else:
+                    records.append(CompactTable(buffer, *fields))
+            sections.append(
+                CompactSection(buffer, title, spans, language, tuple(records))
+            )
+        return cls(
+            image_dir,
+            buffer,
+            tuple(sections),
+            data["metadata"],
+            Language(data["language"]),
+        )
+
+    @classmethod
+    def from_document(cls, document: Document) -> "CompactDocument":
+        return cls.from_dict(document.dict, document.image_dir)
+
+    @classmethod
+    def load(cls, path: str, image_dir: Optional[str] = None) -> "CompactDocument":
+        """
+        Load a document saved by `Document.save`.
+        """
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls.from_dict(data, image_dir or pdirname(path) or ".")
+
+    def iter_medias(self) -> Iterator[CompactMedia]:
+        for section in self.blocks:
+            yield from section.iter_medias()
+
+    def to_document(self) -> Document:
+        """
+        Rebuild the validated pydantic document.
+        """
+        return Document(
+            image_dir=self.image_dir,
+            blocks=[section.to_model() for section in self.blocks],
+            metadata=dict(self.metadata),
+            language=self.language,
+        )
@@ -1,17 +1,23 @@
+import hashlib
 import re
-from typing import Literal
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Literal, Optional
 
 from bs4 import BeautifulSoup
 from fasttext import load_model
 from huggingface_hub import hf_hub_download
 from pydantic import BaseModel, Field, create_model
 
-from .utils import Language, edit_distance
+from .utils import Language, count_tokens, edit_distance
 
 MARKDOWN_IMAGE_REGEX = re.compile(r"!\[.*\]\(.*\)")
 MARKDOWN_TABLE_REGEX = re.compile(
     r"(\|.*\|)|((<html><body>)?<table>.*</table>(</body></html>)?)"
 )
+MARKDOWN_HEADING_REGEX = re.compile(r"^#{1,6}\s+(.*?)\s*#*$")
+MARKDOWN_FENCE_REGEX = re.compile(r"^\s*(```|~~~)")
 
 LID_MODEL = load_model(
     hf_hub_download(
@@ -21,13 +27,60 @@ LID_MODEL = load_model(
 )
 
 
+def chunk_hash(markdown_chunk: str) -> str:
+    """
+    Get a short, stable identifier of a markdown chunk.
+    """
+    return hashlib.sha256(markdown_chunk.encode()).hexdigest()[:16]
+
+
+LANGUAGE_CACHE: dict[str, Language] = {}
+LANGUAGE_CACHE_SIZE = 65536
+_language_cache_lock = threading.Lock()
+
+
 def language_id(text: str) -> Language:
-    text = text[:1024].replace("\n", " ")
-    label = LID_MODEL.predict(text)[0][0].replace("__label__", "")
-    if label in ["zh", "ja", "ko"]:
-        return Language.CJK
-    else:
-        return Language.LATIN
+    return language_ids([text])[0]
+
+
+def language_ids(texts: list[str]) -> list[Language]:
+    """
+    Identify the languages of several texts with one batched fastText prediction.
+    """
+    if len(texts) == 0:
+        return []
+    labels, _ = LID_MODEL.predict([text[:1024].replace("\n", " ") for text in texts])
+    return [
+        (
+            Language.CJK
+            if label[0].replace("__label__", "") in ["zh", "ja", "ko"]
+            else Language.LATIN
+        )
+        for label in labels
+    ]
+
+
+def detect_languages(chunks: list[str]) -> tuple[Language, list[Language]]:
+    """
+    Identify the language of every chunk and of the whole document, cached by chunk hash.
+
+    Returns:
+        tuple[Language, list[Language]]: The language of most chunks, ties going to the earliest, and the language of each chunk.
+    """
+    hashes = [chunk_hash(chunk) for chunk in chunks]
+    with _language_cache_lock:
+        languages = {h: LANGUAGE_CACHE[h] for h in hashes if h in LANGUAGE_CACHE}
+    missing = {h: chunk for h, chunk in zip(hashes, chunks) if h not in languages}
+    if len(missing) != 0:
+        predicted = dict(zip(missing, language_ids(list(missing.values()))))
+        languages.update(predicted)
+        with _language_cache_lock:
+            if len(LANGUAGE_CACHE) + len(predicted) > LANGUAGE_CACHE_SIZE:
+                LANGUAGE_CACHE.clear()
+            LANGUAGE_CACHE.update(predicted)
+    chunk_languages = [languages[h] for h in hashes]
+    votes = Counter(chunk_languages).most_common(1)
+    return votes[0][0] if votes else Language.LATIN, chunk_languages
 
 
 def count_markdown_chunks(markdown_text):
@@ -251,6 +304,235 @@ def split_markdown_by_headings(
     return sections
 
 
+def guess_top_headings(headings: list[str]) -> list[str]:
+    """
+    Guess the top-level headings without an LLM, to start processing chunks before they are extracted.
+
+    The shallowest level with several headings is taken, a lone heading above it is usually the document title.
+    Among them, headings numbered like subsections ("2.1") are dropped when some are numbered like sections ("2.").
+
+    Args:
+        headings (list[str]): The markdown heading lines in document order.
+
+    Returns:
+        list[str]: The guessed top-level headings, the adjusted headings would otherwise be a subset of them.
+    """
+    if len(headings) == 0:
+        return []
+    levels = [len(h) - len(h.lstrip("#")) for h in headings]
+    top = min(
+        (level for level in set(levels) if levels.count(level) > 1),
+        default=min(levels),
+    )
+    guessed = [h for h, level in zip(headings, levels) if level <= top]
+    numbers = [re.match(r"^#+\s*(\d+(?:\.\d+)*)\.?\s", h) for h in guessed]
+    if any(n is not None and "." not in n.group(1) for n in numbers):
+        guessed = [
+            h for h, n in zip(guessed, numbers) if n is None or "." not in n.group(1)
+        ]
+    return guessed
+
+
+def speculative_split(markdown_content: str) -> list[str]:
+    """
+    Split a document by its guessed top-level headings, see `guess_top_headings`.
+    """
+    headings = re.findall(r"^#+\s+.*", markdown_content, re.MULTILINE)
+    return split_markdown_by_headings(
+        markdown_content, headings, guess_top_headings(headings)
+    )
+
+
+def occurrence_keys(chunks: list[str]) -> list[tuple[str, int]]:
+    """
+    Key each chunk by its text and the number of earlier chunks with the same text, to match chunks of two splits by position.
+    """
+    seen = Counter()
+    keys = []
+    for chunk in chunks:
+        keys.append((chunk, seen[chunk]))
+        seen[chunk] += 1
+    return keys
+
+
+def pack_chunks(
+    chunks: list[str], max_tokens: int = 2048, max_sections: int = 8
+) -> list[list[str]]:
+    """
+    Group adjacent chunks so that small sections share one extraction request.
+
+    Args:
+        chunks (list[str]): The markdown chunks in document order.
+        max_tokens (int): The token budget of a pack, a chunk exceeding it forms a pack of its own.
+        max_sections (int): The maximum number of chunks in a pack.
+
+    Returns:
+        list[list[str]]: The packs, concatenating them gives back the chunks in order.
+    """
+    packs: list[list[str]] = []
+    pack_tokens = 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk)
+        if (
+            len(packs) != 0
+            and pack_tokens + tokens <= max_tokens
+            and len(packs[-1]) < max_sections
+        ):
+            packs[-1].append(chunk)
+            pack_tokens += tokens
+        else:
+            packs.append([chunk])
+            pack_tokens = tokens
+    return packs
+
+
+def markdown_paragraphs(markdown_content: str) -> list[str]:
+    """
+    Split markdown at blank lines, keeping fenced code blocks whole even if they contain blank lines.
+    """
+    paragraphs: list[str] = []
+    in_fence = False
+    for para in markdown_content.split("\n\n"):
+        if in_fence:
+            paragraphs[-1] += "\n\n" + para
+        elif para.strip():
+            paragraphs.append(para)
+        else:
+            continue
+        for line in para.splitlines():
+            if MARKDOWN_FENCE_REGEX.match(line):
+                in_fence = not in_fence
+    return paragraphs
+
+
+def split_oversized_chunk(markdown_chunk: str, max_tokens: int = 8192) -> list[str]:
+    """
+    Split a chunk exceeding the token budget into parts at paragraph boundaries, preferring sub-headings.
+
+    Args:
+        markdown_chunk (str): The markdown chunk of a section.
+        max_tokens (int): The token budget of a part, a single paragraph exceeding it forms a part of its own.
+
+    Returns:
+        list[str]: The parts in order, or the chunk itself if it fits the budget.
+    """
+    if count_tokens(markdown_chunk) <= max_tokens:
+        return [markdown_chunk]
+    parts: list[list[str]] = []
+    part_tokens = 0
+    after_heading = False
+    for para in markdown_paragraphs(markdown_chunk):
+        tokens = count_tokens(para)
+        is_heading = (
+            MARKDOWN_HEADING_REGEX.match(para.lstrip().splitlines()[0]) is not None
+        )
+        # Start a new part at a sub-heading once the current one is half full, but never right after a heading
+        new_part = part_tokens + tokens > max_tokens or (
+            is_heading and part_tokens >= max_tokens // 2
+        )
+        if len(parts) == 0 or (new_part and not after_heading):
+            parts.append([])
+            part_tokens = 0
+        parts[-1].append(para)
+        part_tokens += tokens
+        after_heading = is_heading and len(para.strip().splitlines()) == 1
+    return ["\n\n".join(part) for part in parts]
+
+
+@dataclass
+class RuleCriteria:
+    """
+    When a chunk is structured enough to be extracted without a request, see `rule_extract_section`.
+
+    Args:
+        min_subsections (int): The minimum number of sub-headings below the heading of the chunk.
+        max_title_words (int): The maximum number of words of a sub-heading, longer ones are likely sentences.
+        max_subsection_tokens (int): The maximum number of tokens of a subsection.
+    """
+
+    min_subsections: int = 2
+    max_title_words: int = 12
+    max_subsection_tokens: int = 2048
+
+
+def rule_extract_section(markdown_chunk: str, criteria: RuleCriteria) -> Optional[dict]:
+    """
+    Build a section straight from the headings and paragraphs of a chunk, without an LLM.
+
+    Every sub-heading starts a subsection with the paragraphs below it, text before the first one is
+    a subsection titled after the chunk heading. Tables and images are left out, they are linked as medias.
+
+    Args:
+        markdown_chunk (str): The markdown chunk of a section.
+        criteria (RuleCriteria): The structure required to extract the chunk.
+
+    Returns:
+        Optional[dict]: The section in the format of the extractor response with an empty summary,
+            or None if the chunk does not meet the criteria and should be extracted by the LLM.
+    """
+    title = None
+    blocks: list[dict] = []
+    paragraphs: list[str] = []
+    lines: list[str] = []
+
+    def close_paragraph():
+        if len(lines) != 0:
+            paragraphs.append("\n".join(lines))
+            lines.clear()
+
+    def close_block():
+        close_paragraph()
+        if len(paragraphs) != 0:
+            if len(blocks) == 0:
+                blocks.append({"title": title, "content": ""})
+            blocks[-1]["content"] = "\n\n".join(paragraphs)
+            paragraphs.clear()
+
+    in_fence = False
+    for para in markdown_paragraphs(markdown_chunk):
+        para = para.strip()
+        if MARKDOWN_TABLE_REGEX.match(para) or MARKDOWN_IMAGE_REGEX.match(para):
+            continue
+        # Markup other than tables is left for the LLM to clean up
+        if para.startswith("<"):
+            return None
+        for line in para.splitlines():
+            # A code block is kept whole, the comments in it are not headings
+            heading = None
+            if MARKDOWN_FENCE_REGEX.match(line):
+                in_fence = not in_fence
+            elif not in_fence:
+                heading = MARKDOWN_HEADING_REGEX.match(line)
+            if heading is None:
+                if title is None:
+                    return None
+                lines.append(line)
+                continue
+            close_block()
+            text = heading.group(1).strip()
+            if title is None:
+                title = text
+                continue
+            # A sub-heading without content, e.g. directly followed by a nested one
+            if len(blocks) != 0 and not blocks[-1]["content"]:
+                return None
+            blocks.append({"title": text, "content": ""})
+        close_paragraph()
+    close_block()
+
+    subsections = [block for block in blocks if block["title"] != title]
+    if title is None or len(blocks) == 0 or len(subsections) < criteria.min_subsections:
+        return None
+    for block in blocks:
+        if (
+            not block["content"]
+            or len(block["title"].split()) > criteria.max_title_words
+            or count_tokens(block["content"]) > criteria.max_subsection_tokens
+        ):
+            return None
+    return {"title": title, "summary": "", "blocks": blocks}
+
+
 def process_markdown_content(
     markdown_content: str,
     max_chunk_size: int = 256,
@@ -1,22 +1,58 @@
 import asyncio
 import contextlib
+import json
+import os
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional
+from typing import Optional, TextIO, Union
 
 from jinja2 import Environment, StrictUndefined
 
 from .agent import Agent
+from .checkpoint import Checkpoint
 from .doc_utils import (
     LogicHeadings,
+    RuleCriteria,
+    chunk_hash,
+    detect_languages,
     get_tree_structure,
+    occurrence_keys,
+    pack_chunks,
     process_markdown_content,
+    rule_extract_section,
+    speculative_split,
     split_markdown_by_headings,
+    split_oversized_chunk,
 )
-from .element import Section, SubSection, Table, link_medias
+from .element import (
+    ImageDeduplicator,
+    Media,
+    Section,
+    SubSection,
+    Table,
+    build_section,
+)
+from .executors import EXECUTORS, run_cpu, run_in_thread
+from .export import export, iter_overview
 from .llms import AsyncLLM
-from .utils import Language, get_logger, package_join, pbasename, pexists, pjoin
+from .search import (
+    BM25Index,
+    EmbeddingIndex,
+    SearchHit,
+    embedding_index_path,
+    search_index_path,
+)
+from .tracing import instant, span
+from .usage import UsageTracker, track_usage
+from .utils import (
+    Language,
+    get_logger,
+    image_index,
+    package_join,
+    pdirname,
+    pexists,
+)
 
 logger = get_logger(__name__)
 
@@ -28,27 +64,92 @@ MERGE_METADATA_PROMPT = env.from_string(
 HEADING_EXTRACT_PROMPT = env.from_string(
     open(package_join("prompts", "heading_extract.txt")).read()
 )
+SECTION_REDUCE_PROMPT = env.from_string(
+    open(package_join("prompts", "section_reduce.txt")).read()
+)
+SECTION_SUMMARIES_PROMPT = env.from_string(
+    open(package_join("prompts", "section_summaries.txt")).read()
+)
+# Sections summarized per request, and the characters of each section shown in it
+SUMMARY_BATCH_SIZE = 16
+SUMMARY_SECTION_CHARS = 2000
+
+
+def valid_section(response: dict) -> bool:
+    """
+    Check a section extracted by a cheaper model: it matches the Section schema and has a title and blocks.
+    """
+    try:
+        section = Section.from_dict(
+            {key: value for key, value in response.items() if key != "metadata"}
+        )
+    except Exception:
+        return False
+    return bool(section.title.strip()) and len(section.blocks) > 0
+
+
+@contextlib.asynccontextmanager
+async def hand_over(limiter: Optional[asyncio.Semaphore]):
+    """
+    Release the slot of `limiter` held by the caller while its requests take slots of their own.
+    """
+    if limiter is None:
+        yield
+        return
+    limiter.release()
+    try:
+        yield
+    finally:
+        await limiter.acquire()
+
+
+async def take_slot(limiter: Optional[asyncio.Semaphore], coro):
+    async with limiter or contextlib.AsyncExitStack():
+        return await coro
+
+
+def lead_summary(section: Section, max_words: int = 100) -> str:
+    """
+    The leading sentences of a section, used when no summary was generated for it.
+    """
+    content = " ".join(
+        block.content for block in section.blocks if isinstance(block, SubSection)
+    )
+    summary, words = [], 0
+    for sentence in re.split(r"(?<=[.!?])\s+|(?<=[。！？])", content.strip()):
+        words += len(sentence.split())
+        if len(summary) != 0 and words > max_words:
+            break
+        summary.append(sentence)
+    # Also bounds a single long sentence, or text without spaces between words
+    return " ".join(summary)[: max_words * 8]
 
 
 @dataclass
 class Document:
     image_dir: str
-    sections: list[Section]
+    blocks: list[Section]
     metadata: dict[str, str]
     language: Language
+    usage: Optional[UsageTracker] = field(default=None, repr=False, compare=False)
+    _search_index: Optional[BM25Index] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _embedding_index: Optional[EmbeddingIndex] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     def __post_init__(self):
         self.metadata["presentation-date"] = datetime.now().strftime("%Y-%m-%d")
         assert pexists(
             self.image_dir
         ), f"image directory is not found: {self.image_dir}"
+        index = image_index(self.image_dir)
         for media in self.iter_medias():
-            if pexists(media.path):
-                continue
-            basename = pbasename(media.path)
-            if pexists(pjoin(self.image_dir, basename)):
-                media.path = pjoin(self.image_dir, basename)
-            else:
+            path = index.resolve(media.path)
+            if path is not None:
+                media.path = path
+            elif not pexists(media.path):
                 raise FileNotFoundError(f"image file not found: {media.path}")
 
     def iter_medias(self):
@@ -62,32 +163,409 @@ class Document:
         raise ValueError(f"table not found: {image_path}")
 
     @classmethod
-    async def _parse_chunk(
+    async def _split_chunks(
+        cls,
+        markdown_content: str,
+        language_model: AsyncLLM,
+        checkpoint: Optional[Checkpoint] = None,
+    ) -> list[str]:
+        """
+        Extract the logical top-level headings and split the document by them.
+        """
+        with span("heading_extraction"):
+            headings = re.findall(r"^#+\s+.*", markdown_content, re.MULTILINE)
+            adjusted_headings = None
+            if checkpoint is not None:
+                adjusted_headings = checkpoint.load("headings")
+            if adjusted_headings is None:
+                document_tree = get_tree_structure(markdown_content)
+                response = await language_model(
+                    HEADING_EXTRACT_PROMPT.render(tree=document_tree),
+                    return_json=True,
+                    response_format=LogicHeadings.get_literal_schema(headings),
+                )
+                adjusted_headings = response["headings"]
+                if checkpoint is not None:
+                    await run_in_thread(checkpoint.save, "headings", adjusted_headings)
+        with span("split_chunks", "cpu"):
+            return split_markdown_by_headings(
+                markdown_content, headings, adjusted_headings
+            )
+
+    @classmethod
+    async def _extract_section(
         cls,
         extractor: Agent,
         markdown_chunk: str,
         image_dir: str,
+        map_tokens: Optional[int] = None,
+        limiter: Optional[asyncio.Semaphore] = None,
+    ) -> tuple[dict, Section]:
+        """
+        Extract a section from a markdown chunk and link its medias.
+
+        With `map_tokens`, a chunk exceeding it is split into parts extracted in parallel, see `_map_reduce_section`.
+        """
+        with span("process_markdown", "cpu"):
+            medias = await run_cpu(process_markdown_content, markdown_chunk)
+            parts = [markdown_chunk]
+            if map_tokens is not None:
+                parts = await run_cpu(split_oversized_chunk, markdown_chunk, map_tokens)
+        if len(parts) > 1:
+            section = await cls._map_reduce_section(extractor, parts, limiter)
+        else:
+            with span("extraction"):
+                _, section = await extractor(
+                    markdown_document=markdown_chunk,
+                    response_format=Section.json_schema(),
+                    validate=valid_section,
+                )
+        metadata = section.pop("metadata", {})
+        section = await cls._build_section(section, markdown_chunk, medias, image_dir)
+        return metadata, section
+
+    @classmethod
+    async def _map_reduce_section(
+        cls,
+        extractor: Agent,
+        parts: list[str],
+        limiter: Optional[asyncio.Semaphore] = None,
+    ) -> dict:
+        """
+        Extract the parts of an oversized chunk in parallel and merge them into one section.
+
+        The slot of `limiter` held by the chunk is handed over to its parts, each part takes a slot of its own, see `hand_over`.
+        The blocks are concatenated in order, and a short request over the part titles and summaries writes those of the section,
+        answered by the cheaper model of the extractor cascade if there is one, as it only merges short texts.
+        """
+
+        with span("map_extraction", sections=len(parts)):
+            async with hand_over(limiter):
+                responses = await asyncio.gather(
+                    *(
+                        take_slot(
+                            limiter,
+                            extractor(
+                                markdown_document=part,
+                                response_format=Section.json_schema(),
+                                validate=valid_section,
+                            ),
+                        )
+                        for part in parts
+                    )
+                )
+        extracted = [response for _, response in responses]
+        metadata = {}
+        for part in extracted:
+            for key, value in part.pop("metadata", {}).items():
+                metadata.setdefault(key, value)
+        with span("reduce_section"):
+            prompt = SECTION_REDUCE_PROMPT.render(parts=extracted)
+            reduced = None
+            for route in extractor.routes:
+                try:
+                    reduced = await route.llm(prompt, return_json=True, retry=False)
+                    break
+                except Exception as e:
+                    logger.warning(
+                        "route %s failed to reduce a section: %s", route.name, e
+                    )
+            if not isinstance(reduced, dict):
+                reduced = await extractor.llm(prompt, return_json=True)
+        return {
+            "metadata": metadata,
+            "title": reduced.get("title", extracted[0]["title"]),
+            "summary": reduced.get(
+                "summary", " ".join(part["summary"] for part in extracted)
+            ),
+            "blocks": [block for part in extracted for block in part["blocks"]],
+        }
+
+    @classmethod
+    async def _extract_sections(
+        cls,
+        extractor: Agent,
+        multi_extractor: Agent,
+        markdown_chunks: list[str],
+        image_dir: str,
+        map_tokens: Optional[int] = None,
+        limiter: Optional[asyncio.Semaphore] = None,
+    ) -> list[tuple[dict, Section]]:
+        """
+        Extract several small chunks with one request, falling back to a request per chunk if the response does not match them.
+
+        `limiter` is the semaphore whose slot the caller holds, handed over to the parts of oversized chunks.
+        """
+        if len(markdown_chunks) == 1:
+            return [
+                await cls._extract_section(
+                    extractor, markdown_chunks[0], image_dir, map_tokens, limiter
+                )
+            ]
+        with span("process_markdown", "cpu"):
+            medias = await asyncio.gather(
+                *(run_cpu(process_markdown_content, chunk) for chunk in markdown_chunks)
+            )
+        with span("extraction", sections=len(markdown_chunks)):
+            _, response = await multi_extractor(
+                markdown_documents=markdown_chunks,
+                response_format=Section.multi_json_schema(),
+                validate=lambda response: len(response.get("sections", []))
+                == len(markdown_chunks)
+                and all(valid_section(section) for section in response["sections"]),
+            )
+        sections = response.get("sections", [])
+        if len(sections) != len(markdown_chunks):
+            logger.warning(
+                "expected %d sections from the multi-section extractor, got %d, extracting them one by one",
+                len(markdown_chunks),
+                len(sections),
+            )
+            async with hand_over(limiter):
+                return await asyncio.gather(
+                    *(
+                        take_slot(
+                            limiter,
+                            cls._extract_section(
+                                extractor, chunk, image_dir, map_tokens, limiter
+                            ),
+                        )
+                        for chunk in markdown_chunks
+                    )
+                )
+        sections = await asyncio.gather(
+            *(
+                cls._build_section(section, chunk, chunk_medias, image_dir)
+                for section, chunk, chunk_medias in zip(
+                    sections, markdown_chunks, medias
+                )
+            )
+        )
+        # The metadata is shared by the pack, attach it once so that merging does not see duplicates
+        metadata = response.get("metadata", {})
+        return [(metadata if i == 0 else {}, s) for i, s in enumerate(sections)]
+
+    @classmethod
+    async def _build_section(
+        cls,
+        section: dict,
+        markdown_chunk: str,
+        medias: list[dict],
+        image_dir: str,
+    ) -> Section:
+        with span("link_medias", "cpu"):
+            section = await run_cpu(build_section, section, markdown_chunk, medias)
+        # Parsing mutates the medias and renders tables with Chromium, so it stays in threads
+        await asyncio.gather(
+            *(cls._parse_media(media, image_dir) for media in section.iter_medias())
+        )
+        return section
+
+    @classmethod
+    async def _parse_media(cls, media: Media, image_dir: str):
+        if not isinstance(media, Table):
+            await run_in_thread(media.parse, image_dir)
+            return
+        # Every rendering starts a Chromium, bound them apart from the thread pool
+        async with contextlib.AsyncExitStack() as stack:
+            with span("wait_render", "queue"):
+                await stack.enter_async_context(EXECUTORS.render_limiter)
+            await run_in_thread(media.parse, image_dir)
+
+    @classmethod
+    async def _caption_medias(
+        cls,
+        section: Section,
         language_model: AsyncLLM,
         vision_model: AsyncLLM,
-        limiter: contextlib.AsyncExitStack,
+        checkpoint: Optional[Checkpoint] = None,
+        image_dedup: Optional[ImageDeduplicator] = None,
     ):
-        medias = process_markdown_content(
-            markdown_chunk,
+        """
+        Caption the medias of a section, tables with the language model and images with the vision model.
+        """
+
+        async def caption(media: Media) -> bool:
+            if media.caption is not None:
+                return False
+            if isinstance(media, Table):
+                await media.get_caption(language_model)
+            elif image_dedup is not None:
+                await image_dedup.get_caption(media, vision_model)
+            else:
+                await media.get_caption(vision_model)
+            return True
+
+        results = await asyncio.gather(
+            *(caption(media) for media in section.iter_medias()), return_exceptions=True
         )
-        async with limiter:
-            _, section = await extractor(
-                markdown_document=markdown_chunk, response_format=Section.json_schema()
+        # Saved once per section, keeping the captions finished before a failure
+        if checkpoint is not None and any(result is True for result in results):
+            await run_in_thread(checkpoint.save_captions, section)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    @classmethod
+    async def _merge_metadata(
+        cls,
+        metadata: list[dict],
+        language_model: AsyncLLM,
+        checkpoint: Optional[Checkpoint] = None,
+    ) -> dict[str, str]:
+        if checkpoint is not None and (merged := checkpoint.load("metadata")):
+            return merged
+        with span("merge_metadata"):
+            merged = await language_model(
+                MERGE_METADATA_PROMPT.render(metadata=metadata), return_json=True
             )
-            metadata = section.pop("metadata", {})
-            section = Section(**section, markdown_content=markdown_chunk)
-            link_medias(medias, section)
-            for media in section.iter_medias():
-                media.parse(image_dir)
-                if isinstance(media, Table):
-                    await media.get_caption(language_model)
-                else:
-                    await media.get_caption(vision_model)
-        return metadata, section
+        if checkpoint is not None:
+            await run_in_thread(checkpoint.save, "metadata", merged)
+        return merged
+
+    @classmethod
+    async def _summarize_sections(
+        cls,
+        sections: list[Section],
+        language_model: AsyncLLM,
+        checkpoint: Optional[Checkpoint] = None,
+    ):
+        """
+        Write the missing summaries of sections, `SUMMARY_BATCH_SIZE` sections per request.
+
+        Each section is shown by its subsection titles and the beginning of their content, a batch whose response
+        does not match it falls back to the leading sentences, see `lead_summary`.
+        """
+        saved = {}
+        if checkpoint is not None:
+            saved = checkpoint.load("summaries") or {}
+        for section in sections:
+            if not section.summary:
+                section.summary = saved.get(chunk_hash(section.markdown_content), "")
+        missing = [section for section in sections if not section.summary]
+
+        async def summarize(batch: list[Section]):
+            shown = []
+            for section in batch:
+                subsections = [
+                    block for block in section.blocks if isinstance(block, SubSection)
+                ]
+                chars = SUMMARY_SECTION_CHARS // max(1, len(subsections))
+                shown.append(
+                    {
+                        "title": section.title,
+                        "blocks": [
+                            {"title": block.title, "content": block.content[:chars]}
+                            for block in subsections
+                        ],
+                    }
+                )
+            response = {}
+            try:
+                response = await language_model(
+                    SECTION_SUMMARIES_PROMPT.render(sections=shown), return_json=True
+                )
+            except Exception as e:
+                logger.warning("failed to summarize %d sections: %s", len(batch), e)
+            summaries = (
+                response.get("summaries", []) if isinstance(response, dict) else []
+            )
+            if len(summaries) != len(batch):
+                summaries = [lead_summary(section) for section in batch]
+            for section, summary in zip(batch, summaries):
+                section.summary = str(summary) or lead_summary(section)
+
+        with span("summarize_sections", sections=len(missing)):
+            await asyncio.gather(
+                *(
+                    summarize(missing[i : i + SUMMARY_BATCH_SIZE])
+                    for i in range(0, len(missing), SUMMARY_BATCH_SIZE)
+                )
+            )
+        if checkpoint is not None and len(missing) != 0:
+            await run_in_thread(
+                checkpoint.save,
+                "summaries",
+                {
+                    chunk_hash(section.markdown_content): section.summary
+                    for section in sections
+                },
+            )
+
+    @classmethod
+    async def _parse_pack(
+        cls,
+        extractor: Agent,
+        multi_extractor: Agent,
+        markdown_chunks: list[str],
+        image_dir: str,
+        language_model: AsyncLLM,
+        vision_model: AsyncLLM,
+        limiter: contextlib.AsyncExitStack,
+        checkpoint: Optional[Checkpoint] = None,
+        image_dedup: Optional[ImageDeduplicator] = None,
+        map_tokens: Optional[int] = None,
+        rule_sections: Optional[list[Optional[dict]]] = None,
+    ) -> list[tuple[dict, Section]]:
+        """
+        Extract and caption a pack of adjacent chunks, see `pack_chunks`.
+
+        `rule_sections` is aligned with the chunks, a chunk with a section is built from it instead of being extracted, see `rule_extract_section`.
+        """
+        with span(
+            "parse_chunk",
+            chunk=chunk_hash(markdown_chunks[0]),
+            sections=len(markdown_chunks),
+        ):
+            async with contextlib.AsyncExitStack() as stack:
+                with span("wait_limiter", "queue"):
+                    await stack.enter_async_context(limiter)
+                # Kept by position, chunks with the same text still get their own sections
+                results = [None] * len(markdown_chunks)
+                if checkpoint is not None:
+                    for idx, chunk in enumerate(markdown_chunks):
+                        results[idx] = checkpoint.load_section(chunk)
+                for idx, chunk in enumerate(markdown_chunks):
+                    if results[idx] is not None or rule_sections is None:
+                        continue
+                    if rule_sections[idx] is None:
+                        continue
+                    medias = await run_cpu(process_markdown_content, chunk)
+                    section = await cls._build_section(
+                        rule_sections[idx], chunk, medias, image_dir
+                    )
+                    results[idx] = ({}, section)
+                    if checkpoint is not None:
+                        await run_in_thread(checkpoint.save_section, {}, section)
+                missing = [idx for idx, result in enumerate(results) if result is None]
+                if len(missing) != 0:
+                    extracted = await cls._extract_sections(
+                        extractor,
+                        multi_extractor,
+                        [markdown_chunks[idx] for idx in missing],
+                        image_dir,
+                        map_tokens,
+                        limiter if isinstance(limiter, asyncio.Semaphore) else None,
+                    )
+                    for idx, (metadata, section) in zip(missing, extracted):
+                        results[idx] = (metadata, section)
+                        if checkpoint is not None:
+                            await run_in_thread(
+                                checkpoint.save_section, metadata, section
+                            )
+                await asyncio.gather(
+                    *(
+                        cls._caption_medias(
+                            section,
+                            language_model,
+                            vision_model,
+                            checkpoint,
+                            image_dedup,
+                        )
+                        for _, section in results
+                    )
+                )
+        return results
 
     @classmethod
     async def from_markdown(
@@ -97,58 +575,177 @@ class Document:
         vision_model: AsyncLLM,
         image_dir: str,
         max_at_once: Optional[int] = None,
+        checkpoint_dir: Optional[str] = None,
+        image_dedup: Union[bool, ImageDeduplicator] = False,
+        pack_tokens: Optional[int] = None,
+        map_tokens: Optional[int] = None,
+        fast_model: Optional[AsyncLLM] = None,
+        rule_criteria: Optional[RuleCriteria] = None,
+        speculative: bool = False,
     ):
-        doc_extractor = Agent(
-            "doc_extractor",
-            llm_mapping={"language": language_model, "vision": vision_model},
-        )
-        document_tree = get_tree_structure(markdown_content)
-        headings = re.findall(r"^#+\s+.*", markdown_content, re.MULTILINE)
-        adjusted_headings = await language_model(
-            HEADING_EXTRACT_PROMPT.render(tree=document_tree),
-            return_json=True,
-            response_format=LogicHeadings.get_literal_schema(headings),
-        )
-        metadata = []
-        sections = []
-        tasks = []
-
-        limiter = (
-            asyncio.Semaphore(max_at_once)
-            if max_at_once is not None
-            else contextlib.AsyncExitStack()
-        )
-        async with asyncio.TaskGroup() as tg:
-            for chunk in split_markdown_by_headings(
-                markdown_content, headings, adjusted_headings["headings"]
-            ):
-                tasks.append(
-                    tg.create_task(
-                        cls._parse_chunk(
+        """
+        Parse a markdown document into sections with LLMs.
+
+        Args:
+            markdown_content (str): The markdown document.
+            language_model (AsyncLLM): The model for headings, sections, table captions and metadata.
+            vision_model (AsyncLLM): The model for image captions.
+            image_dir (str): The directory of the images referenced in the markdown.
+            max_at_once (Optional[int]): The maximum number of chunks processed concurrently.
+            checkpoint_dir (Optional[str]): Persist completed stages here and resume from them on rerun.
+            image_dedup (Union[bool, ImageDeduplicator]): Caption near-duplicate images once, pass a shared ImageDeduplicator to deduplicate across documents.
+                Off by default, similar but distinct images may share a caption.
+            pack_tokens (Optional[int]): Extract adjacent small chunks together in requests of up to this many tokens, None for one request per chunk.
+            map_tokens (Optional[int]): Split chunks exceeding this many tokens into parts extracted in parallel and merged, None to extract every chunk whole.
+            fast_model (Optional[AsyncLLM]): A cheaper model trying the section extraction first, escalated to `language_model` by the `cascade` of the extractor roles.
+            rule_criteria (Optional[RuleCriteria]): Build the sections of chunks meeting these criteria from their headings without an extraction request,
+                and summarize them in batched requests to `fast_model` or `language_model`. The first chunk is always extracted for the metadata.
+            speculative (bool): Start parsing the chunks of the guessed top-level headings while the headings are extracted, see `speculative_split`.
+                Chunks whose boundaries match the extracted headings are kept, the others are parsed again.
+        """
+        if image_dedup is True:
+            image_dedup = ImageDeduplicator()
+        elif image_dedup is False:
+            image_dedup = None
+        checkpoint = None
+        if checkpoint_dir is not None:
+            checkpoint = Checkpoint(checkpoint_dir, markdown_content)
+        with (
+            track_usage() as usage,
+            span("from_markdown", document=chunk_hash(markdown_content)),
+        ):
+            llm_mapping = {"language": language_model, "vision": vision_model}
+            if fast_model is not None:
+                llm_mapping["fast"] = fast_model
+            doc_extractor = Agent("doc_extractor", llm_mapping=llm_mapping)
+            multi_extractor = Agent("doc_extractor_multi", llm_mapping=llm_mapping)
+            limiter = (
+                asyncio.Semaphore(max_at_once)
+                if max_at_once is not None
+                else contextlib.AsyncExitStack()
+            )
+
+            async def launch(
+                tg: asyncio.TaskGroup, chunks: list[str], indices: list[int]
+            ) -> list[tuple[list[int], list[Optional[dict]], asyncio.Task]]:
+                """
+                Start parsing the chunks at `indices` in packs, returned with the positions and rule-built sections of their chunks.
+
+                The first chunk of the document is always extracted for the metadata.
+                """
+                selected = [chunks[idx] for idx in indices]
+                if pack_tokens is not None:
+                    with span("pack_chunks", "cpu"):
+                        packed = await run_cpu(pack_chunks, selected, pack_tokens)
+                else:
+                    packed = [[chunk] for chunk in selected]
+                positions = iter(indices)
+                packs = [[next(positions) for _ in pack] for pack in packed]
+                rules = {}
+                if rule_criteria is not None:
+                    candidates = [idx for idx in indices if idx != 0]
+                    with span("rule_extraction", "cpu"):
+                        extracted = await asyncio.gather(
+                            *(
+                                run_cpu(
+                                    rule_extract_section, chunks[idx], rule_criteria
+                                )
+                                for idx in candidates
+                            )
+                        )
+                    rules = dict(zip(candidates, extracted))
+                launched = []
+                for pack in packs:
+                    pack_rules = [rules.get(idx) for idx in pack]
+                    task = tg.create_task(
+                        cls._parse_pack(
                             doc_extractor,
-                            chunk,
+                            multi_extractor,
+                            [chunks[idx] for idx in pack],
                             image_dir,
                             language_model,
                             vision_model,
                             limiter,
+                            checkpoint,
+                            image_dedup,
+                            map_tokens,
+                            pack_rules,
                         )
                     )
-                )
+                    launched.append((pack, pack_rules, task))
+                return launched
 
-        # Process results in order
-        for task in tasks:
-            meta, section = task.result()
-            metadata.append(meta)
-            sections.append(section)
+            speculate = speculative and (
+                checkpoint is None or checkpoint.load("headings") is None
+            )
+            async with asyncio.TaskGroup() as tg:
+                speculated, guessed = [], []
+                if speculate:
+                    heading_task = tg.create_task(
+                        cls._split_chunks(markdown_content, language_model, checkpoint)
+                    )
+                    with span("speculative_split", "cpu"):
+                        guessed = await run_cpu(speculative_split, markdown_content)
+                    speculated = await launch(tg, guessed, list(range(len(guessed))))
+                    chunks = await heading_task
+                else:
+                    chunks = await cls._split_chunks(
+                        markdown_content, language_model, checkpoint
+                    )
+                # Keep the speculative packs with a chunk whose boundaries were confirmed, re-issue the other chunks.
+                # A guessed chunk matches the final chunk with the same text and the same number of earlier repeats
+                final = {key: idx for idx, key in enumerate(occurrence_keys(chunks))}
+                guessed_keys = occurrence_keys(guessed)
+                tasks = []
+                for pack, pack_rules, task in speculated:
+                    positions = [final.get(guessed_keys[idx]) for idx in pack]
+                    if any(pos is not None for pos in positions):
+                        tasks.append((positions, pack_rules, task))
+                    else:
+                        task.cancel()
+                reused = {pos for positions, _, _ in tasks for pos in positions}
+                reissued = [idx for idx in range(len(chunks)) if idx not in reused]
+                if speculate:
+                    instant(
+                        "speculation",
+                        reused=len(chunks) - len(reissued),
+                        reissued=len(reissued),
+                    )
+                tasks += await launch(tg, chunks, reissued)
 
-        merged_metadata = await language_model(
-            MERGE_METADATA_PROMPT.render(metadata=metadata), return_json=True
-        )
+            # Process results in order
+            results = [None] * len(chunks)
+            rule_built = [False] * len(chunks)
+            for positions, pack_rules, task in tasks:
+                for pos, rule, result in zip(positions, pack_rules, task.result()):
+                    if pos is not None:
+                        results[pos] = result
+                        rule_built[pos] = rule is not None
+            metadata = [result[0] for result in results]
+            sections = [result[1] for result in results]
+            # Cached by chunk hash, a fastText prediction is only made for new chunks, in a single batch
+            with span("language_id", "cpu"):
+                language, chunk_languages = await run_in_thread(
+                    detect_languages, chunks
+                )
+            for section, chunk_language in zip(sections, chunk_languages):
+                section.language = chunk_language
+            if any(rule_built):
+                await cls._summarize_sections(
+                    [s for s, built in zip(sections, rule_built) if built],
+                    fast_model or language_model,
+                    checkpoint,
+                )
+
+            merged_metadata = await cls._merge_metadata(
+                metadata, language_model, checkpoint
+            )
         return Document(
             image_dir=image_dir,
             metadata=merged_metadata,
             blocks=sections,
-            language=Language.CJK,
+            language=language,
+            usage=usage,
         )
 
     def __contains__(self, key: str):
@@ -179,24 +776,81 @@ class Document:
                 subsecs.append(section[subsec_key])
         return subsecs
 
+    def build_search_index(self) -> BM25Index:
+        """
+        Build the full-text index of the section titles and summaries, subsections and media captions.
+
+        The index is kept by the document, and saved and loaded alongside it.
+        """
+        self._search_index = BM25Index.from_document(self)
+        return self._search_index
+
+    def full_text_search(
+        self, query: str, k: int = 10
+    ) -> list[tuple[Union[Section, SubSection, Media], float]]:
+        """
+        Get the top-k sections, subsections or medias for a query ranked by BM25, the index is built on first use.
+        """
+        if self._search_index is None:
+            self.build_search_index()
+        return [
+            (self.get_block(hit), hit.score)
+            for hit in self._search_index.search(query, k)
+        ]
+
+    async def build_embedding_index(
+        self, text_model: AsyncLLM, batch_size: int = 32
+    ) -> EmbeddingIndex:
+        """
+        Embed every subsection and media caption in batched requests, see `EmbeddingIndex.build`.
+
+        The index is kept by the document, and saved and loaded alongside it.
+        """
+        self._embedding_index = await EmbeddingIndex.build(self, text_model, batch_size)
+        return self._embedding_index
+
+    async def search(
+        self, query: str, k: int = 10, text_model: Optional[AsyncLLM] = None
+    ) -> list[tuple[Union[SubSection, Media], float]]:
+        """
+        Get the top-k subsections or medias by embedding similarity to the query.
+
+        Args:
+            query (str): The query.
+            k (int): The number of blocks to return.
+            text_model (Optional[AsyncLLM]): The model embedding the query, defaults to the one that built the index.
+        """
+        assert (
+            self._embedding_index is not None
+        ), "call build_embedding_index first, or load a document saved with its embeddings"
+        hits = await self._embedding_index.search(query, k, text_model)
+        return [(self.get_block(hit), hit.score) for hit in hits]
+
+    def get_block(self, hit: SearchHit) -> Union[Section, SubSection, Media]:
+        section = self.blocks[hit.section]
+        if hit.block is None:
+            return section
+        return section.blocks[hit.block]
+
     def find_caption(self, caption: str):
         for media in self.iter_medias():
             if media.caption == caption:
                 return media.path
         raise ValueError(f"Image caption not found: {caption}")
 
-    def get_overview(self, include_summary: bool = False):
-        overview = ""
-        for section in self.blocks:
-            overview += f"Section: {section.title}\n"
-            if include_summary:
-                overview += f"\tSummary: {section.summary}\n"
-            for subsection in section.subsections:
-                overview += f"\tSubsection: {subsection.title}\n"
-                for media in subsection.medias:
-                    overview += f"\t\tMedia: {media.caption}\n"
-                overview += "\n"
-        return overview
+    def get_overview(self, include_summary: bool = False) -> str:
+        """
+        Render the titles, captions and optionally the summaries of the document.
+
+        Rendered in one walk of the blocks on every call, so it always reflects the current blocks.
+        """
+        return "".join(iter_overview(self.blocks, include_summary))
+
+    def export(self, target: Union[str, TextIO], format: Optional[str] = None):
+        """
+        Stream the document to a file as markdown, JSONL (one block per line) or HTML, see `strucdoc.export.export`.
+        """
+        export(self, target, format)
 
     @property
     def metainfo(self):
@@ -206,6 +860,58 @@ class Document:
     def dict(self):
         return {
             "metadata": self.metadata,
-            "blocks": [section.model_dump(mode="json") for section in self.blocks],
+            "blocks": [
+                section.model_dump(mode="json", serialize_as_any=True)
+                for section in self.blocks
+            ],
             "language": self.language.value,
         }
+
+    def save(self, path: str):
+        """
+        Save the document as JSON, the file is replaced atomically so a partial write is never left behind.
+
+        Built search and embedding indexes are saved alongside, see `search_index_path` and `embedding_index_path`.
+        """
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.dict, f, indent=2, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+        if self._search_index is not None:
+            self._search_index.save(search_index_path(path))
+        if self._embedding_index is not None:
+            self._embedding_index.save(embedding_index_path(path))
+
+    @classmethod
+    def from_dict(cls, data: dict, image_dir: str) -> "Document":
+        return cls(
+            image_dir=image_dir,
+            blocks=[Section.from_dict(section) for section in data["blocks"]],
+            metadata=data["metadata"],
+            language=Language(data["language"]),
+        )
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        image_dir: Optional[str] = None,
+        text_model: Optional[AsyncLLM] = None,
+    ) -> "Document":
+        """
+        Load a document saved by `save`.
+
+        Args:
+            path (str): The path of the JSON file.
+            image_dir (Optional[str]): The image directory, defaults to the directory of the file.
+            text_model (Optional[AsyncLLM]): The model embedding the queries of `search`, if the embeddings were saved.
+        """
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        document = cls.from_dict(data, image_dir or pdirname(path) or ".")
+        if pexists(search_index_path(path)):
+            document._search_index = BM25Index.load(search_index_path(path))
+        if pexists(embedding_index_path(path)):
+            document._embedding_index = EmbeddingIndex.load(
+                embedding_index_path(path), text_model
+            )
+        return document
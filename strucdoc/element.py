@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 import re
 from typing import Optional
@@ -5,16 +6,20 @@ from typing import Optional
 from jinja2 import Environment, StrictUndefined
 from mistune import html as markdown
 from PIL import Image
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, PrivateAttr, field_validator
 
 from .doc_utils import parse_table_with_merges
+from .executors import run_in_thread
+from .image_hash import PerceptualIndex, image_hash
 from .llms import AsyncLLM
+from .tracing import span
 from .utils import (
+    Language,
     edit_distance,
     get_logger,
+    image_index,
     markdown_table_to_image,
     package_join,
-    pexists,
     pjoin,
 )
 
@@ -36,35 +41,67 @@ class Media(BaseModel):
     near_chunks: tuple[str, str]
     path: Optional[str] = None
     caption: Optional[str] = None
+    # (path, size, format) of the image, read once per path
+    _image_info: Optional[tuple[str, tuple[int, int], Optional[str]]] = PrivateAttr(
+        default=None
+    )
+    # (path, (dHash, pHash)) of the image
+    _image_hash: Optional[tuple[str, tuple[int, int]]] = PrivateAttr(default=None)
+
+    def _load_image_info(self) -> tuple[str, tuple[int, int], Optional[str]]:
+        assert self.path is not None, "Path is required to get image info"
+        if self._image_info is None or self._image_info[0] != self.path:
+            with Image.open(self.path) as image:
+                self._image_info = (self.path, image.size, image.format)
+        return self._image_info
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self._load_image_info()[1]
 
     @property
-    def size(self):
-        assert self.path is not None, "Path is required to get size"
-        return Image.open(self.path).size
+    def format(self) -> Optional[str]:
+        return self._load_image_info()[2]
+
+    @property
+    def image_hash(self) -> tuple[int, int]:
+        """
+        The perceptual hashes (dHash, pHash) of the image, computed once per path.
+        """
+        assert self.path is not None, "Path is required to get image hash"
+        if self._image_hash is None or self._image_hash[0] != self.path:
+            self._image_hash = (self.path, image_hash(self.path))
+        return self._image_hash[1]
 
     def parse(self, image_dir: str):
         """
         Parse the markdown content to extract image path and alt text.
         Format expected: ![alt text](image.png)
         """
-        match = IMAGE_PARSING_REGEX.search(self.markdown_content)
-        if match is None:
-            raise ValueError("No image found in the markdown content")
-        image_path = match.group(1)
-        if not pexists(image_path):
-            image_path = pjoin(image_dir, image_path)
-        assert pexists(image_path), f"image file not found: {image_path}"
-        self.path = image_path
+        with span("media_parse", "cpu"):
+            match = IMAGE_PARSING_REGEX.search(self.markdown_content)
+            if match is None:
+                raise ValueError("No image found in the markdown content")
+            image_path = match.group(1)
+            indexed_path = image_index(image_dir).resolve(image_path)
+            if indexed_path is None:
+                # The image may have been added after the directory was indexed
+                indexed_path = image_index(image_dir, revalidate=True).resolve(
+                    image_path
+                )
+            assert indexed_path is not None, f"image file not found: {image_path}"
+            self.path = indexed_path
 
     async def get_caption(self, vision_model: AsyncLLM):
         assert self.path is not None, "Path is required to get caption"
         if self.caption is None:
-            self.caption = await vision_model(
-                IMAGE_CAPTION_PROMPT.render(
-                    markdown_caption=self.near_chunks,
-                ),
-                self.path,
-            )
+            with span("caption", media=self.path):
+                self.caption = await vision_model(
+                    IMAGE_CAPTION_PROMPT.render(
+                        markdown_caption=self.near_chunks,
+                    ),
+                    self.path,
+                )
             logger.debug(f"Caption: {self.caption}")
 
 
@@ -73,29 +110,76 @@ class Table(Media):
     merge_area: Optional[list[tuple[int, int, int, int]]] = None
 
     def parse(self, image_dir: str):
-        html = markdown(self.markdown_content)
-        cells, merges = parse_table_with_merges(html)
-        self.cells = cells
-        self.merge_area = merges
+        with span("table_parse", "cpu"):
+            html = markdown(self.markdown_content)
+            cells, merges = parse_table_with_merges(html)
+            self.cells = cells
+            self.merge_area = merges
 
         if self.path is None:
             self.path = pjoin(
                 image_dir,
                 f"table_{hashlib.md5(str(self.cells).encode()).hexdigest()[:4]}.png",
             )
-        markdown_table_to_image(self.markdown_content, self.path)
+        with span("table_render", "cpu", media=self.path):
+            markdown_table_to_image(self.markdown_content, self.path)
+        image_index(image_dir).add(self.path)
 
     async def get_caption(self, language_model: AsyncLLM):
         if self.caption is None:
-            self.caption = await language_model(
-                TABLE_CAPTION_PROMPT.render(
-                    markdown_content=self.markdown_content,
-                    markdown_caption=self.near_chunks,
+            with span("caption", media=self.path):
+                self.caption = await language_model(
+                    TABLE_CAPTION_PROMPT.render(
+                        markdown_content=self.markdown_content,
+                        markdown_caption=self.near_chunks,
+                    )
                 )
-            )
             logger.debug(f"Caption: {self.caption}")
 
 
+class ImageDeduplicator:
+    """
+    Caption one representative of each group of near-duplicate images and fan its caption out to the others.
+
+    Share one instance between documents to deduplicate images across a corpus. Similar but distinct
+    images, such as two plots of the same layout, may share a caption, so deduplication is opt-in.
+    """
+
+    def __init__(self, index: Optional[PerceptualIndex] = None):
+        self.index = index or PerceptualIndex()
+        self.captions: dict[int, str] = {}
+        self.deduplicated = 0
+        self._pending: dict[int, asyncio.Task] = {}
+
+    async def get_caption(self, media: Media, vision_model: AsyncLLM):
+        if media.caption is not None:
+            return
+        # Hashed only when deduplicating, off the event loop
+        with span("image_hash", "cpu"):
+            hashes = await run_in_thread(lambda: media.image_hash)
+        group = self.index.group(hashes)
+        if group in self.captions:
+            self.deduplicated += 1
+            media.caption = self.captions[group]
+            return
+        pending = self._pending.get(group)
+        if pending is not None:
+            self.deduplicated += 1
+            media.caption = await asyncio.shield(pending)
+            return
+        pending = asyncio.ensure_future(self._caption(media, vision_model))
+        self._pending[group] = pending
+        try:
+            self.captions[group] = await asyncio.shield(pending)
+        finally:
+            self._pending.pop(group, None)
+
+    @staticmethod
+    async def _caption(media: Media, vision_model: AsyncLLM) -> str:
+        await media.get_caption(vision_model)
+        return media.caption
+
+
 class SubSection(BaseModel):
     title: str
     content: str
@@ -106,6 +190,7 @@ class Section(BaseModel):
     summary: str
     blocks: list[SubSection | Media]
     markdown_content: Optional[str] = None
+    language: Optional[Language] = None
 
     @field_validator("blocks")
     def validate_blocks_not_empty(cls, v):
@@ -118,6 +203,21 @@ class Section(BaseModel):
             if isinstance(block, Media):
                 yield block
 
+    @classmethod
+    def from_dict(cls, data: dict) -> "Section":
+        """
+        Rebuild a section from its `model_dump`, restoring the Table and Media blocks.
+        """
+        blocks = []
+        for block in data["blocks"]:
+            if "cells" in block:
+                blocks.append(Table(**block))
+            elif "markdown_content" in block:
+                blocks.append(Media(**block))
+            else:
+                blocks.append(SubSection(**block))
+        return cls(**{**data, "blocks": blocks})
+
     @classmethod
     def json_schema(cls):
         pydantic_schema = cls.model_json_schema()
@@ -131,11 +231,45 @@ class Section(BaseModel):
             "type": "object",
         }
 
-        # Remove markdown_content from schema
+        # Remove markdown_content and the detected language from schema
         del pydantic_schema["$defs"]["Media"]
+        del pydantic_schema["$defs"]["Language"]
         del pydantic_schema["properties"]["markdown_content"]
+        del pydantic_schema["properties"]["language"]
         return pydantic_schema
 
+    @classmethod
+    def multi_json_schema(cls):
+        """
+        The response format of the multi-section extractor: shared metadata and one section per input chunk.
+        """
+        section_schema = cls.json_schema()
+        metadata_schema = section_schema["properties"].pop("metadata")
+        defs = section_schema.pop("$defs")
+        return {
+            "$defs": {**defs, "Section": section_schema},
+            "properties": {
+                "metadata": metadata_schema,
+                "sections": {
+                    "items": {"$ref": "#/$defs/Section"},
+                    "title": "Sections",
+                    "type": "array",
+                },
+            },
+            "required": ["metadata", "sections"],
+            "title": "Sections",
+            "type": "object",
+        }
+
+
+def build_section(section: dict, markdown_chunk: str, medias: list[dict]) -> Section:
+    """
+    Build a section from the extracted JSON and link its medias, a pure function so it can run in an executor.
+    """
+    section = Section(**section, markdown_content=markdown_chunk)
+    link_medias(medias, section)
+    return section
+
 
 def link_medias(
     medias: list[dict],
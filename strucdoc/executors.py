@@ -0,0 +1,197 @@
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import threading
+import time
+import weakref
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, TypeVar
+
+from .tracing import instant, percentile
+
+T = TypeVar("T")
+
+
+@dataclass
+class ExecutorOptions:
+    """
+    Sizes of the pools used to keep blocking work off the event loop.
+
+    Args:
+        thread_workers (Optional[int]): Threads for blocking I/O and work mutating shared objects, None for the default of ThreadPoolExecutor.
+        process_workers (int): Processes for pure CPU-bound functions, 0 runs them in the thread pool instead.
+        render_workers (int): Tables rendered at once, each rendering starts a headless Chromium.
+    """
+
+    thread_workers: Optional[int] = None
+    process_workers: int = 0
+    render_workers: int = 2
+
+
+class Executors:
+    """
+    Lazily created thread and process pools shared by the whole process.
+    """
+
+    def __init__(self, options: Optional[ExecutorOptions] = None):
+        self.options = options or ExecutorOptions()
+        self._lock = threading.Lock()
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        # Semaphores are bound to the loop they are used in, one per running loop
+        self._render_limiters: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+
+    def configure(self, **options):
+        """
+        Update the pool sizes, the running pools are shut down and recreated on next use.
+        """
+        with self._lock:
+            for key, value in options.items():
+                assert hasattr(self.options, key), f"Unknown executor option: {key}"
+                setattr(self.options, key, value)
+            self._shutdown()
+
+    def shutdown(self):
+        with self._lock:
+            self._shutdown()
+
+    def _shutdown(self):
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+        self._thread_pool = self._process_pool = None
+        self._render_limiters.clear()
+
+    @property
+    def thread_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(
+                    self.options.thread_workers, thread_name_prefix="strucdoc"
+                )
+            return self._thread_pool
+
+    @property
+    def cpu_pool(self) -> Executor:
+        """
+        The process pool if enabled, otherwise the thread pool.
+        """
+        if self.options.process_workers <= 0:
+            return self.thread_pool
+        with self._lock:
+            if self._process_pool is None:
+                # spawn instead of fork, the parent already runs threads of the thread pool and the HTTP clients
+                self._process_pool = ProcessPoolExecutor(
+                    self.options.process_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._process_pool
+
+    @property
+    def render_limiter(self) -> asyncio.Semaphore:
+        """
+        The semaphore bounding the table renderings of the running loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._render_limiters:
+                self._render_limiters[loop] = asyncio.Semaphore(
+                    self.options.render_workers
+                )
+            return self._render_limiters[loop]
+
+
+EXECUTORS = Executors()
+
+
+def configure_executors(**options):
+    """
+    Configure the pools used for blocking work.
+
+    Args:
+        thread_workers (Optional[int]): The number of threads.
+        process_workers (int): The number of processes for CPU-bound work, 0 to use threads.
+        render_workers (int): The number of tables rendered at once.
+    """
+    EXECUTORS.configure(**options)
+
+
+async def run_in_thread(func: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run a blocking function in the shared thread pool, the tracing and usage context is preserved.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        EXECUTORS.thread_pool, functools.partial(context.run, func, *args, **kwargs)
+    )
+
+
+async def run_cpu(func: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run a CPU-bound function in the process pool if enabled, otherwise in the thread pool.
+
+    The function, its arguments and result must be picklable, and it must not rely on mutating its arguments.
+    """
+    executor = EXECUTORS.cpu_pool
+    if isinstance(executor, ThreadPoolExecutor):
+        return await run_in_thread(func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+class LoopLagMonitor:
+    """
+    Measure how late the event loop wakes up a periodic timer, a responsive loop has a lag close to zero.
+
+    Lags above `threshold` are also recorded as `loop_lag` events of the active tracer.
+
+    Example:
+        async with LoopLagMonitor() as monitor:
+            document = await Document.from_markdown(...)
+        print(monitor.summary())
+    """
+
+    def __init__(self, interval: float = 0.01, threshold: float = 0.1):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags: list[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.lags.append(lag)
+            if lag > self.threshold:
+                instant("loop_lag", "cpu", lag=lag)
+
+    async def __aenter__(self) -> "LoopLagMonitor":
+        self._task = asyncio.create_task(self._run(), name="loop-lag-monitor")
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def summary(self) -> dict[str, Any]:
+        """
+        Get the lag statistics in milliseconds.
+        """
+        lags = sorted(self.lags)
+        return {
+            "samples": len(lags),
+            "mean": sum(lags) / len(lags) * 1000 if lags else 0.0,
+            "p50": percentile(lags, 50) * 1000,
+            "p99": percentile(lags, 99) * 1000,
+            "max": lags[-1] * 1000 if lags else 0.0,
+        }
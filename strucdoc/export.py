@@ -0,0 +1,156 @@
+"""
+Streaming writers of documents, every block is written to the file as soon as it is rendered.
+"""
+
+import json
+from html import escape
+from typing import TYPE_CHECKING, Iterator, Optional, TextIO, Union
+
+from mistune import html as markdown
+
+from .element import Media, Section, SubSection, Table
+
+if TYPE_CHECKING:
+    from .document import Document
+
+
+def iter_overview(
+    sections: list[Section], include_summary: bool = False
+) -> Iterator[str]:
+    """
+    Iterate the lines of the overview: section titles, optionally their summaries, subsection titles and media captions.
+
+    Medias are nested under the subsection they follow.
+    """
+    for section in sections:
+        yield f"Section: {section.title}\n"
+        if include_summary:
+            yield f"\tSummary: {section.summary}\n"
+        indent = "\t"
+        for block in section.blocks:
+            if isinstance(block, SubSection):
+                yield f"\tSubsection: {block.title}\n"
+                indent = "\t\t"
+            elif isinstance(block, Media):
+                yield f"{indent}Media: {block.caption}\n"
+        yield "\n"
+
+
+def write_markdown(document: "Document", f: TextIO):
+    if "title" in document.metadata:
+        f.write(f"# {document.metadata['title']}\n\n")
+    for section in document.blocks:
+        f.write(f"## {section.title}\n\n")
+        if section.summary:
+            f.write(f"> {section.summary}\n\n")
+        for block in section.blocks:
+            if isinstance(block, SubSection):
+                f.write(f"### {block.title}\n\n{block.content}\n\n")
+            elif isinstance(block, Table):
+                f.write(f"{block.markdown_content}\n\n")
+                if block.caption:
+                    f.write(f"*{block.caption}*\n\n")
+            elif isinstance(block, Media):
+                f.write(f"![{block.caption or ''}]({block.path})\n\n")
+
+
+def write_jsonl(document: "Document", f: TextIO):
+    """
+    Write one JSON record per line: the metadata, then every section followed by its blocks.
+    """
+
+    def write(record: dict):
+        f.write(json.dumps(record, ensure_ascii=False))
+        f.write("\n")
+
+    write(
+        {
+            "type": "metadata",
+            "metadata": document.metadata,
+            "language": document.language.value,
+        }
+    )
+    for i, section in enumerate(document.blocks):
+        write(
+            {
+                "type": "section",
+                "section": i,
+                **section.model_dump(
+                    mode="json", exclude={"blocks", "markdown_content"}
+                ),
+            }
+        )
+        for j, block in enumerate(section.blocks):
+            if isinstance(block, Table):
+                block_type = "table"
+            elif isinstance(block, Media):
+                block_type = "media"
+            else:
+                block_type = "subsection"
+            write(
+                {
+                    "type": block_type,
+                    "section": i,
+                    "block": j,
+                    **block.model_dump(mode="json"),
+                }
+            )
+
+
+def write_html(document: "Document", f: TextIO):
+    title = escape(str(document.metadata.get("title", "")))
+    f.write(
+        f'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{title}</title>\n</head>\n<body>\n'
+    )
+    if title:
+        f.write(f"<h1>{title}</h1>\n")
+    for section in document.blocks:
+        f.write(f"<section>\n<h2>{escape(section.title)}</h2>\n")
+        if section.summary:
+            f.write(f'<p class="summary">{escape(section.summary)}</p>\n')
+        for block in section.blocks:
+            if isinstance(block, SubSection):
+                f.write(f"<h3>{escape(block.title)}</h3>\n{markdown(block.content)}")
+            elif isinstance(block, Table):
+                f.write(f"<figure>\n{markdown(block.markdown_content)}")
+                if block.caption:
+                    f.write(f"<figcaption>{escape(block.caption)}</figcaption>\n")
+                f.write("</figure>\n")
+            elif isinstance(block, Media):
+                caption = escape(block.caption or "")
+                f.write(
+                    f'<figure>\n<img src="{escape(block.path or "")}" alt="{caption}">\n'
+                    f"<figcaption>{caption}</figcaption>\n</figure>\n"
+                )
+        f.write("</section>\n")
+    f.write("</body>\n</html>\n")
+
+
+EXPORTERS = {
+    "md": write_markdown,
+    "markdown": write_markdown,
+    "jsonl": write_jsonl,
+    "html": write_html,
+}
+
+
+def export(
+    document: "Document", target: Union[str, TextIO], format: Optional[str] = None
+):
+    """
+    Write a document as markdown, JSONL or HTML.
+
+    Args:
+        document (Document): The document to export.
+        target (Union[str, TextIO]): A path or an open text file.
+        format (Optional[str]): One of "md", "markdown", "jsonl" or "html", inferred from the extension of a path by default.
+    """
+    if format is None:
+        assert isinstance(target, str), "format is required when writing to a file"
+        format = target.rsplit(".", 1)[-1].lower()
+    assert format in EXPORTERS, f"unsupported export format: {format}"
+    if isinstance(target, str):
+        with open(target, "w", encoding="utf-8") as f:
+            EXPORTERS[format](document, f)
+    else:
+        EXPORTERS[format](document, target)
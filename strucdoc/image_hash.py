@@ -0,0 +1,128 @@
+import math
+from collections import defaultdict
+from functools import lru_cache
+
+import torch
+from PIL import Image
+
+HASH_SIZE = 8
+
+
+def grayscale(image: Image.Image, width: int, height: int) -> torch.Tensor:
+    """
+    Downscale an image to grayscale pixels of shape (height, width).
+    """
+    image = image.convert("L").resize((width, height), Image.Resampling.LANCZOS)
+    return (
+        torch.frombuffer(bytearray(image.tobytes()), dtype=torch.uint8)
+        .view(height, width)
+        .double()
+    )
+
+
+def dhash(image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """
+    Difference hash: whether each pixel of a downscaled grayscale image is brighter than its right neighbour.
+    """
+    pixels = grayscale(image, hash_size + 1, hash_size)
+    return bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+@lru_cache(maxsize=4)
+def dct_matrix(size: int) -> torch.Tensor:
+    """
+    The orthonormal DCT-II matrix, `D @ x @ D.T` is the 2D DCT of `x`.
+    """
+    k = torch.arange(size, dtype=torch.float64).unsqueeze(1)
+    n = torch.arange(size, dtype=torch.float64).unsqueeze(0)
+    matrix = torch.cos(math.pi * (2 * n + 1) * k / (2 * size)) * math.sqrt(2 / size)
+    matrix[0] /= math.sqrt(2)
+    return matrix
+
+
+def phash(
+    image: Image.Image, hash_size: int = HASH_SIZE, highfreq_factor: int = 4
+) -> int:
+    """
+    Perceptual hash: whether each low-frequency DCT coefficient of a downscaled grayscale image is above their median.
+    """
+    size = hash_size * highfreq_factor
+    pixels = grayscale(image, size, size)
+    matrix = dct_matrix(size)
+    low_freq = (matrix @ pixels @ matrix.T)[:hash_size, :hash_size]
+    return bits_to_int(low_freq > low_freq.median())
+
+
+def bits_to_int(bits: torch.Tensor) -> int:
+    value = 0
+    for bit in bits.flatten().tolist():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def image_hash(path: str) -> tuple[int, int]:
+    """
+    Get the (dHash, pHash) of an image.
+    """
+    with Image.open(path) as image:
+        return dhash(image), phash(image)
+
+
+class PerceptualIndex:
+    """
+    Group near-duplicate images, two images are near-duplicates if both their dHash and pHash
+    differ by at most `max_distance` bits from the first image of a group.
+
+    Share one index between documents to group images across a corpus. The dHash of the representatives
+    is split into `max_distance + 1` bands, a near-duplicate matches at least one band exactly, so only
+    the representatives sharing a band are compared instead of all of them.
+    """
+
+    def __init__(self, max_distance: int = 6, hash_bits: int = HASH_SIZE * HASH_SIZE):
+        self.max_distance = max_distance
+        self.representatives: list[tuple[int, int]] = []
+        self._groups: dict[tuple[int, int], int] = {}
+        bounds = [hash_bits * i // (max_distance + 1) for i in range(max_distance + 2)]
+        # (shift, mask) of every band
+        self._bands = [
+            (start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])
+        ]
+        self._buckets: dict[tuple[int, int], list[int]] = defaultdict(list)
+
+    def _band_keys(self, dhash_value: int) -> list[tuple[int, int]]:
+        return [
+            (band, (dhash_value >> shift) & mask)
+            for band, (shift, mask) in enumerate(self._bands)
+        ]
+
+    def group(self, hashes: tuple[int, int]) -> int:
+        """
+        Get the group of an image, a new group is created if no near-duplicate is indexed.
+        """
+        group = self._groups.get(hashes)
+        if group is not None:
+            return group
+        keys = self._band_keys(hashes[0])
+        candidates = sorted({idx for key in keys for idx in self._buckets.get(key, ())})
+        for idx in candidates:
+            d, p = self.representatives[idx]
+            if (
+                hamming(d, hashes[0]) <= self.max_distance
+                and hamming(p, hashes[1]) <= self.max_distance
+            ):
+                group = idx
+                break
+        else:
+            group = len(self.representatives)
+            self.representatives.append(hashes)
+            for key in keys:
+                self._buckets[key].append(group)
+        self._groups[hashes] = group
+        return group
+
+    def __len__(self) -> int:
+        return len(self.representatives)
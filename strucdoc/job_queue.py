@@ -0,0 +1,294 @@
+"""
+A job queue in a directory on shared storage, so that workers on several machines can split a corpus without a broker.
+
+Every job is a JSON file that moves between the state directories of the queue:
+    pending/: jobs waiting for a worker
+    claimed/: jobs being processed, the modification time of the file is the last heartbeat of its lease
+    done/, failed/: the results of finished jobs
+
+A worker claims a job by renaming it from pending/ to claimed/, which only one worker can do since
+renames are atomic. Claimed jobs whose lease is not renewed by heartbeats are moved back to pending/
+by any worker, so the jobs of a crashed worker are picked up by the others. A job may be processed
+twice if a lease expires while its worker is still alive, the handler should write its results atomically.
+Every claim writes a lease token in the job file, a worker that lost its lease never heartbeats, completes
+or releases the claim of the worker the job was given to next.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import uuid
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from .utils import get_logger, pjoin
+
+logger = get_logger(__name__)
+
+STATES = ("pending", "claimed", "done", "failed")
+
+
+@dataclass
+class Job:
+    """
+    A claimed job.
+
+    Args:
+        id (str): The file name of the job without extension.
+        dir (str): The document directory to process.
+        attempts (int): The number of times the job was claimed, including this one.
+        worker (str): The worker holding the job.
+        lease (str): The token of this claim, written in the claimed job file.
+    """
+
+    id: str
+    dir: str
+    attempts: int
+    worker: str
+    lease: str = ""
+
+
+def job_id(doc_dir: str) -> str:
+    return hashlib.sha256(os.path.abspath(doc_dir).encode()).hexdigest()[:16]
+
+
+def worker_name() -> str:
+    """
+    A name identifying this process across machines.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class JobQueue:
+    """
+    Document jobs in a directory shared by the workers, claimed with leases renewed by heartbeats.
+
+    Args:
+        directory (str): The queue directory, on storage shared by all workers.
+        lease_seconds (float): A claimed job without a heartbeat for this long is given to another worker.
+        max_attempts (int): A job failing or expiring this many times is moved to failed/.
+    """
+
+    def __init__(
+        self, directory: str, lease_seconds: float = 300.0, max_attempts: int = 3
+    ):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for state in STATES:
+            os.makedirs(pjoin(directory, state), exist_ok=True)
+
+    def _path(self, state: str, job: str) -> str:
+        return pjoin(self.directory, state, f"{job}.json")
+
+    def _write(self, path: str, data: dict):
+        """
+        Write a JSON file atomically, which also renews its modification time.
+        """
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def _list(self, state: str) -> list[str]:
+        return [
+            name[: -len(".json")]
+            for name in os.listdir(pjoin(self.directory, state))
+            if name.endswith(".json")
+        ]
+
+    def now(self) -> float:
+        """
+        The current time of the shared storage, so that leases do not depend on the clocks of the machines agreeing.
+        """
+        path = pjoin(self.directory, ".clock")
+        with open(path, "a"):
+            os.utime(path)
+        return os.stat(path).st_mtime
+
+    def submit(self, doc_dirs: Iterable[str]) -> int:
+        """
+        Add jobs for document directories, a directory already in any state of the queue is skipped.
+
+        Returns:
+            int: The number of jobs added.
+        """
+        existing = {job for state in STATES for job in self._list(state)}
+        added = 0
+        for doc_dir in doc_dirs:
+            job = job_id(doc_dir)
+            if job in existing:
+                continue
+            self._write(
+                self._path("pending", job),
+                {"dir": os.path.abspath(doc_dir), "attempts": 0},
+            )
+            existing.add(job)
+            added += 1
+        return added
+
+    def counts(self) -> dict[str, int]:
+        return {state: len(self._list(state)) for state in STATES}
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """
+        Claim a pending job, None if there is none.
+        """
+        for job in self._list("pending"):
+            claimed = self._path("claimed", job)
+            try:
+                os.rename(self._path("pending", job), claimed)
+                # A rename keeps the modification time of the submission, start the lease before reaping can see it expired
+                os.utime(claimed)
+                with open(claimed, encoding="utf-8") as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
+            data["attempts"] += 1
+            data["worker"] = worker
+            data["lease"] = uuid.uuid4().hex
+            if data["attempts"] > self.max_attempts:
+                data["error"] = f"gave up after {self.max_attempts} attempts"
+                self._write(self._path("failed", job), data)
+                try:
+                    os.remove(claimed)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                # Renew the lease only if the file is still ours, recreating it would claim a released job twice
+                os.utime(claimed)
+            except FileNotFoundError:
+                continue
+            self._write(claimed, data)
+            return Job(job, data["dir"], data["attempts"], worker, data["lease"])
+        return None
+
+    def holds(self, job: Job) -> bool:
+        """
+        Whether the claim of a job is still this one, False once its lease was given back to the queue.
+        """
+        try:
+            with open(self._path("claimed", job.id), encoding="utf-8") as f:
+                return json.load(f).get("lease") == job.lease
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+    def heartbeat(self, job: Job) -> bool:
+        """
+        Renew the lease of a job, False if it expired and was given back to the queue.
+        """
+        if not self.holds(job):
+            return False
+        try:
+            os.utime(self._path("claimed", job.id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def reap(self) -> int:
+        """
+        Move the claimed jobs whose lease expired back to pending.
+
+        Returns:
+            int: The number of jobs released.
+        """
+        now, released = self.now(), 0
+        for job in self._list("claimed"):
+            claimed = self._path("claimed", job)
+            try:
+                if now - os.stat(claimed).st_mtime < self.lease_seconds:
+                    continue
+                os.rename(claimed, self._path("pending", job))
+            except FileNotFoundError:
+                continue
+            logger.warning("lease of job %s expired, released it", job)
+            released += 1
+        return released
+
+    def complete(self, job: Job, result: dict[str, Any]):
+        """
+        Record the result of a job, a failed job is retried until it reaches `max_attempts`.
+
+        The result of a job whose lease was lost is dropped, the job is left to the worker it was given to.
+        """
+        claimed = self._path("claimed", job.id)
+        if not self.holds(job):
+            logger.warning("lost the lease of job %s, dropped its result", job.id)
+            return
+        data = {
+            "dir": job.dir,
+            "attempts": job.attempts,
+            "worker": job.worker,
+            **result,
+        }
+        if result.get("ok", True):
+            self._write(self._path("done", job.id), data)
+        elif job.attempts < self.max_attempts:
+            self._write(claimed, data)
+            try:
+                os.rename(claimed, self._path("pending", job.id))
+            except FileNotFoundError:
+                pass
+            return
+        else:
+            self._write(self._path("failed", job.id), data)
+        try:
+            os.remove(claimed)
+        except FileNotFoundError:
+            pass
+
+
+async def serve(
+    queue: JobQueue,
+    handler: Callable[[Job], Awaitable[dict[str, Any]]],
+    concurrency: int = 1,
+    poll_seconds: float = 5.0,
+    worker: Optional[str] = None,
+    on_result: Optional[Callable[[dict[str, Any]], None]] = None,
+):
+    """
+    Process jobs of the queue until no job is pending or claimed by any worker.
+
+    Args:
+        queue (JobQueue): The queue.
+        handler (Callable[[Job], Awaitable[dict[str, Any]]]): Process a job and return its result, with "ok" False on failure.
+        concurrency (int): The number of jobs processed at once.
+        poll_seconds (float): The interval to look for jobs released by expired leases while other workers are busy.
+        worker (Optional[str]): The name of this worker, see `worker_name`.
+        on_result (Optional[Callable[[dict[str, Any]], None]]): Called with the result of every job.
+    """
+    worker = worker or worker_name()
+
+    async def keep_alive(job: Job):
+        while True:
+            await asyncio.sleep(queue.lease_seconds / 3)
+            if not await asyncio.to_thread(queue.heartbeat, job):
+                logger.warning("lost the lease of job %s", job.id)
+                return
+
+    async def consume():
+        while True:
+            job = await asyncio.to_thread(queue.claim, worker)
+            if job is None:
+                await asyncio.to_thread(queue.reap)
+                counts = await asyncio.to_thread(queue.counts)
+                if counts["pending"] == 0 and counts["claimed"] == 0:
+                    return
+                if counts["pending"] == 0:
+                    await asyncio.sleep(poll_seconds)
+                continue
+            heartbeat = asyncio.create_task(keep_alive(job))
+            try:
+                result = await handler(job)
+            except Exception as e:
+                result = {"ok": False, "error": repr(e)}
+            finally:
+                heartbeat.cancel()
+            await asyncio.to_thread(queue.complete, job, result)
+            if on_result is not None:
+                on_result(result)
+
+    await asyncio.gather(*(consume() for _ in range(concurrency)))
@@ -1,20 +1,387 @@
+import asyncio
 import base64
+import functools
+import json
 import re
 import threading
+import time
+import weakref
 from dataclasses import dataclass
-from typing import Optional, Union
+from typing import Any, Optional, Union
 
 import torch
-from oaib import Auto
-from openai import AsyncOpenAI, OpenAI
+from openai import (
+    DEFAULT_CONNECTION_LIMITS,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    OpenAI,
+)
 from openai.types.chat import ChatCompletion
 from pydantic import BaseModel
 
+from .executors import run_cpu
+from .tracing import Span, span
+from .usage import Usage, record_usage
 from .utils import get_json_from_response, get_logger, tenacity_decorator
 
 logger = get_logger(__name__)
 
 
+@dataclass
+class HTTPOptions:
+    """
+    Connection pool settings of the HTTP clients shared by all LLMs.
+    """
+
+    max_connections: int = 256
+    max_keepalive_connections: int = 64
+    keepalive_expiry: float = 60.0
+    http2: bool = False
+
+
+async def close_clients(clients: list[AsyncOpenAI]):
+    """
+    Close asynchronous clients, a client failing to close does not keep the others open.
+    """
+    results = await asyncio.gather(
+        *(client.close() for client in clients), return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("failed to close an HTTP client: %s", result)
+
+
+class ClientRegistry:
+    """
+    A process-wide registry of OpenAI clients.
+
+    LLMs with the same base_url and api_key share one connection pool, so that
+    concurrent requests reuse warm connections. Asynchronous pools are kept per
+    event loop, as connections cannot outlive the loop that opened them, and are
+    closed when the loop shuts down its tasks, e.g. at the end of `asyncio.run`.
+    """
+
+    def __init__(self, options: Optional[HTTPOptions] = None):
+        self.options = options or HTTPOptions()
+        self._lock = threading.Lock()
+        self._sync_clients: dict[tuple, OpenAI] = {}
+        self._async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._loopless_clients: dict[tuple, AsyncOpenAI] = {}
+        # The task of each loop waiting to close its clients, see `_close_on_shutdown`
+        self._closers: dict[asyncio.AbstractEventLoop, asyncio.Task] = {}
+        self._closing: set[asyncio.Task] = set()
+
+    def configure(self, **options):
+        """
+        Update the HTTP options, clients created afterwards use the new settings and the replaced ones are closed.
+        """
+        with self._lock:
+            for key, value in options.items():
+                assert hasattr(self.options, key), f"Unknown HTTP option: {key}"
+                setattr(self.options, key, value)
+            sync_clients = list(self._sync_clients.values())
+            loopless_clients = list(self._loopless_clients.values())
+            closers = list(self._closers.items())
+            self._sync_clients.clear()
+            self._async_clients.clear()
+            self._loopless_clients.clear()
+        for client in sync_clients:
+            client.close()
+        # Cancelling the closer of a loop closes its clients in that loop
+        for loop, closer in closers:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(closer.cancel)
+        if len(loopless_clients) == 0:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(close_clients(loopless_clients))
+        else:
+            task = loop.create_task(close_clients(loopless_clients))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    def get(
+        self,
+        base_url: Optional[str],
+        api_key: Optional[str],
+        timeout: float,
+        use_async: bool = False,
+    ) -> Union[OpenAI, AsyncOpenAI]:
+        """
+        Get a client sharing the connection pool of its base_url and api_key.
+        """
+        key = (base_url, api_key, timeout)
+        with self._lock:
+            if not use_async:
+                clients = self._sync_clients
+            else:
+                try:
+                    loop = asyncio.get_running_loop()
+                except RuntimeError:
+                    clients = self._loopless_clients
+                else:
+                    clients = self._async_clients.get(loop)
+                    if clients is None:
+                        clients = self._async_clients[loop] = {}
+                        self._closers[loop] = loop.create_task(
+                            self._close_on_shutdown(loop, clients),
+                            name="close-http-clients",
+                        )
+            client = clients.get(key)
+            if client is None:
+                client = self._create(base_url, api_key, use_async, clients)
+                client = client.with_options(timeout=timeout)
+                clients[key] = client
+        return client
+
+    async def _close_on_shutdown(
+        self, loop: asyncio.AbstractEventLoop, clients: dict[tuple, AsyncOpenAI]
+    ):
+        """
+        Wait until cancelled, by `configure` or by the loop cancelling its remaining tasks, then close the clients of the loop.
+        """
+        try:
+            await loop.create_future()
+        finally:
+            with self._lock:
+                if self._async_clients.get(loop) is clients:
+                    del self._async_clients[loop]
+                if self._closers.get(loop) is asyncio.current_task():
+                    del self._closers[loop]
+            await close_clients(list(clients.values()))
+
+    def _create(
+        self,
+        base_url: Optional[str],
+        api_key: Optional[str],
+        use_async: bool,
+        clients: dict,
+    ) -> Union[OpenAI, AsyncOpenAI]:
+        for (url, key, _), client in clients.items():
+            if url == base_url and key == api_key:
+                return client
+        # DEFAULT_CONNECTION_LIMITS is an instance of the httpx Limits used by openai
+        limits = type(DEFAULT_CONNECTION_LIMITS)(
+            max_connections=self.options.max_connections,
+            max_keepalive_connections=self.options.max_keepalive_connections,
+            keepalive_expiry=self.options.keepalive_expiry,
+        )
+        if use_async:
+            return AsyncOpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=limits, http2=self.options.http2
+                ),
+            )
+        return OpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            http_client=DefaultHttpxClient(limits=limits, http2=self.options.http2),
+        )
+
+
+CLIENTS = ClientRegistry()
+
+
+def configure_http(**options):
+    """
+    Configure the connection pools shared by all LLMs.
+
+    Args:
+        max_connections (int): The maximum number of concurrent connections per pool.
+        max_keepalive_connections (int): The maximum number of idle connections kept alive.
+        keepalive_expiry (float): Seconds before an idle connection is closed.
+        http2 (bool): Whether to use HTTP/2, requires the `h2` package.
+    """
+    CLIENTS.configure(**options)
+
+
+def structured_output_kwargs(response_format: Optional[dict]) -> dict:
+    """
+    Build the `response_format` argument for a raw JSON schema.
+
+    Args:
+        response_format (dict): A JSON schema, or None for plain text output.
+
+    Returns:
+        dict: Keyword arguments to pass to `chat.completions.create`.
+    """
+    if response_format is None:
+        return {}
+    return {
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": response_format.get("title", "response"),
+                "schema": response_format,
+            },
+        }
+    }
+
+
+def trace_usage(llm_span: Optional[Span], usage: Optional[Usage]):
+    """
+    Attach the token usage of a request to its span.
+    """
+    if llm_span is not None and usage is not None:
+        llm_span.attrs["prompt_tokens"] = usage.prompt_tokens
+        llm_span.attrs["completion_tokens"] = usage.completion_tokens
+
+
+@dataclass
+class BatchStats:
+    """
+    Counters of a `BatchDispatcher`.
+    """
+
+    requests: int = 0
+    batches: int = 0
+    deduplicated: int = 0
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.requests / self.batches if self.batches else 0.0
+
+
+class BatchDispatcher:
+    """
+    Accumulate concurrent chat completion requests and submit them together.
+
+    Every caller awaits its own future. Requests arriving within `batch_window`
+    seconds are grouped (up to `max_batch_size`), identical requests inside a group
+    are sent only once, and each completion is routed back to its callers as soon
+    as it arrives, a slow request does not hold back the others of its batch.
+    """
+
+    def __init__(
+        self,
+        send,
+        max_batch_size: int = 32,
+        batch_window: float = 0.05,
+        deduplicate: bool = True,
+    ):
+        """
+        Args:
+            send (Callable): Coroutine function sending one request, called with the request kwargs.
+            max_batch_size (int): The maximum number of requests in one batch.
+            batch_window (float): Seconds to wait for more requests before flushing.
+            deduplicate (bool): Whether identical requests in a batch share one call.
+        """
+        assert max_batch_size > 0, "max_batch_size must be positive"
+        self.send = send
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.deduplicate = deduplicate
+        self.stats = BatchStats()
+        self._loop = None
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._flush_handle = None
+        self._inflight: set[asyncio.Task] = set()
+
+    async def submit(self, **request):
+        """
+        Queue a request and wait for its completion.
+        """
+        result, _ = await self.submit_shared(**request)
+        return result
+
+    async def submit_shared(self, **request) -> tuple[Any, bool]:
+        """
+        Queue a request and wait for its completion, with whether it was shared with an identical request
+        of another caller, which then accounts for its usage.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Pending state belongs to the loop that created it
+            self._loop = loop
+            self._pending = []
+            self._flush_handle = None
+            self._inflight = set()
+        future = loop.create_future()
+        self._pending.append((request, future))
+        if len(self._pending) >= self.max_batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self.flush)
+        return await future
+
+    def flush(self):
+        """
+        Submit all pending requests as one batch.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if len(batch) == 0:
+            return
+        self._dispatch(batch)
+
+    def _dispatch(self, batch: list[tuple[dict, asyncio.Future]]):
+        groups: dict[str, list[asyncio.Future]] = {}
+        requests: dict[str, dict] = {}
+        for idx, (request, future) in enumerate(batch):
+            key = request_key(request) if self.deduplicate else str(idx)
+            requests.setdefault(key, request)
+            groups.setdefault(key, []).append(future)
+        self.stats.requests += len(batch)
+        self.stats.batches += 1
+        self.stats.deduplicated += len(batch) - len(groups)
+
+        for key, request in requests.items():
+            task = self._loop.create_task(self.send(**request))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+            task.add_done_callback(functools.partial(self._resolve, groups[key]))
+
+    @staticmethod
+    def _resolve(futures: list[asyncio.Future], task: asyncio.Task):
+        """
+        Route the completion of a sent request to its callers, the first caller still waiting owns it.
+        """
+        shared = False
+        for future in futures:
+            if future.done():
+                continue
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result((task.result(), shared))
+                shared = True
+
+
+def request_key(request: dict) -> str:
+    """
+    Get a stable key identifying a chat completion request.
+    """
+
+    def default(obj):
+        if isinstance(obj, type) and issubclass(obj, BaseModel):
+            return obj.model_json_schema()
+        return repr(obj)
+
+    return json.dumps(request, sort_keys=True, ensure_ascii=False, default=default)
+
+
+def image_part(image: str) -> dict:
+    """
+    The content part of a chat message embedding an image file as base64.
+    """
+    with open(image, "rb") as f:
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/jpeg;base64,{base64.b64encode(f.read()).decode('utf-8')}"
+            },
+        }
+
+
 @dataclass
 class LLM:
     """
@@ -25,11 +392,22 @@ class LLM:
     base_url: Optional[str] = None
     api_key: Optional[str] = None
     timeout: int = 360
+    _client = None
 
-    def __post_init__(self):
-        self.client = OpenAI(
-            base_url=self.base_url, api_key=self.api_key, timeout=self.timeout
-        )
+    @property
+    def client(self) -> OpenAI:
+        if self._client is not None:
+            return self._client
+        return CLIENTS.get(self.base_url, self.api_key, self.timeout)
+
+    @client.setter
+    def client(self, client: OpenAI):
+        self._client = client
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_client", None)
+        return state
 
     @tenacity_decorator
     def __call__(
@@ -41,6 +419,7 @@ class LLM:
         return_json: bool = False,
         return_message: bool = False,
         response_format: Optional[BaseModel] = None,
+        retry: bool = True,
         **client_kwargs,
     ) -> Union[str, dict, list, tuple]:
         """
@@ -53,6 +432,7 @@ class LLM:
             history (list): The conversation history.
             return_json (bool): Whether to return the response as JSON.
             return_message (bool): Whether to return the message.
+            retry (bool): Whether to retry a failed request, see `tenacity_decorator`.
             **client_kwargs: Additional keyword arguments to pass to the client.
 
         Returns:
@@ -61,20 +441,27 @@ class LLM:
         if history is None:
             history = []
         system, message = self.format_message(content, images, system_message)
+        start = time.perf_counter()
         try:
-            if response_format is None:
-                completion = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=system + history + message,
-                    **client_kwargs,
-                )
-            else:
-                completion = self.client.beta.chat.completions.parse(
-                    model=self.model,
-                    messages=system + history + message,
-                    response_format=response_format,
-                    **client_kwargs,
+            with span("llm", "llm", model=self.model) as llm_span:
+                if response_format is None or isinstance(response_format, dict):
+                    completion = self.client.chat.completions.create(
+                        model=self.model,
+                        messages=system + history + message,
+                        **structured_output_kwargs(response_format),
+                        **client_kwargs,
+                    )
+                else:
+                    completion = self.client.beta.chat.completions.parse(
+                        model=self.model,
+                        messages=system + history + message,
+                        response_format=response_format,
+                        **client_kwargs,
+                    )
+                usage = record_usage(
+                    self.model, completion.usage, time.perf_counter() - start
                 )
+                trace_usage(llm_span, usage)
         except Exception as e:
             logger.warning("Error in LLM call: %s", e)
             raise e
@@ -93,7 +480,7 @@ class LLM:
         Process the response based on return options.
 
         Args:
-            response (str): The raw response from the model.
+            response (str): The raw response from the model, or its parsed JSON.
             message (List): The message history.
             return_json (bool): Whether to return the response as JSON.
             return_message (bool): Whether to return the message.
@@ -101,7 +488,8 @@ class LLM:
         Returns:
             Union[str, Dict, Tuple]: Processed response.
         """
-        response = response.strip()
+        if isinstance(response, str):
+            response = response.strip()
         if return_json:
             response = get_json_from_response(response)
         if return_message:
@@ -168,15 +556,7 @@ class LLM:
         if images is not None:
             for image in images:
                 try:
-                    with open(image, "rb") as f:
-                        message[0]["content"].append(
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64.b64encode(f.read()).decode('utf-8')}"
-                                },
-                            }
-                        )
+                    message[0]["content"].append(image_part(image))
                 except Exception as e:
                     logger.error("Failed to load image %s: %s", image, e)
         return system, message
@@ -224,6 +604,8 @@ class LLM:
 @dataclass
 class AsyncLLM(LLM):
     use_batch: bool = False
+    batch_size: int = 32
+    batch_window: float = 0.05
     """
     Asynchronous wrapper class for language model interaction.
     """
@@ -236,19 +618,26 @@ class AsyncLLM(LLM):
             model (str): The model name.
             base_url (str): The base URL for the API.
             api_key (str): API key for authentication. Defaults to environment variable.
+            use_batch (bool): Whether to group concurrent calls through a `BatchDispatcher`.
+            batch_size (int): The maximum number of requests submitted in one batch.
+            batch_window (float): Seconds to wait for more requests before submitting a batch.
         """
-        self.client = AsyncOpenAI(
-            base_url=self.base_url,
-            api_key=self.api_key,
-            timeout=self.timeout,
-        )
-        self.batch = Auto(
-            base_url=self.base_url,
-            api_key=self.api_key,
-            timeout=self.timeout,
-            loglevel=0,
+        self.batch = BatchDispatcher(
+            self._create,
+            max_batch_size=self.batch_size,
+            batch_window=self.batch_window,
         )
 
+    @property
+    def client(self) -> AsyncOpenAI:
+        if self._client is not None:
+            return self._client
+        return CLIENTS.get(self.base_url, self.api_key, self.timeout, use_async=True)
+
+    @client.setter
+    def client(self, client: AsyncOpenAI):
+        self._client = client
+
     @tenacity_decorator
     async def __call__(
         self,
@@ -259,6 +648,7 @@ class AsyncLLM(LLM):
         return_json: bool = False,
         return_message: bool = False,
         response_format: Optional[BaseModel] = None,
+        retry: bool = True,
         **client_kwargs,
     ) -> Union[str, dict, tuple]:
         """
@@ -271,82 +661,95 @@ class AsyncLLM(LLM):
             history (list): The conversation history.
             return_json (bool): Whether to return the response as JSON.
             return_message (bool): Whether to return the message.
+            retry (bool): Whether to retry a failed request, see `tenacity_decorator`.
             **client_kwargs: Additional keyword arguments to pass to the client.
 
         Returns:
             Union[str, Dict, List, Tuple]: The response from the model.
         """
-        if self.use_batch and threading.current_thread() is threading.main_thread():
-            self.batch = Auto(
-                base_url=self.base_url,
-                api_key=self.api_key,
-                timeout=self.timeout,
-                loglevel=0,
-            )
-        elif self.use_batch:
-            logger.warning(
-                "Warning: AsyncLLM is not running in the main thread, may cause race condition."
-            )
         if history is None:
             history = []
         system, message = self.format_message(content, images, system_message)
+        start = time.perf_counter()
         try:
-            if self.use_batch:
-                assert (
-                    response_format is None
-                ), "response_format is not supported in batch mode"
-                await self.batch.add(
-                    "chat.completions.create",
-                    model=self.model,
-                    messages=system + history + message,
-                    **client_kwargs,
-                )
-                completion = await self.batch.run()
-                if "result" not in completion or len(completion["result"]) != 1:
-                    raise ValueError(
-                        f"The length of completion result should be 1, but got {completion}.\nRace condition may have occurred if multiple values are returned.\nOr, there was an error in the LLM call, use the synchronous version to check."
-                    )
-                completion = ChatCompletion(**completion["result"][0])
-            else:
-                if response_format is None:
-                    completion = await self.client.chat.completions.create(
-                        model=self.model,
+            with span("llm", "llm", model=self.model) as llm_span:
+                shared = False
+                if self.use_batch:
+                    completion, shared = await self.batch.submit_shared(
                         messages=system + history + message,
+                        response_format=response_format,
                         **client_kwargs,
                     )
                 else:
-                    completion = await self.client.beta.chat.completions.parse(
-                        model=self.model,
+                    completion = await self._create(
                         messages=system + history + message,
                         response_format=response_format,
                         **client_kwargs,
                     )
-
+                # A completion shared by identical requests is counted once, by the caller owning it
+                if not shared:
+                    usage = record_usage(
+                        self.model, completion.usage, time.perf_counter() - start
+                    )
+                    trace_usage(llm_span, usage)
         except Exception as e:
             logger.warning("Error in AsyncLLM call: %s", e)
             raise e
         response = completion.choices[0].message.content
         message.append({"role": "assistant", "content": response})
-        return self.__post_process__(response, message, return_json, return_message)
+        return await self.__post_process__(
+            response, message, return_json, return_message
+        )
+
+    async def __post_process__(
+        self,
+        response: str,
+        message: list,
+        return_json: bool = False,
+        return_message: bool = False,
+    ) -> Union[str, dict, tuple]:
+        """
+        Process the response like `LLM.__post_process__`, parsing the JSON off the event loop.
+        """
+        if return_json:
+            response = await run_cpu(get_json_from_response, response.strip())
+        return super().__post_process__(response, message, False, return_message)
+
+    async def _create(
+        self,
+        messages: list,
+        response_format: Optional[Union[type[BaseModel], dict]] = None,
+        **client_kwargs,
+    ) -> ChatCompletion:
+        """
+        Send a single chat completion request.
+        """
+        if response_format is None or isinstance(response_format, dict):
+            return await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                **structured_output_kwargs(response_format),
+                **client_kwargs,
+            )
+        return await self.client.beta.chat.completions.parse(
+            model=self.model,
+            messages=messages,
+            response_format=response_format,
+            **client_kwargs,
+        )
 
     def __getstate__(self):
         state = self.__dict__.copy()
-        state["client"] = None
+        state.pop("_client", None)
         state["batch"] = None
         return state
 
     def __setstate__(self, state: dict):
         self.__dict__.update(state)
-        self.client = AsyncOpenAI(
-            base_url=self.base_url,
-            api_key=self.api_key,
-            timeout=self.timeout,
-        )
-        self.batch = Auto(
-            base_url=self.base_url,
-            api_key=self.api_key,
-            timeout=self.timeout,
-            loglevel=0,
+        self.batch = BatchDispatcher(
+            self._create,
+            max_batch_size=self.batch_size,
+            batch_window=self.batch_window,
         )
 
     async def test_connection(self) -> bool:
@@ -388,7 +791,7 @@ class AsyncLLM(LLM):
 
     async def get_embedding(
         self,
-        text: str,
+        text: str | list[str],
         to_tensor: bool = True,
         **kwargs,
     ) -> torch.Tensor | list[float]:
@@ -396,11 +799,11 @@ class AsyncLLM(LLM):
         Get the embedding of a text asynchronously.
 
         Args:
-            text (str): The text to get embeddings for.
+            text (str | list[str]): The text to get embeddings for, or a batch of texts embedded by one request.
             **kwargs: Additional keyword arguments.
 
         Returns:
-            List[float]: The embedding vector.
+            List[float]: The embedding vectors, one row per text.
         """
         response = await self.client.embeddings.create(
             model=self.model,
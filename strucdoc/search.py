@@ -0,0 +1,332 @@
+import asyncio
+import heapq
+import json
+import math
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterator, Optional
+
+import torch
+
+from .element import Media, SubSection
+from .executors import run_cpu
+from .llms import AsyncLLM
+from .tracing import span
+from .utils import ENCODING
+
+if TYPE_CHECKING:
+    from .document import Document
+
+CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+TOKEN_REGEX = re.compile(rf"[{CJK_CHARS}]+|[^\W{CJK_CHARS}]+")
+CJK_REGEX = re.compile(rf"[{CJK_CHARS}]")
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Split text into lowercase terms, words for alphabetic scripts and character bigrams for CJK, which has no spaces between words.
+    """
+    terms = []
+    for match in TOKEN_REGEX.finditer(text.lower()):
+        token = match.group()
+        if CJK_REGEX.match(token) is None:
+            terms.append(token)
+        elif len(token) == 1:
+            terms.append(token)
+        else:
+            terms.extend(token[i : i + 2] for i in range(len(token) - 1))
+    return terms
+
+
+@dataclass
+class SearchHit:
+    """
+    A block matching a query.
+
+    Args:
+        score (float): The BM25 score, or the cosine similarity for an EmbeddingIndex.
+        kind (str): "section" for the title and summary of a section, "subsection" or "media", and "table" in a DocumentStore.
+        section (int): The index of the section in `Document.blocks`.
+        block (Optional[int]): The index of the block in `Section.blocks`, None for a section.
+        document (Optional[str]): The name of the document in a corpus index.
+    """
+
+    score: float
+    kind: str
+    section: int
+    block: Optional[int] = None
+    document: Optional[str] = None
+
+
+class BM25Index:
+    """
+    An inverted index over the sections, subsections and media captions of one document or a corpus, scored with BM25.
+
+    Example:
+        index = BM25Index()
+        index.add_document(document, "paper")
+        hits = index.search("evaluation datasets", k=5)
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # (kind, section, block, document) of every entry
+        self.entries: list[tuple[str, int, Optional[int], Optional[str]]] = []
+        self.lengths: list[int] = []
+        self.total_length = 0
+        # term -> {entry id: term frequency}
+        self.postings: dict[str, dict[int, int]] = {}
+        # The length normalization of every entry, recomputed after entries are added
+        self._norms: Optional[list[float]] = None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(
+        self,
+        text: str,
+        kind: str,
+        section: int,
+        block: Optional[int] = None,
+        document: Optional[str] = None,
+    ):
+        entry_id = len(self.entries)
+        terms = tokenize(text)
+        self.entries.append((kind, section, block, document))
+        self.lengths.append(len(terms))
+        self.total_length += len(terms)
+        self._norms = None
+        for term, tf in Counter(terms).items():
+            self.postings.setdefault(term, {})[entry_id] = tf
+
+    def add_document(self, document: "Document", name: Optional[str] = None):
+        """
+        Index the section titles and summaries, subsections and media captions of a document.
+        """
+        for kind, text, section, block in iter_search_texts(document):
+            self.add(text, kind, section, block, name)
+
+    @classmethod
+    def from_document(cls, document: "Document", **kwargs) -> "BM25Index":
+        index = cls(**kwargs)
+        index.add_document(document)
+        return index
+
+    def idf(self, term: str) -> float:
+        df = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.entries) - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, k: int = 10) -> list[SearchHit]:
+        """
+        Get the top-k entries for a query, only the postings of the query terms are visited.
+        """
+        if len(self.entries) == 0:
+            return []
+        if self._norms is None:
+            avg_length = max(self.total_length / len(self.entries), 1e-9)
+            self._norms = [
+                self.k1 * (1 - self.b + self.b * length / avg_length)
+                for length in self.lengths
+            ]
+        norms = self._norms
+        scores: dict[int, float] = {}
+        for term, query_tf in Counter(tokenize(query)).items():
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            weight = self.idf(term) * query_tf * (self.k1 + 1)
+            for entry_id, tf in postings.items():
+                scores[entry_id] = scores.get(entry_id, 0.0) + weight * tf / (
+                    tf + norms[entry_id]
+                )
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [SearchHit(score, *self.entries[entry_id]) for entry_id, score in top]
+
+    def save(self, path: str):
+        """
+        Save the index as JSON, the file is replaced atomically.
+        """
+        data = {
+            "k1": self.k1,
+            "b": self.b,
+            "entries": self.entries,
+            "lengths": self.lengths,
+            "postings": {
+                term: [[entry_id, tf] for entry_id, tf in postings.items()]
+                for term, postings in self.postings.items()
+            },
+        }
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(data["k1"], data["b"])
+        index.entries = [tuple(entry) for entry in data["entries"]]
+        index.lengths = data["lengths"]
+        index.total_length = sum(index.lengths)
+        index.postings = {
+            term: dict(map(tuple, postings))
+            for term, postings in data["postings"].items()
+        }
+        return index
+
+
+class EmbeddingIndex:
+    """
+    Embeddings of the subsections and media captions of a document, stacked in one contiguous float32 matrix.
+
+    Rows are L2-normalized, so cosine scores of a query against every block are a single matrix-vector product.
+    """
+
+    def __init__(
+        self,
+        matrix: torch.Tensor,
+        entries: list[tuple[str, int, Optional[int], Optional[str]]],
+        model: str,
+        text_model: Optional[AsyncLLM] = None,
+    ):
+        assert matrix.shape[0] == len(entries), "one embedding per entry is required"
+        self.matrix = matrix.to(torch.float32).contiguous()
+        self.entries = entries
+        self.model = model
+        # The model embedding the queries, not persisted
+        self.text_model = text_model
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @classmethod
+    async def build(
+        cls,
+        document: "Document",
+        text_model: AsyncLLM,
+        batch_size: int = 32,
+        max_at_once: int = 4,
+        max_tokens: int = 8191,
+    ) -> "EmbeddingIndex":
+        """
+        Embed every subsection and media caption of a document, `batch_size` texts per request.
+
+        Args:
+            document (Document): The document to index.
+            text_model (AsyncLLM): The embedding model.
+            batch_size (int): The number of texts embedded by one request.
+            max_at_once (int): The maximum number of concurrent requests.
+            max_tokens (int): Texts are truncated to this many tokens, the input limit of the model.
+        """
+        entries, texts = [], []
+        for kind, text, section, block in iter_search_texts(document):
+            if kind != "section":
+                entries.append((kind, section, block, None))
+                texts.append(text)
+        texts = await run_cpu(truncate_texts, texts, max_tokens)
+        limiter = asyncio.Semaphore(max_at_once)
+
+        async def embed(batch: list[str]) -> torch.Tensor:
+            async with limiter:
+                return await text_model.get_embedding(batch)
+
+        with span("embed_blocks", texts=len(texts)):
+            batches = await asyncio.gather(
+                *(
+                    embed(texts[i : i + batch_size])
+                    for i in range(0, len(texts), batch_size)
+                )
+            )
+        matrix = torch.cat(batches) if batches else torch.empty(0, 0)
+        return cls(
+            torch.nn.functional.normalize(matrix.float(), dim=-1),
+            entries,
+            text_model.model,
+            text_model,
+        )
+
+    async def search(
+        self, query: str, k: int = 10, text_model: Optional[AsyncLLM] = None
+    ) -> list[SearchHit]:
+        """
+        Get the top-k blocks by cosine similarity to the query.
+        """
+        text_model = text_model or self.text_model
+        assert (
+            text_model is not None
+        ), "pass the text_model that built the index to embed the query"
+        if len(self.entries) == 0:
+            return []
+        query_embedding = await text_model.get_embedding(query)
+        query_embedding = torch.nn.functional.normalize(
+            query_embedding.reshape(-1).float(), dim=0
+        )
+        scores, ids = torch.topk(
+            self.matrix @ query_embedding, min(k, len(self.entries))
+        )
+        return [
+            SearchHit(score, *self.entries[entry_id])
+            for score, entry_id in zip(scores.tolist(), ids.tolist())
+        ]
+
+    def save(self, path: str):
+        """
+        Save the matrix and the entries with `torch.save`, the file is replaced atomically.
+        """
+        torch.save(
+            {"model": self.model, "entries": self.entries, "matrix": self.matrix},
+            path + ".tmp",
+        )
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str, text_model: Optional[AsyncLLM] = None) -> "EmbeddingIndex":
+        data = torch.load(path, weights_only=True)
+        return cls(
+            data["matrix"],
+            [tuple(entry) for entry in data["entries"]],
+            data["model"],
+            text_model,
+        )
+
+
+def truncate_texts(texts: list[str], max_tokens: int) -> list[str]:
+    truncated = []
+    for text in texts:
+        tokens = ENCODING.encode(text, disallowed_special=())
+        if len(tokens) > max_tokens:
+            text = ENCODING.decode(tokens[:max_tokens])
+        truncated.append(text)
+    return truncated
+
+
+def iter_search_texts(
+    document: "Document",
+) -> Iterator[tuple[str, str, int, Optional[int]]]:
+    """
+    Iterate the searchable texts of a document as (kind, text, section index, block index).
+    """
+    for i, section in enumerate(document.blocks):
+        yield "section", f"{section.title}\n{section.summary}", i, None
+        for j, block in enumerate(section.blocks):
+            if isinstance(block, SubSection):
+                yield "subsection", f"{block.title}\n{block.content}", i, j
+            elif isinstance(block, Media) and block.caption:
+                yield "media", block.caption, i, j
+
+
+def search_index_path(document_path: str) -> str:
+    """
+    The path of the search index saved alongside a document.
+    """
+    return os.path.splitext(document_path)[0] + ".bm25.json"
+
+
+def embedding_index_path(document_path: str) -> str:
+    """
+    The path of the embedding index saved alongside a document.
+    """
+    return os.path.splitext(document_path)[0] + ".embeddings.pt"
@@ -0,0 +1,475 @@
+"""
+A SQLite store of parsed documents, to query a corpus without loading every JSON file.
+
+Documents, their metadata, sections and blocks are rows of indexed tables, and the searchable
+texts are indexed with FTS5. Texts are tokenized by `strucdoc.search.tokenize` before they are
+indexed, so CJK text is matched by character bigrams as in `BM25Index`. Pydantic models are only
+rebuilt from rows for the documents, sections and blocks that are asked for.
+"""
+
+import json
+import sqlite3
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional, Union
+
+from .document import Document
+from .element import Media, Section, SubSection, Table
+from .search import SearchHit, tokenize
+from .utils import Language, pdirname
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    image_dir TEXT NOT NULL,
+    language INTEGER NOT NULL,
+    metadata TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS document_metadata (
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS document_metadata_key_value ON document_metadata(key, value);
+CREATE INDEX IF NOT EXISTS document_metadata_document ON document_metadata(document_id);
+CREATE TABLE IF NOT EXISTS sections (
+    id INTEGER PRIMARY KEY,
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    markdown_content TEXT,
+    language INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS sections_document_position ON sections(document_id, position);
+CREATE TABLE IF NOT EXISTS blocks (
+    id INTEGER PRIMARY KEY,
+    section_id INTEGER NOT NULL REFERENCES sections(id) ON DELETE CASCADE,
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    title TEXT,
+    content TEXT,
+    markdown_content TEXT,
+    near_chunks TEXT,
+    path TEXT,
+    caption TEXT,
+    cells TEXT,
+    merge_area TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS blocks_section_position ON blocks(section_id, position);
+CREATE INDEX IF NOT EXISTS blocks_kind_document ON blocks(kind, document_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS sections_fts USING fts5(text, content='');
+CREATE VIRTUAL TABLE IF NOT EXISTS blocks_fts USING fts5(text, content='');
+"""
+
+BLOCK_COLUMNS = "kind, title, content, markdown_content, near_chunks, path, caption, cells, merge_area"
+
+
+def search_text(text: str) -> str:
+    """
+    The text indexed by FTS5, terms of `tokenize` separated by spaces.
+    """
+    return " ".join(tokenize(text))
+
+
+def match_query(query: str) -> Optional[str]:
+    """
+    Convert a query to an FTS5 expression matching all of its terms, None if it has no terms.
+    """
+    terms = tokenize(query)
+    if not terms:
+        return None
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def block_text(block: dict) -> Optional[str]:
+    if "markdown_content" not in block:
+        return f"{block['title']}\n{block['content']}"
+    return block.get("caption") or None
+
+
+def block_row(block: dict) -> tuple:
+    if "markdown_content" not in block:
+        return ("subsection", block["title"], block["content"]) + (None,) * 6
+    table = "cells" in block
+    return (
+        "table" if table else "media",
+        None,
+        None,
+        block["markdown_content"],
+        json.dumps(block["near_chunks"], ensure_ascii=False),
+        block.get("path"),
+        block.get("caption"),
+        json.dumps(block["cells"], ensure_ascii=False) if table else None,
+        json.dumps(block["merge_area"]) if table else None,
+    )
+
+
+def block_from_row(row: tuple) -> Union[SubSection, Media]:
+    (
+        kind,
+        title,
+        content,
+        markdown_content,
+        near_chunks,
+        path,
+        caption,
+        cells,
+        merge_area,
+    ) = row
+    if kind == "subsection":
+        return SubSection(title=title, content=content)
+    fields = {
+        "markdown_content": markdown_content,
+        "near_chunks": json.loads(near_chunks),
+        "path": path,
+        "caption": caption,
+    }
+    if kind == "media":
+        return Media(**fields)
+    return Table(**fields, cells=json.loads(cells), merge_area=json.loads(merge_area))
+
+
+class DocumentStore:
+    """
+    Documents persisted into SQLite tables with indexes on metadata and block kinds, and FTS5 over their texts.
+
+    Example:
+        with DocumentStore("corpus.db") as store:
+            store.add_many((path, Document.load(path)) for path in paths)
+            for name, table in store.iter_medias(tables=True, metadata={"venue": "ACL"}):
+                ...
+            hits = store.search("evaluation datasets", k=5)
+            section = store.get_section(hits[0].document, hits[0].section)
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        # Transactions are managed explicitly, see `transaction`
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        if path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self) -> "DocumentStore":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def __contains__(self, name: str) -> bool:
+        return self._document_id(name) is not None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the statements of the block in one write transaction, rolled back if it raises.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def _document_id(self, name: str) -> Optional[int]:
+        row = self.connection.execute(
+            "SELECT id FROM documents WHERE name = ?", (name,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _insert(self, name: str, data: dict, image_dir: str):
+        """
+        Insert a document from the output of `Document.dict`, a document with the same name is replaced.
+        """
+        if self._document_id(name) is not None:
+            self._delete(name)
+        cursor = self.connection.execute(
+            "INSERT INTO documents (name, image_dir, language, metadata) VALUES (?, ?, ?, ?)",
+            (
+                name,
+                image_dir,
+                data["language"],
+                json.dumps(data["metadata"], ensure_ascii=False),
+            ),
+        )
+        document_id = cursor.lastrowid
+        self.connection.executemany(
+            "INSERT INTO document_metadata (document_id, key, value) VALUES (?, ?, ?)",
+            [(document_id, key, str(value)) for key, value in data["metadata"].items()],
+        )
+        # Ids are assigned here so that all rows are inserted with executemany
+        section_id, block_id = self.connection.execute(
+            "SELECT (SELECT COALESCE(MAX(id), 0) FROM sections), (SELECT COALESCE(MAX(id), 0) FROM blocks)"
+        ).fetchone()
+        sections, blocks, section_texts, block_texts = [], [], [], []
+        for i, section in enumerate(data["blocks"]):
+            section_id += 1
+            sections.append(
+                (
+                    section_id,
+                    document_id,
+                    i,
+                    section["title"],
+                    section["summary"],
+                    section.get("markdown_content"),
+                    section.get("language"),
+                )
+            )
+            section_texts.append(
+                (section_id, search_text(f"{section['title']}\n{section['summary']}"))
+            )
+            for j, block in enumerate(section["blocks"]):
+                block_id += 1
+                blocks.append((block_id, section_id, document_id, j, *block_row(block)))
+                text = block_text(block)
+                if text is not None:
+                    block_texts.append((block_id, search_text(text)))
+        self.connection.executemany(
+            "INSERT INTO sections (id, document_id, position, title, summary, markdown_content, language) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            sections,
+        )
+        self.connection.executemany(
+            f"INSERT INTO blocks (id, section_id, document_id, position, {BLOCK_COLUMNS}) VALUES ({', '.join('?' * 13)})",
+            blocks,
+        )
+        self.connection.executemany(
+            "INSERT INTO sections_fts (rowid, text) VALUES (?, ?)", section_texts
+        )
+        self.connection.executemany(
+            "INSERT INTO blocks_fts (rowid, text) VALUES (?, ?)", block_texts
+        )
+
+    def _delete(self, name: str):
+        document_id = self._document_id(name)
+        # Contentless FTS5 tables delete a row given the text it was indexed with
+        self.connection.executemany(
+            "INSERT INTO sections_fts (sections_fts, rowid, text) VALUES ('delete', ?, ?)",
+            [
+                (section_id, search_text(f"{title}\n{summary}"))
+                for section_id, title, summary in self.connection.execute(
+                    "SELECT id, title, summary FROM sections WHERE document_id = ?",
+                    (document_id,),
+                )
+            ],
+        )
+        block_texts = []
+        for (
+            block_id,
+            title,
+            content,
+            markdown_content,
+            caption,
+        ) in self.connection.execute(
+            "SELECT id, title, content, markdown_content, caption FROM blocks WHERE document_id = ?",
+            (document_id,),
+        ):
+            block = {"title": title, "content": content}
+            if markdown_content is not None:
+                block = {"markdown_content": markdown_content, "caption": caption}
+            text = block_text(block)
+            if text is not None:
+                block_texts.append((block_id, search_text(text)))
+        self.connection.executemany(
+            "INSERT INTO blocks_fts (blocks_fts, rowid, text) VALUES ('delete', ?, ?)",
+            block_texts,
+        )
+        self.connection.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+
+    def add(self, document: Document, name: str):
+        """
+        Insert a document, a document with the same name is replaced.
+        """
+        with self.transaction():
+            self._insert(name, document.dict, document.image_dir)
+
+    def add_many(self, documents: Iterable[tuple[str, Document]]):
+        """
+        Insert (name, document) pairs in one transaction.
+        """
+        with self.transaction():
+            for name, document in documents:
+                self._insert(name, document.dict, document.image_dir)
+
+    def import_files(
+        self,
+        paths: Iterable[str],
+        names: Optional[Iterable[str]] = None,
+        batch_size: int = 100,
+    ):
+        """
+        Insert documents saved by `Document.save` without validating them, committing every `batch_size` documents.
+
+        Args:
+            paths (Iterable[str]): The JSON files.
+            names (Optional[Iterable[str]]): The names of the documents, the paths by default.
+            batch_size (int): The number of documents inserted by one transaction.
+        """
+        paths = list(paths)
+        names = paths if names is None else list(names)
+        for i in range(0, len(paths), batch_size):
+            with self.transaction():
+                for path, name in zip(
+                    paths[i : i + batch_size], names[i : i + batch_size]
+                ):
+                    with open(path, encoding="utf-8") as f:
+                        data = json.load(f)
+                    self._insert(name, data, pdirname(path) or ".")
+
+    def remove(self, name: str):
+        assert name in self, f"document not found: {name}"
+        with self.transaction():
+            self._delete(name)
+
+    def documents(self, metadata: Optional[dict[str, str]] = None) -> list[str]:
+        """
+        Get the names of the documents whose metadata has all the given values.
+        """
+        where, params = self._metadata_filter(metadata)
+        return [
+            row[0]
+            for row in self.connection.execute(
+                f"SELECT name FROM documents d WHERE {where} ORDER BY d.id", params
+            )
+        ]
+
+    def _metadata_filter(
+        self, metadata: Optional[dict[str, str]]
+    ) -> tuple[str, list[str]]:
+        conditions, params = ["1"], []
+        for key, value in (metadata or {}).items():
+            conditions.append(
+                "d.id IN (SELECT document_id FROM document_metadata WHERE key = ? AND value = ?)"
+            )
+            params += [key, str(value)]
+        return " AND ".join(conditions), params
+
+    def iter_medias(
+        self,
+        tables: bool = False,
+        metadata: Optional[dict[str, str]] = None,
+        caption: Optional[str] = None,
+    ) -> Iterator[tuple[str, Media]]:
+        """
+        Iterate (document name, media) of the matching medias, every media is rebuilt as it is iterated.
+
+        Args:
+            tables (bool): Only iterate tables.
+            metadata (Optional[dict[str, str]]): Only iterate the medias of documents with these metadata values.
+            caption (Optional[str]): Only iterate the medias whose caption contains all terms of this query.
+        """
+        where, params = self._metadata_filter(metadata)
+        where += " AND b.kind = 'table'" if tables else " AND b.kind != 'subsection'"
+        if caption is not None:
+            query = match_query(caption)
+            if query is None:
+                return
+            where += (
+                " AND b.id IN (SELECT rowid FROM blocks_fts WHERE blocks_fts MATCH ?)"
+            )
+            params.append(query)
+        columns = ", ".join(f"b.{column}" for column in BLOCK_COLUMNS.split(", "))
+        for name, *row in self.connection.execute(
+            f"SELECT d.name, {columns} FROM blocks b JOIN documents d ON d.id = b.document_id WHERE {where} ORDER BY b.id",
+            params,
+        ):
+            yield name, block_from_row(row)
+
+    def search(
+        self,
+        query: str,
+        k: int = 10,
+        metadata: Optional[dict[str, str]] = None,
+    ) -> list[SearchHit]:
+        """
+        Get the top-k sections, subsections and medias containing all terms of the query, ranked by the bm25 of FTS5.
+
+        Sections and blocks are ranked by two FTS5 tables, so their scores are only roughly comparable.
+        """
+        query = match_query(query)
+        if query is None:
+            return []
+        where, params = self._metadata_filter(metadata)
+        # bm25() is lower for better matches, scores are negated to be higher for better matches
+        rows = self.connection.execute(
+            f"""
+            SELECT -bm25(sections_fts) AS score, 'section', s.position, NULL, d.name
+            FROM sections_fts JOIN sections s ON s.id = sections_fts.rowid JOIN documents d ON d.id = s.document_id
+            WHERE sections_fts MATCH ? AND {where}
+            UNION ALL
+            SELECT -bm25(blocks_fts) AS score, b.kind, s.position, b.position, d.name
+            FROM blocks_fts JOIN blocks b ON b.id = blocks_fts.rowid
+            JOIN sections s ON s.id = b.section_id JOIN documents d ON d.id = b.document_id
+            WHERE blocks_fts MATCH ? AND {where}
+            ORDER BY score DESC LIMIT ?
+            """,
+            [query, *params, query, *params, k],
+        )
+        return [SearchHit(*row) for row in rows]
+
+    def get_section(self, name: str, position: int) -> Section:
+        """
+        Rebuild one section of a document from its rows.
+        """
+        row = self.connection.execute(
+            "SELECT s.id, s.title, s.summary, s.markdown_content, s.language FROM sections s JOIN documents d ON d.id = s.document_id WHERE d.name = ? AND s.position = ?",
+            (name, position),
+        ).fetchone()
+        assert row is not None, f"section {position} of {name} not found"
+        section_id, title, summary, markdown_content, language = row
+        return Section(
+            title=title,
+            summary=summary,
+            blocks=[
+                block_from_row(block)
+                for block in self.connection.execute(
+                    f"SELECT {BLOCK_COLUMNS} FROM blocks WHERE section_id = ? ORDER BY position",
+                    (section_id,),
+                )
+            ],
+            markdown_content=markdown_content,
+            language=None if language is None else Language(language),
+        )
+
+    def get_block(self, hit: SearchHit) -> Union[Section, SubSection, Media]:
+        """
+        Rebuild the section or block of a search hit.
+        """
+        if hit.block is None:
+            return self.get_section(hit.document, hit.section)
+        row = self.connection.execute(
+            f"SELECT {', '.join(f'b.{column}' for column in BLOCK_COLUMNS.split(', '))} FROM blocks b "
+            "JOIN sections s ON s.id = b.section_id JOIN documents d ON d.id = b.document_id "
+            "WHERE d.name = ? AND s.position = ? AND b.position = ?",
+            (hit.document, hit.section, hit.block),
+        ).fetchone()
+        assert row is not None, f"block {hit} not found"
+        return block_from_row(row)
+
+    def get_document(self, name: str) -> Document:
+        """
+        Rebuild a whole document from its rows.
+        """
+        row = self.connection.execute(
+            "SELECT id, image_dir, language, metadata FROM documents WHERE name = ?",
+            (name,),
+        ).fetchone()
+        assert row is not None, f"document not found: {name}"
+        document_id, image_dir, language, metadata = row
+        (count,) = self.connection.execute(
+            "SELECT COUNT(*) FROM sections WHERE document_id = ?", (document_id,)
+        ).fetchone()
+        return Document(
+            image_dir=image_dir,
+            blocks=[self.get_section(name, i) for i in range(count)],
+            metadata=json.loads(metadata),
+            language=Language(language),
+        )
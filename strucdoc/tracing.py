@@ -0,0 +1,234 @@
+import asyncio
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Optional
+
+# Attributes propagated from a span to the spans nested in it
+INHERITED_ATTRS = ("document", "chunk")
+
+
+@dataclass
+class Span:
+    """
+    A timed stage of the pipeline.
+    """
+
+    name: str
+    category: str
+    start: float
+    lane: str
+    end: Optional[float] = None
+    attrs: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+class Tracer:
+    """
+    Collect spans of the pipeline and export them as a timeline or a summary table.
+
+    Categories:
+        stage: a step of the pipeline, may contain other spans
+        queue: time spent waiting for a concurrency slot
+        llm: a single LLM request
+        cpu: local computation
+
+    Example:
+        with trace() as tracer:
+            document = await Document.from_markdown(...)
+        tracer.save_chrome_trace("trace.json")
+        print(tracer.summary_table())
+    """
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self.origin = time.perf_counter()
+
+    def add(self, span: Span):
+        self.spans.append(span)
+
+    def to_chrome_trace(self) -> dict:
+        """
+        Convert the spans to the Chrome trace event format, viewable in Perfetto or chrome://tracing.
+        """
+        lanes: dict[str, int] = {}
+        events = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            tid = lanes.setdefault(span.lane, len(lanes))
+            event = {
+                "name": span.name,
+                "cat": span.category,
+                "ts": (span.start - self.origin) * 1e6,
+                "pid": 0,
+                "tid": tid,
+                "args": span.attrs,
+            }
+            if span.end == span.start:
+                event.update(ph="i", s="t")
+            else:
+                event.update(ph="X", dur=span.duration * 1e6)
+            events.append(event)
+        for lane, tid in lanes.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 0,
+                    "tid": tid,
+                    "args": {"name": lane},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_chrome_trace(), f, ensure_ascii=False, default=str)
+
+    def summary(self) -> list[dict[str, Any]]:
+        """
+        Aggregate the durations of spans by category and name.
+        """
+        groups: dict[tuple[str, str], list[Span]] = defaultdict(list)
+        for span in self.spans:
+            groups[(span.category, span.name)].append(span)
+        rows = []
+        for (category, name), spans in sorted(groups.items()):
+            durations = sorted(span.duration for span in spans)
+            rows.append(
+                {
+                    "category": category,
+                    "name": name,
+                    "count": len(durations),
+                    "total": sum(durations),
+                    "mean": sum(durations) / len(durations),
+                    "p50": percentile(durations, 50),
+                    "p99": percentile(durations, 99),
+                    "max": durations[-1],
+                    "tokens": sum(
+                        span.attrs.get("prompt_tokens", 0)
+                        + span.attrs.get("completion_tokens", 0)
+                        for span in spans
+                    ),
+                }
+            )
+        return rows
+
+    def breakdown(self) -> dict[str, dict[str, float]]:
+        """
+        Get the seconds spent in queueing, LLM requests and local CPU work per document.
+        """
+        result: dict[str, dict[str, float]] = defaultdict(
+            lambda: {"queue": 0.0, "llm": 0.0, "cpu": 0.0}
+        )
+        for span in self.spans:
+            if span.category in ("queue", "llm", "cpu"):
+                document = span.attrs.get("document", "unknown")
+                result[document][span.category] += span.duration
+        return dict(result)
+
+    def summary_table(self) -> str:
+        header = f"{'category':<8} {'name':<24} {'count':>6} {'total(s)':>9} {'mean(s)':>8} {'p50(s)':>8} {'p99(s)':>8} {'max(s)':>8} {'tokens':>9}"
+        lines = [header, "-" * len(header)]
+        for row in self.summary():
+            lines.append(
+                f"{row['category']:<8} {row['name']:<24} {row['count']:>6} {row['total']:>9.3f} "
+                f"{row['mean']:>8.3f} {row['p50']:>8.3f} {row['p99']:>8.3f} {row['max']:>8.3f} {row['tokens']:>9}"
+            )
+        return "\n".join(lines)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Get the q-th percentile of sorted values by nearest rank.
+    """
+    if len(values) == 0:
+        return 0.0
+    rank = math.ceil(q / 100 * len(values))
+    return values[min(len(values) - 1, max(0, rank - 1))]
+
+
+_tracer: ContextVar[Optional[Tracer]] = ContextVar("tracer", default=None)
+_inherited: ContextVar[dict[str, Any]] = ContextVar("inherited", default={})
+
+
+@contextmanager
+def trace(tracer: Optional[Tracer] = None) -> Iterator[Tracer]:
+    """
+    Record the spans of everything run in this context, including the tasks it creates.
+    """
+    if tracer is None:
+        tracer = Tracer()
+    token = _tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _tracer.reset(token)
+
+
+def _lane() -> str:
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return task.get_name()
+    return threading.current_thread().name
+
+
+@contextmanager
+def span(name: str, category: str = "stage", **attrs) -> Iterator[Optional[Span]]:
+    """
+    Time the enclosed block as a span of the active tracer, does nothing if no tracer is active.
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        yield None
+        return
+    inherited = _inherited.get()
+    current = Span(
+        name=name,
+        category=category,
+        start=time.perf_counter(),
+        lane=_lane(),
+        attrs={**inherited, **attrs},
+    )
+    token = _inherited.set(
+        {**inherited, **{k: v for k, v in attrs.items() if k in INHERITED_ATTRS}}
+    )
+    try:
+        yield current
+    except BaseException as e:
+        current.attrs["error"] = repr(e)
+        raise
+    finally:
+        _inherited.reset(token)
+        current.end = time.perf_counter()
+        tracer.add(current)
+
+
+def instant(name: str, category: str = "stage", **attrs):
+    """
+    Record an instantaneous event, such as a retry, to the active tracer.
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        return
+    now = time.perf_counter()
+    tracer.add(
+        Span(
+            name=name,
+            category=category,
+            start=now,
+            end=now,
+            lane=_lane(),
+            attrs={**_inherited.get(), **attrs},
+        )
+    )
@@ -0,0 +1,136 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Iterator, Optional
+
+
+@dataclass
+class Usage:
+    """
+    Token usage and latency of one or more LLM requests.
+    """
+
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency: float = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def __iadd__(self, other: "Usage") -> "Usage":
+        self.requests += other.requests
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.latency += other.latency
+        return self
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "latency": round(self.latency, 3),
+            "mean_latency": (
+                round(self.latency / self.requests, 3) if self.requests else 0.0
+            ),
+        }
+
+
+class UsageTracker:
+    """
+    Per-model usage of the LLM calls made inside a `track_usage` block.
+    """
+
+    def __init__(self):
+        self.models: dict[str, Usage] = defaultdict(Usage)
+        self.start = time.perf_counter()
+        self.elapsed: Optional[float] = None
+
+    def record(self, model: str, usage: Usage):
+        self.models[model] += usage
+
+    @property
+    def total(self) -> Usage:
+        total = Usage()
+        for usage in self.models.values():
+            total += usage
+        return total
+
+    def summary(self) -> dict[str, Any]:
+        elapsed = self.elapsed
+        if elapsed is None:
+            elapsed = time.perf_counter() - self.start
+        return {
+            "models": {model: usage.summary() for model, usage in self.models.items()},
+            "total": self.total.summary(),
+            "wall_time": round(elapsed, 3),
+        }
+
+
+_trackers: ContextVar[tuple[UsageTracker, ...]] = ContextVar("trackers", default=())
+_last_usage: ContextVar[Optional[Usage]] = ContextVar("last_usage", default=None)
+
+
+@contextmanager
+def track_usage() -> Iterator[UsageTracker]:
+    """
+    Collect the usage of every LLM call made in this context, including the tasks it creates.
+
+    Example:
+        with track_usage() as tracker:
+            document = await Document.from_markdown(...)
+        print(tracker.summary())
+    """
+    tracker = UsageTracker()
+    token = _trackers.set(_trackers.get() + (tracker,))
+    try:
+        yield tracker
+    finally:
+        tracker.elapsed = time.perf_counter() - tracker.start
+        _trackers.reset(token)
+
+
+def record_usage(model: str, usage: Any, latency: float) -> Optional[Usage]:
+    """
+    Record the `usage` block of a completion to the active trackers.
+
+    Args:
+        model (str): The model name.
+        usage (CompletionUsage | dict | None): The usage returned by the API.
+        latency (float): The request latency in seconds.
+
+    Returns:
+        Optional[Usage]: The usage of this request, None if the API did not return token counts.
+    """
+    if isinstance(usage, dict):
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+    else:
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+    result = Usage(
+        requests=1,
+        prompt_tokens=prompt_tokens or 0,
+        completion_tokens=completion_tokens or 0,
+        latency=latency,
+    )
+    for tracker in _trackers.get():
+        tracker.record(model, result)
+    if prompt_tokens is None:
+        result = None
+    _last_usage.set(result)
+    return result
+
+
+def pop_last_usage() -> Optional[Usage]:
+    """
+    Get and clear the usage of the latest LLM call awaited in the current context.
+    """
+    usage = _last_usage.get()
+    _last_usage.set(None)
+    return usage
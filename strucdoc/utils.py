@@ -1,19 +1,31 @@
 import json
 import logging
 import os
+import threading
 import traceback
+from collections import OrderedDict
+from dataclasses import dataclass
 from enum import Enum, auto
 from itertools import product
-from typing import Any
+from typing import Any, Optional
 
 import json_repair
 import Levenshtein
+import tiktoken
 from bs4 import BeautifulSoup
 from html2image import Html2Image
 from mistune import html as markdown
 from PIL import Image as PILImage
 from tenacity import RetryCallState, retry, stop_after_attempt, wait_fixed
 
+from .tracing import instant
+
+ENCODING = tiktoken.encoding_for_model("gpt-4o")
+
+
+def count_tokens(text: str) -> int:
+    return len(ENCODING.encode(text, disallowed_special=()))
+
 
 class Language(Enum):
     LATIN = auto()
@@ -85,6 +97,21 @@ def tenacity_log(retry_state: RetryCallState) -> None:
     traceback.print_tb(retry_state.outcome.exception().__traceback__)
 
 
+def tenacity_trace(retry_state: RetryCallState) -> None:
+    """
+    Record a retry to the active tracer.
+
+    Args:
+        retry_state (RetryCallState): The retry state.
+    """
+    instant(
+        "retry",
+        function=retry_state.fn.__qualname__,
+        attempt=retry_state.attempt_number,
+        error=repr(retry_state.outcome.exception()),
+    )
+
+
 def get_json_from_response(response: str) -> dict[str, Any]:
     """
     Extract JSON from a text response.
@@ -135,10 +162,22 @@ def get_json_from_response(response: str) -> dict[str, Any]:
     raise Exception("JSON not found in the given output", response)
 
 
+def retry_unless_disabled(retry_state: RetryCallState) -> bool:
+    """
+    Retry failed calls, except those made with `retry=False`, such as a cheaper model whose failures escalate.
+    """
+    return retry_state.outcome.failed and retry_state.kwargs.get("retry", True)
+
+
 # Create a tenacity decorator with custom settings
 def tenacity_decorator(_func=None, *, wait: int = 3, stop: int = 5):
     def decorator(func):
-        return retry(wait=wait_fixed(wait), stop=stop_after_attempt(stop))(func)
+        return retry(
+            wait=wait_fixed(wait),
+            stop=stop_after_attempt(stop),
+            retry=retry_unless_disabled,
+            before_sleep=tenacity_trace,
+        )(func)
 
     if _func is None:
         # Called with arguments
@@ -204,6 +243,125 @@ def markdown_table_to_image(markdown_text: str, output_path: str):
     return output_path
 
 
+@dataclass
+class ImageFile:
+    path: str
+    size: int
+    mtime: float
+
+
+class ImageIndex:
+    """
+    A one-time `os.scandir` index of an image directory and its subdirectories.
+
+    Files are looked up by their absolute path, by their path relative to the directory or by a unique basename,
+    saving a stat call per lookup on slow or network filesystems.
+    """
+
+    def __init__(self, image_dir: str):
+        self.image_dir = image_dir
+        self.files: dict[str, ImageFile] = {}
+        self.basenames: dict[str, Optional[ImageFile]] = {}
+        # The modification times of the scanned directories, which change when files are added or removed
+        self.dir_mtimes: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._scan(image_dir)
+
+    def _scan(self, directory: str):
+        self.dir_mtimes[os.path.abspath(directory)] = os.stat(directory).st_mtime
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    self._scan(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    self._insert(ImageFile(entry.path, stat.st_size, stat.st_mtime))
+
+    def _insert(self, image_file: ImageFile):
+        path = os.path.normpath(os.path.abspath(image_file.path))
+        new = path not in self.files
+        self.files[path] = image_file
+        basename = pbasename(path)
+        if basename not in self.basenames:
+            self.basenames[basename] = image_file
+        elif new:
+            # A basename shared by several files cannot identify one of them
+            self.basenames[basename] = None
+        elif self.basenames[basename] is not None:
+            self.basenames[basename] = image_file
+
+    def add(self, path: str):
+        """
+        Register a file created after the scan, such as a rendered table.
+        """
+        stat = os.stat(path)
+        with self._lock:
+            self._insert(ImageFile(path, stat.st_size, stat.st_mtime))
+            directory = pdirname(os.path.abspath(path))
+            if directory in self.dir_mtimes:
+                self.dir_mtimes[directory] = os.stat(directory).st_mtime
+
+    def is_current(self) -> bool:
+        """
+        Whether no file was added to or removed from the scanned directories since the scan.
+        """
+        try:
+            return all(
+                os.stat(directory).st_mtime == mtime
+                for directory, mtime in self.dir_mtimes.items()
+            )
+        except FileNotFoundError:
+            return False
+
+    def resolve(self, path: str) -> Optional[str]:
+        """
+        Find an image by its path relative to the directory, its path or, as a last resort, its basename.
+
+        Indexed paths are found without a stat call, only a path missing from the index is checked on disk.
+
+        Returns:
+            Optional[str]: The indexed path if it is relative to the directory, `path` itself if it is indexed or exists,
+            the indexed path if only its basename matches a single indexed file, None if the image is not found.
+        """
+        if not os.path.isabs(path):
+            image_file = self.files.get(
+                os.path.normpath(os.path.abspath(os.path.join(self.image_dir, path)))
+            )
+            if image_file is not None:
+                return image_file.path
+        if os.path.normpath(os.path.abspath(path)) in self.files or pexists(path):
+            return path
+        image_file = self.basenames.get(pbasename(path))
+        return image_file.path if image_file is not None else None
+
+
+IMAGE_INDEX_CACHE_SIZE = 8
+_image_indexes: OrderedDict[str, ImageIndex] = OrderedDict()
+_image_indexes_lock = threading.Lock()
+
+
+def image_index(image_dir: str, revalidate: bool = False) -> ImageIndex:
+    """
+    Get the shared index of an image directory.
+
+    With `revalidate`, the index is scanned again if files were added to or removed from the directory since,
+    which stats every scanned directory, so only revalidate after a lookup missed.
+    """
+    key = os.path.abspath(image_dir)
+    with _image_indexes_lock:
+        index = _image_indexes.get(key)
+        if index is not None:
+            _image_indexes.move_to_end(key)
+    if index is not None and (not revalidate or index.is_current()):
+        return index
+    index = ImageIndex(image_dir)
+    with _image_indexes_lock:
+        _image_indexes[key] = index
+        while len(_image_indexes) > IMAGE_INDEX_CACHE_SIZE:
+            _image_indexes.popitem(last=False)
+    return index
+
+
 def package_join(*paths: str) -> str:
     """
     Join paths with the appropriate separator for the platform.
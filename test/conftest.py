@@ -0,0 +1,20 @@
+import pytest
+from PIL import Image
+from scripted import ScriptedLLM
+
+
+@pytest.fixture
+def scripted_llm():
+    """
+    Create fresh scripted models, each counting its own requests.
+    """
+    return lambda: ScriptedLLM(model="scripted", api_key="test")
+
+
+@pytest.fixture
+def image_dir(tmp_path) -> str:
+    """
+    A directory with the figure referenced by the test documents.
+    """
+    Image.new("RGB", (32, 32), "white").save(tmp_path / "figure.png")
+    return str(tmp_path)
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import re
+import time
+
+from openai.types.chat import ChatCompletion
+
+from strucdoc import AsyncLLM
+
+MARKDOWN = """# Introduction
+
+![](figure.png)
+
+The figure above shows the overall pipeline of the method.
+
+# Method
+
+We split the document by its headings and extract every chunk in parallel.
+"""
+
+STEPS = ["Split", "Extract", "Merge"]
+LONG_MARKDOWN = MARKDOWN[: MARKDOWN.find("We split")] + "".join(
+    f"\n## {step}\n\n" + "words " * 100 + "\n" for step in STEPS
+)
+
+
+def respond(prompt: str, response_format) -> str:
+    if isinstance(response_format, type):
+        headings = re.findall(r"■ <title>(.*?)</title>", prompt)
+        return json.dumps({"headings": [f"# {heading}" for heading in headings]})
+    if response_format is not None and response_format["title"] == "Sections":
+        return json.dumps(
+            {
+                "metadata": {"title": "Structuring documents"},
+                "sections": [
+                    {
+                        "title": title,
+                        "summary": f"summary of {title}",
+                        "blocks": [{"title": title, "content": "content"}],
+                    }
+                    for title in ["Introduction", "Method"]
+                ],
+            }
+        )
+    if response_format is not None:
+        heading = re.search(r"^# (.*)$", prompt, re.MULTILINE)
+        title = heading.group(1) if heading else "Introduction"
+        subtitle = re.search(r"^## (.*)$", prompt, re.MULTILINE)
+        return json.dumps(
+            {
+                "metadata": {"title": "Structuring documents"},
+                "title": title,
+                "summary": f"summary of {title}",
+                "blocks": [
+                    {
+                        "title": subtitle.group(1) if subtitle else title,
+                        "content": "content",
+                    }
+                ],
+            }
+        )
+    if "summary of each section" in prompt:
+        titles = re.findall(r"^Section \d+: (.*)$", prompt, re.MULTILINE)
+        return json.dumps({"summaries": [f"summary of {title}" for title in titles]})
+    if "title and summary of the whole section" in prompt:
+        return json.dumps({"title": "Method", "summary": "summary of the method"})
+    if "metadata" in prompt:
+        return json.dumps({"title": "Structuring documents"})
+    return "Diagram: the overall pipeline"
+
+
+class ScriptedLLM(AsyncLLM):
+    calls: int = 0
+    fail_on: str = None
+    heading_delay: float = 0.0
+    delay: float = 0.0
+    # The requests in flight, and their maximum
+    active: int = 0
+    max_active: int = 0
+
+    async def __call__(self, content, *args, **kwargs):
+        if self.fail_on is not None and self.fail_on in content:
+            raise RuntimeError("server went away")
+        return await super().__call__(content, *args, **kwargs)
+
+    async def _create(self, messages, response_format=None, **client_kwargs):
+        self.calls += 1
+        prompt = messages[-1]["content"][0]["text"]
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            if isinstance(response_format, type):
+                await asyncio.sleep(self.heading_delay)
+        finally:
+            self.active -= 1
+        return ChatCompletion(
+            id=f"chatcmpl-{self.calls}",
+            object="chat.completion",
+            created=int(time.time()),
+            model=self.model,
+            choices=[
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {
+                        "role": "assistant",
+                        "content": respond(prompt, response_format),
+                    },
+                }
+            ],
+        )
@@ -0,0 +1,195 @@
+import json
+import time
+
+from openai.types.chat import ChatCompletion
+from PIL import Image
+
+from strucdoc import Agent, AsyncLLM
+from strucdoc.agent import (
+    IMAGE_PLACEHOLDER,
+    argument_tokens,
+    message_tokens,
+    reset_route_stats,
+    route_stats,
+)
+
+CONFIG = {
+    "use_model": "language",
+    "system_prompt": "You are a tester.",
+    "jinja_args": ["text"],
+    "template": "{{ text }}",
+}
+
+
+class RecordingLLM(AsyncLLM):
+    requests: list = []
+
+    async def _create(self, messages, response_format=None, **client_kwargs):
+        self.requests.append(messages)
+        return ChatCompletion(
+            id=f"chatcmpl-{len(self.requests)}",
+            object="chat.completion",
+            created=int(time.time()),
+            model=self.model,
+            choices=[
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {
+                        "role": "assistant",
+                        "content": f"answer {len(self.requests)}",
+                    },
+                }
+            ],
+        )
+
+
+async def test_history_compaction(tmp_path):
+    Image.new("RGB", (64, 64), "white").save(tmp_path / "figure.png")
+    llm = RecordingLLM(model="recording", api_key="test")
+    llm.requests = []
+    agent = Agent("tester", {"language": llm}, config=CONFIG, record_cost=True)
+
+    for i in range(3):
+        await agent(images=[str(tmp_path / "figure.png")], recent=2, text=f"look {i}")
+    messages = llm.requests[-1]
+    # system, two history turns of user and assistant, then the prompt
+    assert len(messages) == 6
+    assert messages[1]["content"][1] == {"type": "text", "text": IMAGE_PLACEHOLDER}
+    assert messages[-1]["content"][1]["type"] == "image_url"
+    history_tokens = message_tokens(messages[1:5])
+
+    # A budget for one turn only keeps the latest one
+    agent.history_tokens = history_tokens // 2
+    await agent(recent=2, text="look 3")
+    assert [m["content"][0]["text"] for m in llm.requests[-1][1:-1:2]] == ["look 2"]
+
+
+async def test_retry_sends_latest_attempt():
+    llm = RecordingLLM(model="recording", api_key="test")
+    llm.requests = []
+    agent = Agent("tester", {"language": llm}, config=CONFIG)
+    turn_id, _ = await agent(text="extract")
+    for i in range(1, 4):
+        await agent.retry(f"feedback {i}", "traceback", turn_id, i)
+    messages = llm.requests[-1]
+    assert [m["role"] for m in messages] == ["system", "user", "assistant", "user"]
+    assert messages[0]["content"][0]["text"] == "You are a tester."
+    assert messages[1]["content"][0]["text"] == "extract"
+    assert messages[2]["content"] == "answer 3"
+    assert "feedback 3" in messages[3]["content"][0]["text"]
+
+
+async def test_history_store(tmp_path):
+    Image.new("RGB", (64, 64), "white").save(tmp_path / "figure.png")
+    llm = RecordingLLM(model="recording", api_key="test")
+    llm.requests = []
+    agent = Agent(
+        "tester",
+        {"language": llm},
+        config={**CONFIG, "max_history_turns": 3},
+        history_dir=str(tmp_path),
+    )
+    turn_id, _ = await agent(images=[str(tmp_path / "figure.png")], text="look")
+    turn = agent.history[0]
+    assert turn.message[0]["content"][1] == {
+        "type": "image_ref",
+        "path": str(tmp_path / "figure.png"),
+    }
+    # The retry reads the image of the original prompt back from its file
+    await agent.retry("feedback", "traceback", turn_id, 1)
+    assert llm.requests[-1][1]["content"][1] == llm.requests[0][1]["content"][1]
+
+    for i in range(3):
+        await agent(text=f"turn {i}")
+    assert [(t.id, t.retry) for t in agent.history] == [(1, -1), (2, -1), (3, -1)]
+    assert agent.next_turn_id == 4 and agent.cost_summary()["turns"] == 5
+    with open(tmp_path / "tester.jsonl") as f:
+        spilled = [json.loads(line) for line in f]
+    assert [(t["id"], t["retry"]) for t in spilled] == [(0, -1), (0, 1)]
+
+
+class FixedLLM(AsyncLLM):
+    content: str = ""
+    calls: int = 0
+
+    async def _create(self, messages, response_format=None, **client_kwargs):
+        self.calls += 1
+        return ChatCompletion(
+            id=f"chatcmpl-{self.calls}",
+            object="chat.completion",
+            created=int(time.time()),
+            model=self.model,
+            choices=[
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": self.content},
+                }
+            ],
+            usage={"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+        )
+
+
+async def test_cascade_routing():
+    reset_route_stats()
+    fast = FixedLLM(model="fast", api_key="test")
+    strong = FixedLLM(model="strong", api_key="test")
+    strong.content = '{"answer": "strong"}'
+    config = {
+        **CONFIG,
+        "return_json": True,
+        "cascade": [{"use_model": "fast", "max_input_tokens": 100}],
+    }
+    agent = Agent("tester", {"language": strong, "fast": fast}, config=config)
+    validate = lambda response: "answer" in response  # noqa: E731
+
+    fast.content = '{"answer": "fast"}'
+    assert (await agent(text="short", validate=validate))[1] == {"answer": "fast"}
+    fast.content = '{"wrong": "fast"}'
+    assert (await agent(text="short", validate=validate))[1] == {"answer": "strong"}
+    fast.content = "not json"
+    assert (await agent(text="short"))[1] == {"answer": "strong"}
+    # Too long for the fast route
+    assert (await agent(text="long " * 200))[1] == {"answer": "strong"}
+
+    assert (fast.calls, strong.calls) == (3, 3)
+    stats = route_stats()
+    assert stats["tester:fast"]["calls"] == 3
+    assert stats["tester:fast"]["accepted"] == 1
+    assert stats["tester:language"]["calls"] == 3
+
+    # The usage of an escalated turn includes the request to the cheaper model
+    agent = Agent(
+        "tester", {"language": strong, "fast": fast}, config=config, record_cost=True
+    )
+    await agent(text="short", validate=validate)
+    summary = agent.cost_summary()
+    assert (summary["requests"], summary["prompt_tokens"]) == (2, 20)
+
+    # Without the fast model in the mapping, the role only uses its own model
+    assert Agent("tester", {"language": strong}, config=config).routes == []
+
+
+class FailingLLM(FixedLLM):
+    async def _create(self, messages, response_format=None, **client_kwargs):
+        self.calls += 1
+        raise RuntimeError("overloaded")
+
+
+async def test_cascade_escalates_without_retries():
+    fast = FailingLLM(model="fast", api_key="test")
+    strong = FixedLLM(model="strong", api_key="test")
+    strong.content = '{"answer": "strong"}'
+    config = {**CONFIG, "return_json": True, "cascade": [{"use_model": "fast"}]}
+    agent = Agent("tester", {"language": strong, "fast": fast}, config=config)
+    start = time.perf_counter()
+    assert (await agent(text="short"))[1] == {"answer": "strong"}
+    # The failing cheaper model is called once, not through its retries
+    assert fast.calls == 1 and time.perf_counter() - start < 1
+
+
+def test_argument_tokens():
+    chunks = ["# Method\n\nWe split the document.", "# Results\n\nIt works."]
+    assert argument_tokens(chunks) == sum(argument_tokens(chunk) for chunk in chunks)
+    assert argument_tokens(chunks) < argument_tokens(str(chunks))
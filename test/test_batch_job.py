@@ -0,0 +1,115 @@
+import json
+
+from PIL import Image
+
+from strucdoc import AsyncLLM, BatchJob, LocalBatchService, track_usage
+from strucdoc.element import Media
+
+MARKDOWN = """# Introduction
+
+Large language models are used to structure documents into sections.
+
+![](figure.png)
+
+The figure above shows the overall pipeline of the method.
+
+# Method
+
+We split the document by its headings and extract every chunk in parallel.
+"""
+
+
+async def responder(body: dict) -> str:
+    response_format = body.get("response_format", {}).get("json_schema", {})
+    if response_format.get("name") == "LogicHeadings":
+        return json.dumps({"headings": ["# Introduction", "# Method"]})
+    if response_format.get("name") == "Section":
+        prompt = body["messages"][-1]["content"][0]["text"]
+        title = "Method" if "# Method" in prompt else "Introduction"
+        return json.dumps(
+            {
+                "metadata": {"title": "Structuring documents"},
+                "title": title,
+                "summary": f"summary of {title}",
+                "blocks": [{"title": title, "content": "content"}],
+            }
+        )
+    if "metadata" in body["messages"][-1]["content"][0]["text"]:
+        return json.dumps({"title": "Structuring documents"})
+    return "Diagram: the overall pipeline"
+
+
+async def test_batch_job_rounds(tmp_path):
+    Image.new("RGB", (32, 32), "white").save(tmp_path / "figure.png")
+    llm = AsyncLLM(model="batch-model", api_key="test")
+    job = BatchJob(str(tmp_path / "workdir"), llm, llm)
+    job.add("paper", MARKDOWN, str(tmp_path))
+    service = LocalBatchService(responder)
+
+    rounds = []
+    while (request_path := await job.prepare()) is not None:
+        with open(request_path) as f:
+            rounds.append([json.loads(line) for line in f])
+        result_path = str(tmp_path / f"results_{len(rounds)}.jsonl")
+        await service.process(request_path, result_path)
+        job.ingest(result_path)
+
+    # headings -> chunk extraction -> captions and metadata merge
+    assert [len(requests) for requests in rounds] == [1, 2, 2]
+    assert rounds[0][0]["url"] == "/v1/chat/completions"
+    document = job.documents["paper"]
+    assert [section.title for section in document.blocks] == ["Introduction", "Method"]
+    assert next(document.iter_medias()).caption == "Diagram: the overall pipeline"
+    assert document.metadata["title"] == "Structuring documents"
+
+    # results are persisted, a new job over the same work directory needs no requests
+    job = BatchJob(str(tmp_path / "workdir"), llm, llm)
+    job.add("paper", MARKDOWN, str(tmp_path))
+    assert await job.prepare() is None
+    assert "paper" in job.documents
+
+
+async def test_batch_job_gives_up(tmp_path):
+    Image.new("RGB", (32, 32), "white").save(tmp_path / "figure.png")
+    llm = AsyncLLM(model="batch-model", api_key="test")
+    job = BatchJob(str(tmp_path / "workdir"), llm, llm, max_attempts=2)
+    job.add("paper", MARKDOWN, str(tmp_path))
+    job.add("broken", MARKDOWN.replace("# Method", "# Broken method"), str(tmp_path))
+
+    async def failing(body: dict) -> str:
+        if "# Broken method" in json.dumps(body) and "LogicHeadings" not in str(
+            body.get("response_format")
+        ):
+            raise ValueError("context length exceeded")
+        return await responder(body)
+
+    # The request failing every round is given up on instead of being issued forever
+    documents = await job.run(LocalBatchService(failing), poll_interval=0)
+    assert list(documents) == ["paper"]
+    assert "context length exceeded" in job.failed["broken"]
+    with open(tmp_path / "workdir" / "attempts.json") as f:
+        assert max(json.load(f).values()) == 2
+
+
+async def test_batch_job_keeps_state_between_rounds(tmp_path, monkeypatch):
+    Image.new("RGB", (32, 32), "white").save(tmp_path / "figure.png")
+    llm = AsyncLLM(model="batch-model", api_key="test")
+    job = BatchJob(str(tmp_path / "workdir"), llm, llm)
+    job.add("paper", MARKDOWN, str(tmp_path))
+    assert job.language_model.batch is not None
+
+    parses = []
+    parse = Media.parse
+
+    def counting_parse(self, image_dir):
+        parses.append(self)
+        return parse(self, image_dir)
+
+    monkeypatch.setattr(Media, "parse", counting_parse)
+    with track_usage() as tracker:
+        await job.run(LocalBatchService(responder), poll_interval=0)
+
+    # every media is parsed once and every answered request is counted once
+    assert len(parses) == 1
+    assert tracker.total.requests == 5
+    assert "paper" in job.documents
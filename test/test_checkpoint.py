@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+from scripted import MARKDOWN
+
+from strucdoc import Document
+from strucdoc.checkpoint import Checkpoint
+
+
+async def test_resume_from_checkpoint(tmp_path, scripted_llm, image_dir):
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    llm = scripted_llm()
+    llm.fail_on = "# Method"
+    with pytest.raises(Exception):
+        await Document.from_markdown(
+            MARKDOWN,
+            llm,
+            llm,
+            image_dir,
+            max_at_once=1,
+            checkpoint_dir=checkpoint_dir,
+        )
+    # the headings, the introduction section and its caption survived the failure
+    assert llm.calls == 3
+
+    llm = scripted_llm()
+    document = await Document.from_markdown(
+        MARKDOWN, llm, llm, image_dir, checkpoint_dir=checkpoint_dir
+    )
+    # only the method section and the metadata merge are requested again
+    assert llm.calls == 2
+    assert [section.title for section in document.blocks] == ["Introduction", "Method"]
+    assert next(document.iter_medias()).caption == "Diagram: the overall pipeline"
+
+    llm = scripted_llm()
+    await Document.from_markdown(
+        MARKDOWN, llm, llm, image_dir, checkpoint_dir=checkpoint_dir
+    )
+    assert llm.calls == 0
+
+
+async def test_checkpoint_writes(tmp_path, scripted_llm, image_dir, monkeypatch):
+    writes = []
+    save = Checkpoint.save
+
+    def recording_save(self, key, value):
+        writes.append((key, threading.current_thread()))
+        save(self, key, value)
+
+    monkeypatch.setattr(Checkpoint, "save", recording_save)
+    llm = scripted_llm()
+    markdown = MARKDOWN.replace("![](figure.png)", "![](figure.png)\n\n![](figure.png)")
+    await Document.from_markdown(
+        markdown, llm, llm, image_dir, checkpoint_dir=str(tmp_path / "checkpoint")
+    )
+    # the captions of a section are saved together, and no write blocks the loop
+    assert len([key for key, _ in writes if key.startswith("captions_")]) == 1
+    assert threading.main_thread() not in [thread for _, thread in writes]
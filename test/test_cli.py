@@ -0,0 +1,103 @@
+import json
+import os
+import queue
+
+from PIL import Image
+from scripted import MARKDOWN
+
+from strucdoc import RuleCriteria
+from strucdoc.cli import (
+    CHECKPOINT_DIRNAME,
+    Progress,
+    _serve,
+    build_parser,
+    build_rule_criteria,
+    discover,
+    format_seconds,
+)
+
+
+def test_discover_skips_completed(tmp_path):
+    for name, size in [("small", 10), ("large", 100), ("done", 50)]:
+        os.makedirs(tmp_path / "batch" / name)
+        (tmp_path / "batch" / name / "source.md").write_text("#" * size)
+    (tmp_path / "batch" / "done" / "document.json").write_text("{}")
+    os.makedirs(tmp_path / "empty")
+
+    pending, completed = discover(str(tmp_path))
+    assert [os.path.basename(d) for d in pending] == ["large", "small"]
+    assert [os.path.basename(d) for d in completed] == ["done"]
+
+    pending, completed = discover(str(tmp_path), overwrite=True)
+    assert len(pending) == 3 and len(completed) == 0
+
+
+def test_parse_arguments():
+    args = build_parser().parse_args(
+        ["parse", "docs", "--workers", "8", "--max-at-once", "4", "--model", "m"]
+    )
+    assert (args.root, args.workers, args.max_at_once, args.model) == (
+        "docs",
+        8,
+        4,
+        "m",
+    )
+    assert format_seconds(3725) == "01:02:05"
+    assert build_rule_criteria(args) is None
+    args = build_parser().parse_args(
+        ["parse", "docs", "--rule-extraction", "--rule-min-subsections", "3"]
+    )
+    assert build_rule_criteria(args) == RuleCriteria(min_subsections=3)
+
+    args = build_parser().parse_args(
+        ["worker", "/shared/queue", "--lease-seconds", "60"]
+    )
+    assert (args.queue, args.lease_seconds, args.func.__name__) == (
+        "/shared/queue",
+        60.0,
+        "run_worker",
+    )
+
+
+async def test_serve_corpus(tmp_path, scripted_llm):
+    for name, markdown in [
+        ("paper", MARKDOWN),
+        ("broken", MARKDOWN.replace("# Method", "# Broken method")),
+    ]:
+        os.makedirs(tmp_path / name)
+        (tmp_path / name / "source.md").write_text(markdown)
+        Image.new("RGB", (32, 32), "white").save(tmp_path / name / "figure.png")
+    args = build_parser().parse_args(
+        ["parse", str(tmp_path), "--checkpoint", "--docs-at-once", "2"]
+    )
+    pending, _ = discover(str(tmp_path))
+    tasks, results = queue.Queue(), queue.Queue()
+    for doc_dir in pending + [None, None]:
+        tasks.put(doc_dir)
+    llm = scripted_llm()
+    llm.fail_on = "# Broken method"
+
+    await _serve(tasks, results, llm, llm, args)
+    progress = Progress(len(pending))
+    outcomes = {}
+    while not results.empty():
+        result = results.get()
+        progress.update(result)
+        outcomes[os.path.basename(result["dir"])] = result
+    assert progress.line().endswith("1 failed") and progress.done == 2
+
+    # the parsed document is saved and its checkpoint removed
+    assert outcomes["paper"]["ok"] and outcomes["paper"]["error"] is None
+    with open(tmp_path / "paper" / "document.json") as f:
+        document = json.load(f)
+    assert document["metadata"]["title"] == "Structuring documents"
+    assert not os.path.exists(tmp_path / "paper" / CHECKPOINT_DIRNAME)
+
+    # the broken document reports its error and keeps its checkpoint for a rerun
+    assert not outcomes["broken"]["ok"]
+    assert "server went away" in outcomes["broken"]["error"]
+    assert not os.path.exists(tmp_path / "broken" / "document.json")
+    assert os.path.exists(tmp_path / "broken" / CHECKPOINT_DIRNAME)
+    pending, completed = discover(str(tmp_path))
+    assert [os.path.basename(d) for d in pending] == ["broken"]
+    assert [os.path.basename(d) for d in completed] == ["paper"]
@@ -0,0 +1,99 @@
+from PIL import Image
+
+from strucdoc import (
+    CompactDocument,
+    Document,
+    Language,
+    Media,
+    Section,
+    SubSection,
+    Table,
+)
+
+MARKDOWN = """# Results
+
+![](figure.png)
+
+The figure shows the accuracy of every method.
+
+|method|accuracy|
+|-|-|
+|ours|0.91|
+
+Our method is the most accurate on all datasets."""
+
+
+def make_document(image_dir) -> Document:
+    Image.new("RGB", (8, 8)).save(image_dir / "figure.png")
+    Image.new("RGB", (8, 8)).save(image_dir / "table.png")
+    return Document(
+        image_dir=str(image_dir),
+        blocks=[
+            Section(
+                title="Results",
+                summary="Our method is the most accurate.",
+                markdown_content=MARKDOWN,
+                language=Language.LATIN,
+                blocks=[
+                    Media(
+                        markdown_content="![](figure.png)",
+                        near_chunks=(
+                            "",
+                            "The figure shows the accuracy of every method.",
+                        ),
+                        path=str(image_dir / "figure.png"),
+                        caption="Chart: accuracy per method",
+                    ),
+                    SubSection(
+                        title="Accuracy",
+                        content="Our method is the most accurate on all datasets.",
+                    ),
+                    Table(
+                        markdown_content="|method|accuracy|\n|-|-|\n|ours|0.91|",
+                        near_chunks=(
+                            "The figure shows the accuracy of every method.",
+                            "",
+                        ),
+                        path=str(image_dir / "table.png"),
+                        cells=[["method", "accuracy"], ["ours", "0.91"]],
+                        merge_area=[],
+                    ),
+                ],
+            ),
+            Section(
+                title="Conclusion",
+                summary="Structure helps, 结构化有帮助。",
+                blocks=[SubSection(title="Summary", content="Rewritten by the model.")],
+            ),
+        ],
+        metadata={"title": "Structuring documents"},
+        language=Language.LATIN,
+    )
+
+
+def test_compact_roundtrip(tmp_path):
+    document = make_document(tmp_path)
+    compact = CompactDocument.from_document(document)
+    assert compact.to_document().dict == document.dict
+
+    results = compact.blocks[0]
+    media, subsection, table = results.blocks
+    assert media.caption == "Chart: accuracy per method"
+    assert table.caption is None
+    assert table.cells == [["method", "accuracy"], ["ours", "0.91"]]
+    assert subsection.content == "Our method is the most accurate on all datasets."
+    assert compact.blocks[1].summary == "Structure helps, 结构化有帮助。"
+    assert len(list(compact.iter_medias())) == 2
+
+    # verbatim texts point into the markdown of their section instead of being copied
+    assert (subsection.start, subsection.end) == (
+        results.spans[2] + MARKDOWN.encode().find(subsection.content.encode()),
+        results.spans[2]
+        + MARKDOWN.encode().find(subsection.content.encode())
+        + len(subsection.content.encode()),
+    )
+    assert compact.buffer.count(b"|ours|0.91|") == 1
+
+    document.save(str(tmp_path / "document.json"))
+    loaded = CompactDocument.load(str(tmp_path / "document.json"))
+    assert loaded.to_document().dict == document.dict
@@ -0,0 +1,82 @@
+from scripted import LONG_MARKDOWN, STEPS
+
+from strucdoc.doc_utils import (
+    RuleCriteria,
+    guess_top_headings,
+    pack_chunks,
+    rule_extract_section,
+    split_oversized_chunk,
+)
+
+
+def test_pack_chunks():
+    chunks = ["short " * 10, "short " * 10, "long " * 500, "short " * 10]
+    packs = pack_chunks(chunks, max_tokens=200)
+    assert packs == [chunks[:2], chunks[2:3], chunks[3:]]
+    assert sum(packs, []) == chunks
+    assert pack_chunks(chunks[:2], max_tokens=200, max_sections=1) == [
+        chunks[:1],
+        chunks[1:2],
+    ]
+
+
+def test_split_oversized_chunk():
+    chunk = LONG_MARKDOWN[LONG_MARKDOWN.find("# Method") :]
+    assert split_oversized_chunk(chunk, max_tokens=10000) == [chunk]
+    parts = split_oversized_chunk(chunk, max_tokens=150)
+    assert len(parts) == len(STEPS)
+    assert all(part.startswith("#") for part in parts)
+    assert "\n\n".join(parts).split() == chunk.split()
+
+    # A fenced code block is never split, and its comments are not headings
+    code = (
+        "```python\n# load the model\nmodel = load()\n\n# parse\n"
+        + "x = 1\n" * 50
+        + "```"
+    )
+    fenced = f"# Method\n\n{'words ' * 100}\n\n{code}\n\n## Merge\n\n{'words ' * 100}"
+    parts = split_oversized_chunk(fenced, max_tokens=150)
+    assert sum(code in part for part in parts) == 1
+    assert parts[-1].startswith("## Merge")
+
+
+def test_rule_extract_section():
+    criteria = RuleCriteria(min_subsections=2)
+    chunk = "# Method\n\nIntro.\n\n## Split\n\nSplit.\n\n![](figure.png)\n\n## Extract\n\nExtract."
+    assert rule_extract_section(chunk, criteria) == {
+        "title": "Method",
+        "summary": "",
+        "blocks": [
+            {"title": "Method", "content": "Intro."},
+            {"title": "Split", "content": "Split."},
+            {"title": "Extract", "content": "Extract."},
+        ],
+    }
+    assert rule_extract_section(chunk, RuleCriteria(min_subsections=3)) is None
+    # A sub-heading directly followed by a nested one, markup and text without a heading go to the LLM
+    assert rule_extract_section(chunk.replace("Split.", "### Nested"), criteria) is None
+    assert rule_extract_section(chunk + "\n\n<div>note</div>", criteria) is None
+    assert rule_extract_section(chunk[len("# Method\n\n") :], criteria) is None
+    code = "```python\n# load\nmodel = load()\n\n# parse\n```"
+    section = rule_extract_section(chunk.replace("Split.", code), criteria)
+    assert section["blocks"][1] == {"title": "Split", "content": code}
+    install = "Run this:\n```bash\n# install deps\npip install x\n```"
+    section = rule_extract_section(chunk.replace("Split.", install), criteria)
+    assert [block["title"] for block in section["blocks"]] == [
+        "Method",
+        "Split",
+        "Extract",
+    ]
+    assert section["blocks"][1]["content"] == install
+    # A heading with only medias has no subsection at all
+    assert (
+        rule_extract_section("# Title\n\n![](a.png)", RuleCriteria(min_subsections=0))
+        is None
+    )
+
+
+def test_guess_top_headings():
+    headings = ["# Title", "## 1. Intro", "## 2. Method", "## 2.1 Details", "### A"]
+    assert guess_top_headings(headings) == ["# Title", "## 1. Intro", "## 2. Method"]
+    assert guess_top_headings(["# A", "# B", "## C"]) == ["# A", "# B"]
+    assert guess_top_headings([]) == []
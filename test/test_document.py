@@ -1,8 +1,20 @@
 import os
 
 import pytest
+from PIL import Image
 
-from strucdoc import AsyncLLM, Document, package_join
+from strucdoc import (
+    AsyncLLM,
+    Document,
+    Language,
+    Media,
+    Section,
+    SubSection,
+    Table,
+    doc_utils,
+    package_join,
+)
+from strucdoc.utils import ImageIndex, image_index
 
 TESTDOC = package_join("..", "Example-PPTAgent-MinerU")
 language_model = AsyncLLM(
@@ -30,3 +42,138 @@ async def test_document_async():
         vision_model,
         image_dir,
     )
+
+
+def test_document_save_load(tmp_path):
+    Image.new("RGB", (8, 8)).save(tmp_path / "table.png")
+    table = Table(
+        markdown_content="|a|b|\n|-|-|\n|1|2|",
+        near_chunks=("before", "after"),
+        path=str(tmp_path / "table.png"),
+        caption="Table: numbers",
+        cells=[["a", "b"], ["1", "2"]],
+        merge_area=[],
+    )
+    section = Section(
+        title="Intro",
+        summary="An introduction.",
+        blocks=[SubSection(title="Background", content="Some text."), table],
+    )
+    document = Document(
+        image_dir=str(tmp_path),
+        blocks=[section],
+        metadata={"title": "Test"},
+        language=Language.LATIN,
+    )
+    document.save(str(tmp_path / "document.json"))
+
+    loaded = Document.load(str(tmp_path / "document.json"))
+    assert loaded.dict == document.dict
+    assert isinstance(loaded.blocks[0].blocks[1], Table)
+
+
+def test_image_index(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / "images")
+    Image.new("RGB", (16, 8)).save(tmp_path / "images" / "figure.png")
+    index = ImageIndex(str(tmp_path))
+    assert index.resolve(str(tmp_path / "images" / "figure.png")) == str(
+        tmp_path / "images" / "figure.png"
+    )
+    assert index.resolve("images/figure.png") == str(tmp_path / "images" / "figure.png")
+    assert index.resolve("elsewhere/figure.png") == str(
+        tmp_path / "images" / "figure.png"
+    )
+    assert index.resolve("missing.png") is None
+
+    # An existing path is kept even if a file of the directory has the same basename
+    os.makedirs(tmp_path / "other")
+    Image.new("RGB", (16, 8)).save(tmp_path / "other" / "figure.png")
+    assert index.resolve(str(tmp_path / "other" / "figure.png")) == str(
+        tmp_path / "other" / "figure.png"
+    )
+    # A basename shared by several files of the directory does not resolve
+    assert image_index(str(tmp_path)) is not image_index(str(tmp_path / "images"))
+    shared = image_index(str(tmp_path))
+    assert shared.resolve("elsewhere/figure.png") is None
+    assert image_index(str(tmp_path)) is shared
+    # Adding a file to a scanned directory rescans it once revalidated
+    Image.new("RGB", (16, 8)).save(tmp_path / "images" / "new.png")
+    assert image_index(str(tmp_path)) is shared
+    assert image_index(str(tmp_path), revalidate=True) is not shared
+    assert image_index(str(tmp_path)).resolve("new.png") == str(
+        tmp_path / "images" / "new.png"
+    )
+
+    media = Media(markdown_content="![](images/figure.png)", near_chunks=("", ""))
+    media.parse(str(tmp_path))
+    assert media.path == str(tmp_path / "images" / "figure.png")
+    assert (media.size, media.format) == ((16, 8), "PNG")
+    # the dimensions are cached, the image is not opened again
+    monkeypatch.setattr("strucdoc.element.Image.open", None)
+    assert media.size == (16, 8)
+
+
+def test_image_lookups_skip_stat(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / "images")
+    for i in range(20):
+        Image.new("RGB", (16, 8)).save(tmp_path / "images" / f"figure_{i}.png")
+    image_index(str(tmp_path))
+    stats = []
+    stat = os.stat
+
+    def counting_stat(path, *args, **kwargs):
+        stats.append(path)
+        return stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "stat", counting_stat)
+    for i in range(20):
+        media = Media(
+            markdown_content=f"![](images/figure_{i}.png)", near_chunks=("", "")
+        )
+        media.parse(str(tmp_path))
+        assert media.path == str(tmp_path / "images" / f"figure_{i}.png")
+    # Images relative to the directory are found in the index, without touching the filesystem
+    assert stats == []
+
+    # A miss revalidates the index, which finds the image added since the scan
+    Image.new("RGB", (16, 8)).save(tmp_path / "images" / "new.png")
+    media = Media(markdown_content="![](images/new.png)", near_chunks=("", ""))
+    media.parse(str(tmp_path))
+    assert media.path == str(tmp_path / "images" / "new.png") and len(stats) > 0
+
+
+def test_detect_languages(monkeypatch):
+    predictions = []
+
+    class CountingModel:
+        def __init__(self, model):
+            self.model = model
+
+        def predict(self, texts):
+            predictions.append(len(texts))
+            return self.model.predict(texts)
+
+    monkeypatch.setattr(doc_utils, "LID_MODEL", CountingModel(doc_utils.LID_MODEL))
+    monkeypatch.setattr(doc_utils, "LANGUAGE_CACHE", {})
+    chunks = [
+        "# 引言\n\n本文提出了一种将文档结构化的方法，并在多个数据集上进行了评估。",
+        "# 方法\n\n我们首先根据标题切分文档，然后并行地抽取每个片段。",
+        "# Appendix\n\nThe hyperparameters used in all experiments are listed below.",
+    ]
+    language, languages = doc_utils.detect_languages(chunks)
+    assert languages == [Language.CJK, Language.CJK, Language.LATIN]
+    assert language == Language.CJK
+    assert predictions == [3]
+
+    # cached chunks are not predicted again, new ones are batched together
+    doc_utils.detect_languages(chunks + ["A new section written in English."])
+    assert predictions == [3, 1]
+
+    section = Section(
+        title="Intro",
+        summary="An introduction.",
+        blocks=[SubSection(title="Background", content="Some text.")],
+        language=Language.CJK,
+    )
+    assert Section.from_dict(section.model_dump(mode="json")).language == Language.CJK
+    assert "language" not in Section.json_schema()["properties"]
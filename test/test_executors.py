@@ -0,0 +1,28 @@
+import asyncio
+import time
+
+from strucdoc.executors import LoopLagMonitor, run_cpu, run_in_thread
+from strucdoc.tracing import span, trace
+
+
+def traced_work(seconds: float) -> int:
+    with span("work", "cpu"):
+        time.sleep(seconds)
+    return 42
+
+
+async def test_offloaded_work_keeps_loop_responsive():
+    with trace() as tracer:
+        async with LoopLagMonitor(interval=0.005) as offloaded:
+            assert await run_in_thread(traced_work, 0.2) == 42
+        async with LoopLagMonitor(interval=0.005) as blocking:
+            await asyncio.sleep(0.02)
+            traced_work(0.2)
+            await asyncio.sleep(0.02)
+    assert offloaded.summary()["max"] < 100 < blocking.summary()["max"]
+    work = [s for s in tracer.spans if s.name == "work"]
+    assert len(work) == 2 and work[0].lane.startswith("strucdoc")
+
+
+async def test_run_cpu_defaults_to_threads():
+    assert await run_cpu(sorted, [3, 1, 2]) == [1, 2, 3]
@@ -0,0 +1,102 @@
+import io
+import json
+
+from PIL import Image
+
+from strucdoc import Document, Language, Media, Section, SubSection, Table
+
+
+def make_document(image_dir) -> Document:
+    Image.new("RGB", (8, 8)).save(image_dir / "figure.png")
+    Image.new("RGB", (8, 8)).save(image_dir / "table.png")
+    return Document(
+        image_dir=str(image_dir),
+        blocks=[
+            Section(
+                title="Introduction",
+                summary="Why <documents> need structure.",
+                blocks=[
+                    Media(
+                        markdown_content="![](figure.png)",
+                        near_chunks=("", ""),
+                        path=str(image_dir / "figure.png"),
+                        caption="Diagram: the pipeline",
+                    ),
+                    SubSection(title="Motivation", content="Long documents."),
+                    Table(
+                        markdown_content="|a|b|\n|-|-|\n|1|2|",
+                        near_chunks=("", ""),
+                        path=str(image_dir / "table.png"),
+                        caption="Table: numbers",
+                        cells=[["a", "b"], ["1", "2"]],
+                        merge_area=[],
+                    ),
+                ],
+            ),
+            Section(
+                title="Method",
+                summary="How it works.",
+                blocks=[SubSection(title="Splitting", content="By headings.")],
+            ),
+        ],
+        metadata={"title": "Structuring documents"},
+        language=Language.LATIN,
+    )
+
+
+def test_overview(tmp_path):
+    document = make_document(tmp_path)
+    overview = document.get_overview(include_summary=True)
+    assert overview == (
+        "Section: Introduction\n"
+        "\tSummary: Why <documents> need structure.\n"
+        "\tMedia: Diagram: the pipeline\n"
+        "\tSubsection: Motivation\n"
+        "\t\tMedia: Table: numbers\n"
+        "\n"
+        "Section: Method\n"
+        "\tSummary: How it works.\n"
+        "\tSubsection: Splitting\n"
+        "\n"
+    )
+    assert "Summary" not in document.get_overview()
+
+    document.blocks[1].title = "Approach"
+    assert "Section: Approach" in document.get_overview(include_summary=True)
+    # Replacing a section in place keeps the length of the blocks, editing the blocks of a section keeps the section
+    document.blocks[1] = document.blocks[1].model_copy(update={"title": "Results"})
+    assert "Section: Results" in document.get_overview()
+    document.blocks[1].blocks.clear()
+    assert "Splitting" not in document.get_overview()
+    document.blocks.pop()
+    assert "Results" not in document.get_overview(include_summary=True)
+
+
+def test_export(tmp_path):
+    document = make_document(tmp_path)
+
+    buffer = io.StringIO()
+    document.export(buffer, "jsonl")
+    records = [json.loads(line) for line in buffer.getvalue().splitlines()]
+    assert [record["type"] for record in records] == [
+        "metadata",
+        "section",
+        "media",
+        "subsection",
+        "table",
+        "section",
+        "subsection",
+    ]
+    assert records[4]["cells"] == [["a", "b"], ["1", "2"]]
+    assert (records[6]["section"], records[6]["block"]) == (1, 0)
+
+    document.export(str(tmp_path / "document.md"))
+    text = (tmp_path / "document.md").read_text()
+    assert text.startswith("# Structuring documents\n\n## Introduction")
+    assert "### Motivation\n\nLong documents." in text
+    assert "*Table: numbers*" in text
+
+    document.export(str(tmp_path / "document.html"))
+    html = (tmp_path / "document.html").read_text()
+    assert "Why &lt;documents&gt; need structure." in html
+    assert "<table>" in html and "<h3>Splitting</h3>" in html
@@ -0,0 +1,91 @@
+import asyncio
+import random
+
+from PIL import Image, ImageDraw
+
+from strucdoc.element import ImageDeduplicator, Media
+from strucdoc.image_hash import PerceptualIndex, hamming, image_hash
+
+
+def draw_figure(path, size=(256, 192), shape="ellipse"):
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    w, h = size
+    if shape == "ellipse":
+        draw.ellipse((w // 8, h // 8, w // 2, h // 2), fill="black")
+    else:
+        draw.rectangle((w // 2, h // 3, w - w // 8, h - h // 8), fill="navy")
+    image.save(path)
+
+
+class CountingVisionModel:
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self, prompt, image):
+        self.calls += 1
+        caption = f"Picture: caption {self.calls}"
+        await asyncio.sleep(0.01)
+        return caption
+
+
+def test_near_duplicates_are_grouped(tmp_path):
+    draw_figure(tmp_path / "logo.png")
+    draw_figure(tmp_path / "logo_copy.jpg", size=(128, 96))
+    draw_figure(tmp_path / "plot.png", shape="rectangle")
+    index = PerceptualIndex()
+    groups = [
+        index.group(image_hash(str(tmp_path / name)))
+        for name in ("logo.png", "logo_copy.jpg", "plot.png")
+    ]
+    assert groups == [0, 0, 1]
+
+
+async def test_captions_fan_out(tmp_path):
+    names = ["logo.png", "logo_copy.jpg", "plot.png"]
+    draw_figure(tmp_path / names[0])
+    draw_figure(tmp_path / names[1], size=(128, 96))
+    draw_figure(tmp_path / names[2], shape="rectangle")
+    medias = []
+    for name in names:
+        media = Media(markdown_content=f"![]({name})", near_chunks=("", ""))
+        media.parse(str(tmp_path))
+        medias.append(media)
+
+    # Hashed lazily, only when captions are deduplicated
+    assert all(media._image_hash is None for media in medias)
+    model = CountingVisionModel()
+    dedup = ImageDeduplicator()
+    await asyncio.gather(*(dedup.get_caption(media, model) for media in medias))
+    assert model.calls == 2 and dedup.deduplicated == 1
+    assert medias[0].caption == medias[1].caption != medias[2].caption
+
+
+def test_index_matches_linear_scan():
+    rng = random.Random(0)
+    bases = [(rng.getrandbits(64), rng.getrandbits(64)) for _ in range(200)]
+    hashes = []
+    for d, p in bases:
+        hashes.append((d, p))
+        flips = rng.sample(range(64), 5)
+        hashes.append(
+            (d ^ sum(1 << bit for bit in flips), p ^ sum(1 << bit for bit in flips[:3]))
+        )
+    rng.shuffle(hashes)
+
+    index, representatives = PerceptualIndex(), []
+    for hashes_ in hashes:
+        # The first representative within the distance, as a scan of all of them finds it
+        expected = next(
+            (
+                idx
+                for idx, (d, p) in enumerate(representatives)
+                if hamming(d, hashes_[0]) <= 6 and hamming(p, hashes_[1]) <= 6
+            ),
+            None,
+        )
+        if expected is None:
+            expected = len(representatives)
+            representatives.append(hashes_)
+        assert index.group(hashes_) == expected
+    assert len(index) == len(bases)
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+
+from strucdoc import job_queue
+from strucdoc.job_queue import Job, JobQueue, serve
+
+
+def test_claim_lease_and_retry(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue"), lease_seconds=0.5, max_attempts=2)
+    assert queue.submit([str(tmp_path / "a"), str(tmp_path / "b")]) == 2
+    assert queue.submit([str(tmp_path / "a")]) == 0
+
+    first, second = queue.claim("w1"), queue.claim("w2")
+    assert {first.dir, second.dir} == {str(tmp_path / "a"), str(tmp_path / "b")}
+    assert queue.claim("w3") is None
+
+    # The lease of the first job is renewed, the second one expires
+    time.sleep(0.35)
+    assert queue.heartbeat(first)
+    time.sleep(0.25)
+    assert queue.reap() == 1 and not queue.heartbeat(second)
+    queue.complete(first, {"ok": True})
+
+    # A failed job is retried until it reaches max_attempts
+    retried = queue.claim("w3")
+    assert (retried.id, retried.attempts) == (second.id, 2)
+    queue.complete(retried, {"ok": False, "error": "boom"})
+    assert queue.counts() == {"pending": 0, "claimed": 0, "done": 1, "failed": 1}
+
+
+def test_reap_during_claim(tmp_path, monkeypatch):
+    queue = JobQueue(str(tmp_path / "queue"), lease_seconds=0.2)
+    queue.submit([str(tmp_path / "a")])
+    # Older than a lease since its submission
+    time.sleep(0.3)
+    load = json.load
+
+    def reap_then_load(f):
+        reaped.append(queue.reap())
+        return load(f)
+
+    reaped = []
+    monkeypatch.setattr(job_queue.json, "load", reap_then_load)
+    # The lease starts at the rename, so a worker reaping meanwhile does not release the job
+    job = queue.claim("w1")
+    assert job is not None and reaped == [0]
+    assert queue.counts()["claimed"] == 1
+
+    # A job released in the middle of a claim is skipped instead of failing the worker
+    queue.complete(job, {"ok": False})
+    queue.lease_seconds = 0
+    assert queue.claim("w2") is None and reaped[-1] == 1
+    assert queue.counts() == {"pending": 1, "claimed": 0, "done": 0, "failed": 0}
+
+
+def process_jobs(queue_dir: str, out_dir: str):
+    async def handle(job: Job) -> dict:
+        await asyncio.sleep(0.05)
+        # Written atomically as the parse results are
+        path = os.path.join(out_dir, f"{job.id}-{os.getpid()}")
+        with open(path + ".tmp", "w") as f:
+            f.write(job.dir)
+        os.replace(path + ".tmp", path)
+        return {"ok": True}
+
+    asyncio.run(
+        serve(JobQueue(queue_dir, lease_seconds=0.5), handle, 2, poll_seconds=0.1)
+    )
+
+
+def test_workers_share_queue(tmp_path):
+    queue_dir, out_dir = str(tmp_path / "queue"), tmp_path / "out"
+    out_dir.mkdir()
+    queue = JobQueue(queue_dir, lease_seconds=0.5)
+    queue.submit(str(tmp_path / f"doc_{i}") for i in range(20))
+    # A worker that crashed while holding a job
+    crashed = queue.claim("crashed")
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=process_jobs, args=(queue_dir, str(out_dir)))
+        for _ in range(2)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    assert queue.counts() == {"pending": 0, "claimed": 0, "done": 20, "failed": 0}
+    processed = [name.split("-")[0] for name in os.listdir(out_dir)]
+    assert sorted(processed) == sorted(set(processed)) and len(processed) == 20
+    assert crashed.id in processed
+    assert len({name.split("-")[1] for name in os.listdir(out_dir)}) > 1
+
+
+def test_complete_after_lost_lease(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue"), lease_seconds=0.2, max_attempts=3)
+    queue.submit([str(tmp_path / "a")])
+    first = queue.claim("w1")
+    time.sleep(0.3)
+    assert queue.reap() == 1
+    second = queue.claim("w2")
+    assert second.attempts == 2 and second.lease != first.lease
+
+    # The first worker neither releases nor finishes the claim of the second one
+    assert not queue.heartbeat(first)
+    queue.complete(first, {"ok": False, "error": "boom"})
+    queue.complete(first, {"ok": True})
+    assert queue.counts() == {"pending": 0, "claimed": 1, "done": 0, "failed": 0}
+    assert queue.heartbeat(second)
+
+    queue.complete(second, {"ok": True})
+    assert queue.counts() == {"pending": 0, "claimed": 0, "done": 1, "failed": 0}
+    with open(tmp_path / "queue" / "done" / f"{second.id}.json") as f:
+        assert json.load(f)["attempts"] == 2
@@ -0,0 +1,149 @@
+import asyncio
+import pickle
+import time
+
+from openai.types.chat import ChatCompletion
+
+from strucdoc.llms import (
+    LLM,
+    AsyncLLM,
+    BatchDispatcher,
+    configure_http,
+    structured_output_kwargs,
+)
+from strucdoc.usage import track_usage
+
+
+class EchoSender:
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+        self.calls = []
+
+    async def __call__(self, messages, response_format=None, **kwargs):
+        self.calls.append(messages)
+        await asyncio.sleep(self.latency)
+        if messages == "boom":
+            raise ValueError("boom")
+        return messages, response_format
+
+
+async def test_batch_dispatcher_routes_results():
+    sender = EchoSender()
+    dispatcher = BatchDispatcher(sender, max_batch_size=4, batch_window=0.01)
+    results = await asyncio.gather(
+        *(dispatcher.submit(messages=f"request {i}") for i in range(10))
+    )
+    assert [r[0] for r in results] == [f"request {i}" for i in range(10)]
+    assert dispatcher.stats.requests == 10
+    assert dispatcher.stats.batches == 3
+
+
+async def test_batch_dispatcher_deduplicates_and_isolates_errors():
+    sender = EchoSender()
+    dispatcher = BatchDispatcher(sender, batch_window=0.01)
+    schema = {"title": "Answer", "type": "object"}
+    results = await asyncio.gather(
+        dispatcher.submit(messages="same", response_format=schema),
+        dispatcher.submit(messages="same", response_format=schema),
+        dispatcher.submit(messages="boom"),
+        return_exceptions=True,
+    )
+    assert results[0] == results[1] == ("same", schema)
+    assert isinstance(results[2], ValueError)
+    assert len(sender.calls) == 2
+    assert dispatcher.stats.deduplicated == 1
+
+
+async def test_batch_dispatcher_resolves_each_request():
+    async def send(messages, response_format=None):
+        await asyncio.sleep(1.0 if messages == "slow" else 0.01)
+        return messages
+
+    dispatcher = BatchDispatcher(send, batch_window=0.01)
+    slow = asyncio.ensure_future(dispatcher.submit(messages="slow"))
+    fast = asyncio.ensure_future(dispatcher.submit(messages="fast"))
+    # The fast request of the batch is not held back by the slow one
+    done, _ = await asyncio.wait([slow, fast], return_when=asyncio.FIRST_COMPLETED)
+    assert done == {fast} and fast.result() == "fast"
+    assert dispatcher.stats.batches == 1
+    slow.cancel()
+
+
+async def test_batched_usage_counted_per_request():
+    llm = PaddedLLM(model="padded", api_key="k", use_batch=True)
+    with track_usage() as usage:
+        responses = await asyncio.gather(llm("same"), llm("same"), llm("other"))
+    assert len(set(responses)) == 1
+    # The identical requests share one completion, counted once
+    assert llm.batch.stats.deduplicated == 1
+    assert (usage.total.requests, usage.total.prompt_tokens) == (2, 20)
+
+
+def test_structured_output_kwargs():
+    assert structured_output_kwargs(None) == {}
+    kwargs = structured_output_kwargs({"title": "Section", "type": "object"})
+    assert kwargs["response_format"]["json_schema"]["name"] == "Section"
+
+
+async def test_llms_share_connection_pool():
+    language = AsyncLLM(model="a", base_url="http://127.0.0.1:1/v1", api_key="k")
+    vision = AsyncLLM(model="b", base_url="http://127.0.0.1:1/v1", api_key="k")
+    other = AsyncLLM(model="a", base_url="http://127.0.0.1:2/v1", api_key="k")
+    copied = pickle.loads(pickle.dumps(language))
+    assert language.client is vision.client is copied.client
+    assert language.client._client is not other.client._client
+
+
+async def test_replaced_clients_closed():
+    llm = AsyncLLM(model="a", base_url="http://127.0.0.1:1/v1", api_key="k")
+    sync_llm = LLM(model="a", base_url="http://127.0.0.1:1/v1", api_key="k")
+    async_client, sync_client = llm.client, sync_llm.client
+    configure_http()
+    assert sync_client.is_closed()
+    for _ in range(10):
+        await asyncio.sleep(0)
+    assert async_client.is_closed()
+    assert not llm.client.is_closed() and llm.client is not async_client
+
+
+def test_loop_clients_closed_on_shutdown():
+    async def get_client():
+        return AsyncLLM(model="a", base_url="http://127.0.0.1:1/v1", api_key="k").client
+
+    client = asyncio.run(get_client())
+    assert client.is_closed()
+
+
+class PaddedLLM(AsyncLLM):
+    async def _create(self, messages, response_format=None, **client_kwargs):
+        await asyncio.sleep(0.01)
+        return ChatCompletion(
+            id="chatcmpl-padded",
+            object="chat.completion",
+            created=int(time.time()),
+            model=self.model,
+            choices=[
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": PADDED},
+                }
+            ],
+            usage={"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+        )
+
+
+PADDED = '\n  {"answer": 42}  \n'
+
+
+async def test_async_post_process_matches_sync():
+    llm = PaddedLLM(model="padded", api_key="k")
+    sync = LLM(model="padded", api_key="k")
+    for return_json in [False, True]:
+        response, message = await llm(
+            "question", return_json=return_json, return_message=True
+        )
+        expected = sync.__post_process__(PADDED, [], return_json)
+        assert response == expected
+        assert message[-1] == {"role": "assistant", "content": PADDED}
+    assert await llm("question") == '{"answer": 42}'
@@ -0,0 +1,210 @@
+import asyncio
+import time
+
+from scripted import LONG_MARKDOWN, MARKDOWN, STEPS
+
+from strucdoc import Document, Section, SubSection, configure_executors
+from strucdoc.doc_utils import RuleCriteria
+from strucdoc.element import Table
+
+
+async def test_packed_extraction(scripted_llm, image_dir):
+    llm = scripted_llm()
+    document = await Document.from_markdown(
+        MARKDOWN, llm, llm, image_dir, pack_tokens=2048
+    )
+    # headings, one request for both sections, the caption and the metadata merge
+    assert llm.calls == 4
+    assert [section.title for section in document.blocks] == ["Introduction", "Method"]
+    assert document.metadata["title"] == "Structuring documents"
+
+
+async def test_map_reduce_extraction(scripted_llm, image_dir):
+    llm = scripted_llm()
+    document = await Document.from_markdown(
+        LONG_MARKDOWN, llm, llm, image_dir, map_tokens=150
+    )
+    # headings, the introduction, three parts and their reduce, the caption and the metadata merge
+    assert llm.calls == 8
+    method = document.blocks[1]
+    assert method.title == "Method"
+    assert method.summary == "summary of the method"
+    assert [block.title for block in method.blocks] == STEPS
+    assert method.markdown_content.startswith("# Method")
+
+    # Every part takes a slot of max_at_once, and the reduce goes to the cheaper model
+    llm, fast = scripted_llm(), scripted_llm()
+    llm.delay = 0.05
+    document = await Document.from_markdown(
+        LONG_MARKDOWN,
+        llm,
+        llm,
+        image_dir,
+        max_at_once=1,
+        map_tokens=150,
+        fast_model=fast,
+    )
+    assert llm.max_active == 1
+    assert document.blocks[1].summary == "summary of the method"
+    # the introduction, three parts and their reduce
+    assert fast.calls == 5
+
+
+RULE_MARKDOWN = MARKDOWN + """
+## Split
+
+Headings separate the sections.
+Lines of a paragraph stay together.
+
+## Extract
+
+Every chunk is extracted in parallel.
+
+# Results
+
+The structure improves retrieval and question answering on every evaluated dataset.
+"""
+
+
+async def test_summarize_sections(scripted_llm):
+    llm = scripted_llm()
+    extracted = Section(
+        title="Method",
+        summary="extracted summary",
+        blocks=[SubSection(title="Split", content="content")],
+        markdown_content="# Method",
+    )
+    built = Section(
+        title="Results",
+        summary="",
+        blocks=[SubSection(title="Results", content="content")],
+        markdown_content="# Results",
+    )
+    # A summary already extracted, e.g. loaded from a checkpoint, is kept
+    await Document._summarize_sections([extracted, built], llm)
+    assert (extracted.summary, built.summary) == (
+        "extracted summary",
+        "summary of Results",
+    )
+    assert llm.calls == 1
+
+
+async def test_rule_extraction(tmp_path, scripted_llm, image_dir):
+    llm = scripted_llm()
+    document = await Document.from_markdown(
+        RULE_MARKDOWN,
+        llm,
+        llm,
+        image_dir,
+        checkpoint_dir=str(tmp_path / "checkpoint"),
+        rule_criteria=RuleCriteria(),
+    )
+    # headings, the introduction and results sections, the caption, the summaries and the metadata merge
+    assert llm.calls == 6
+    assert [section.title for section in document.blocks] == [
+        "Introduction",
+        "Method",
+        "Results",
+    ]
+    method = document.blocks[1]
+    assert method.summary == "summary of Method"
+    assert [(block.title, block.content) for block in method.blocks] == [
+        (
+            "Method",
+            "We split the document by its headings and extract every chunk in parallel.",
+        ),
+        (
+            "Split",
+            "Headings separate the sections.\nLines of a paragraph stay together.",
+        ),
+        ("Extract", "Every chunk is extracted in parallel."),
+    ]
+    assert document.metadata["title"] == "Structuring documents"
+
+    # The summaries are resumed from the checkpoint as well
+    llm = scripted_llm()
+    document = await Document.from_markdown(
+        RULE_MARKDOWN,
+        llm,
+        llm,
+        image_dir,
+        checkpoint_dir=str(tmp_path / "checkpoint"),
+        rule_criteria=RuleCriteria(),
+    )
+    assert llm.calls == 0 and document.blocks[1].summary == "summary of Method"
+
+
+NUMBERED_MARKDOWN = """# 1. Introduction
+
+![](figure.png)
+
+The figure above shows the overall pipeline of the method.
+
+# 2. Method
+
+We split the document by its headings and extract every chunk in parallel.
+
+# 2.1 Details
+
+The headings are extracted from the tree of the document by one request.
+
+# 3. Results
+
+The structure improves retrieval and question answering on every evaluated dataset.
+"""
+
+
+async def test_speculative_headings(scripted_llm, image_dir):
+    llm = scripted_llm()
+    llm.heading_delay = 0.5
+    document = await Document.from_markdown(
+        NUMBERED_MARKDOWN, llm, llm, image_dir, speculative=True
+    )
+    # The "2.1" heading was guessed to be part of the method section, but it was extracted as top-level:
+    # the introduction and results are kept, the method is parsed again and the details are parsed
+    assert [section.title for section in document.blocks] == [
+        "1. Introduction",
+        "2. Method",
+        "2.1 Details",
+        "3. Results",
+    ]
+    assert "2.1" not in document.blocks[1].markdown_content
+    # headings, three speculative sections and the caption, two sections re-issued, the metadata merge
+    assert llm.calls == 8
+
+
+async def test_repeated_chunks(scripted_llm, image_dir):
+    notes = "\n# Notes\n\nThe same boilerplate closes every part of the document.\n"
+    llm = scripted_llm()
+    document = await Document.from_markdown(
+        MARKDOWN + notes + notes,
+        llm,
+        llm,
+        image_dir,
+        pack_tokens=2048,
+        speculative=True,
+    )
+    # Chunks with the same text are kept apart, each with its own section
+    titles = [section.title for section in document.blocks]
+    assert titles == ["Introduction", "Method", "Notes", "Notes"]
+    assert document.blocks[2] is not document.blocks[3]
+
+
+async def test_table_renders_bounded(monkeypatch):
+    rendering = []
+    peak = []
+
+    def render(self, image_dir):
+        rendering.append(self)
+        peak.append(len(rendering))
+        time.sleep(0.02)
+        rendering.remove(self)
+
+    monkeypatch.setattr(Table, "parse", render)
+    configure_executors(render_workers=2)
+    tables = [
+        Table(markdown_content=f"| {i} |\n|---|", near_chunks=("", ""))
+        for i in range(6)
+    ]
+    await asyncio.gather(*(Document._parse_media(table, "") for table in tables))
+    assert len(peak) == 6 and max(peak) == 2
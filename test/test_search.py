@@ -0,0 +1,148 @@
+import zlib
+
+import torch
+from PIL import Image
+
+from strucdoc import (
+    AsyncLLM,
+    BM25Index,
+    Document,
+    Language,
+    Media,
+    Section,
+    SubSection,
+)
+from strucdoc.search import embedding_index_path, search_index_path, tokenize
+
+
+class HashingEmbedder(AsyncLLM):
+    """
+    Bag-of-words embeddings hashed into a fixed number of dimensions.
+    """
+
+    requests: int = 0
+    texts: int = 0
+
+    async def get_embedding(self, text, to_tensor=True, **kwargs):
+        texts = [text] if isinstance(text, str) else text
+        self.requests += 1
+        self.texts += len(texts)
+        embeddings = torch.zeros(len(texts), 64)
+        for i, text in enumerate(texts):
+            for term in tokenize(text):
+                embeddings[i, zlib.crc32(term.encode()) % 64] += 1
+        return embeddings
+
+
+def make_document(image_dir) -> Document:
+    Image.new("RGB", (8, 8)).save(image_dir / "figure.png")
+    return Document(
+        image_dir=str(image_dir),
+        blocks=[
+            Section(
+                title="Introduction",
+                summary="Why documents need structure.",
+                blocks=[
+                    SubSection(
+                        title="Motivation",
+                        content="Language models read long documents poorly without structure.",
+                    ),
+                    Media(
+                        markdown_content="![](figure.png)",
+                        near_chunks=("", ""),
+                        path=str(image_dir / "figure.png"),
+                        caption="Diagram: the parsing pipeline from markdown to sections",
+                    ),
+                ],
+            ),
+            Section(
+                title="实验",
+                summary="在多个数据集上评估文档结构化的效果。",
+                blocks=[
+                    SubSection(
+                        title="数据集",
+                        content="我们使用了三个公开的数据集进行评估。",
+                    ),
+                    SubSection(
+                        title="Evaluation",
+                        content="Extraction accuracy is measured against human annotations.",
+                    ),
+                ],
+            ),
+        ],
+        metadata={"title": "Structuring documents"},
+        language=Language.LATIN,
+    )
+
+
+def test_tokenize():
+    assert tokenize("BM25 ranking, 文档结构化!") == [
+        "bm25",
+        "ranking",
+        "文档",
+        "档结",
+        "结构",
+        "构化",
+    ]
+
+
+def test_full_text_search(tmp_path):
+    document = make_document(tmp_path)
+    block, score = document.full_text_search("parsing pipeline", k=1)[0]
+    assert isinstance(block, Media) and score > 0
+    block, _ = document.full_text_search("公开数据集", k=1)[0]
+    assert block.title == "数据集"
+    block, _ = document.full_text_search("evaluation accuracy", k=1)[0]
+    assert block.title == "Evaluation"
+    assert document.full_text_search("nothing matches this") == []
+
+    document.save(str(tmp_path / "document.json"))
+    assert (tmp_path / "document.bm25.json").exists()
+    assert search_index_path(str(tmp_path / "document.json")) == str(
+        tmp_path / "document.bm25.json"
+    )
+    loaded = Document.load(str(tmp_path / "document.json"))
+    assert loaded._search_index.postings == document._search_index.postings
+    assert [
+        (hit.kind, hit.section, hit.block)
+        for hit in loaded._search_index.search("数据集")
+    ] == [
+        (hit.kind, hit.section, hit.block)
+        for hit in document._search_index.search("数据集")
+    ]
+
+
+def test_corpus_index(tmp_path):
+    index = BM25Index()
+    index.add_document(make_document(tmp_path), "first")
+    index.add_document(make_document(tmp_path), "second")
+    hits = index.search("motivation", k=5)
+    assert {hit.document for hit in hits} == {"first", "second"}
+    assert all((hit.section, hit.block) == (0, 0) for hit in hits)
+
+
+async def test_embedding_search(tmp_path):
+    document = make_document(tmp_path)
+    embedder = HashingEmbedder(model="hashing", api_key="test")
+    index = await document.build_embedding_index(embedder, batch_size=3)
+    # three subsections and a caption, embedded by two requests
+    assert (embedder.requests, embedder.texts) == (2, 4)
+    assert index.matrix.dtype == torch.float32 and index.matrix.is_contiguous()
+    assert index.matrix.shape[0] == 4
+
+    block, score = (await document.search("parsing pipeline markdown", k=1))[0]
+    assert isinstance(block, Media) and 0 < score <= 1
+    block, _ = (await document.search("human annotations accuracy", k=1))[0]
+    assert block.title == "Evaluation"
+
+    document.save(str(tmp_path / "document.json"))
+    assert (tmp_path / "document.embeddings.pt").exists()
+    assert embedding_index_path(str(tmp_path / "document.json")) == str(
+        tmp_path / "document.embeddings.pt"
+    )
+    embedder = HashingEmbedder(model="hashing", api_key="test")
+    loaded = Document.load(str(tmp_path / "document.json"), text_model=embedder)
+    block, _ = (await loaded.search("公开的数据集", k=1))[0]
+    assert block.title == "数据集"
+    # only the query is embedded after loading
+    assert embedder.texts == 1
@@ -0,0 +1,97 @@
+import pytest
+from PIL import Image
+
+from strucdoc import (
+    Document,
+    DocumentStore,
+    Language,
+    Media,
+    Section,
+    SubSection,
+    Table,
+)
+
+
+def make_document(image_dir, venue: str) -> Document:
+    Image.new("RGB", (8, 8)).save(image_dir / "figure.png")
+    return Document(
+        image_dir=str(image_dir),
+        blocks=[
+            Section(
+                title="Introduction",
+                summary="Why documents need structure.",
+                blocks=[
+                    SubSection(
+                        title="Motivation",
+                        content="Language models read long documents poorly without structure.",
+                    ),
+                    Media(
+                        markdown_content="![](figure.png)",
+                        near_chunks=("before", "after"),
+                        path=str(image_dir / "figure.png"),
+                        caption="Diagram: the parsing pipeline",
+                    ),
+                ],
+                markdown_content="# Introduction",
+                language=Language.LATIN,
+            ),
+            Section(
+                title="实验",
+                summary="在多个数据集上评估文档结构化的效果。",
+                blocks=[
+                    Table(
+                        markdown_content="|a|b|\n|-|-|\n|1|2|",
+                        near_chunks=("", ""),
+                        path=str(image_dir / "figure.png"),
+                        caption="Accuracy on evaluation datasets",
+                        cells=[["a", "b"], ["1", "2"]],
+                        merge_area=[(0, 0, 0, 1)],
+                    ),
+                ],
+            ),
+        ],
+        metadata={"title": f"Paper at {venue}", "venue": venue},
+        language=Language.LATIN,
+    )
+
+
+def test_document_store(tmp_path):
+    acl, emnlp = make_document(tmp_path, "ACL"), make_document(tmp_path, "EMNLP")
+    with DocumentStore(str(tmp_path / "corpus.db")) as store:
+        store.add_many([("acl", acl), ("emnlp", emnlp)])
+        assert len(store) == 2 and "acl" in store
+        assert store.documents({"venue": "ACL"}) == ["acl"]
+
+        tables = list(store.iter_medias(tables=True, metadata={"venue": "EMNLP"}))
+        assert tables == [("emnlp", acl.blocks[1].blocks[0])]
+        assert [name for name, _ in store.iter_medias(caption="pipeline")] == [
+            "acl",
+            "emnlp",
+        ]
+
+        hits = store.search("数据集", metadata={"venue": "ACL"})
+        assert [(hit.kind, hit.section, hit.document) for hit in hits] == [
+            ("section", 1, "acl")
+        ]
+        hits = store.search("evaluation datasets")
+        assert {hit.kind for hit in hits} == {"table"}
+        assert store.get_block(hits[0]) == acl.blocks[1].blocks[0]
+        assert store.get_section("acl", 0) == acl.blocks[0]
+        assert store.get_document("emnlp").dict == emnlp.dict
+
+        # Replacing and removing documents also removes their rows from the FTS5 tables
+        store.add(acl, "emnlp")
+        assert store.documents({"venue": "EMNLP"}) == []
+        store.remove("acl")
+        assert [hit.document for hit in store.search("pipeline")] == ["emnlp"]
+
+    with DocumentStore(str(tmp_path / "corpus.db")) as store:
+        with pytest.raises(AssertionError):
+            with store.transaction():
+                store._delete("emnlp")
+                assert False
+        assert store.documents() == ["emnlp"]
+
+        acl.save(str(tmp_path / "acl.json"))
+        store.import_files([str(tmp_path / "acl.json")], ["acl"])
+        assert store.get_document("acl").dict == acl.dict
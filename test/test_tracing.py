@@ -0,0 +1,60 @@
+import asyncio
+
+from strucdoc import trace
+from strucdoc.tracing import span
+from strucdoc.utils import tenacity_decorator
+
+
+async def parse_chunk(idx: int, limiter: asyncio.Semaphore):
+    with span("parse_chunk", chunk=idx):
+        with span("wait_limiter", "queue"):
+            await limiter.acquire()
+        try:
+            with span("llm", "llm", model="test-model") as llm_span:
+                await asyncio.sleep(0.01)
+                llm_span.attrs["prompt_tokens"] = 10
+            with span("link_medias", "cpu"):
+                pass
+        finally:
+            limiter.release()
+
+
+async def test_trace_spans_and_export():
+    limiter = asyncio.Semaphore(1)
+    with trace() as tracer:
+        with span("from_markdown", document="doc"):
+            await asyncio.gather(*(parse_chunk(i, limiter) for i in range(3)))
+
+    llm_spans = [s for s in tracer.spans if s.category == "llm"]
+    assert sorted(s.attrs["chunk"] for s in llm_spans) == [0, 1, 2]
+    assert all(s.attrs["document"] == "doc" for s in llm_spans)
+
+    breakdown = tracer.breakdown()["doc"]
+    assert breakdown["llm"] >= 0.03 and breakdown["queue"] > 0
+
+    events = tracer.to_chrome_trace()["traceEvents"]
+    complete = [e for e in events if e["ph"] == "X"]
+    assert len(complete) == len(tracer.spans)
+    # every chunk runs in its own task and gets its own lane
+    assert len({e["tid"] for e in complete if e["name"] == "llm"}) == 3
+    assert "llm" in tracer.summary_table()
+
+
+async def test_trace_retries():
+    attempts = []
+
+    @tenacity_decorator(wait=0, stop=3)
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ValueError("flaky")
+
+    with trace() as tracer:
+        await flaky()
+    retries = [s for s in tracer.spans if s.name == "retry"]
+    assert [s.attrs["attempt"] for s in retries] == [1, 2]
+
+
+def test_span_without_tracer():
+    with span("noop") as current:
+        assert current is None
@@ -0,0 +1,44 @@
+import asyncio
+
+from strucdoc import Agent, track_usage
+from strucdoc.usage import record_usage
+
+CONFIG = {
+    "system_prompt": "You are a helpful assistant",
+    "template": "{{ question }}",
+    "jinja_args": ["question"],
+    "use_model": "language",
+}
+
+
+class ReportingLLM:
+    model = "reporting-model"
+
+    async def __call__(self, prompt, history=None, return_message=False, **kwargs):
+        await asyncio.sleep(0)
+        record_usage(self.model, {"prompt_tokens": 10, "completion_tokens": 5}, 0.5)
+        message = [
+            {"role": "user", "content": prompt},
+            {"role": "assistant", "content": "answer"},
+        ]
+        return "answer", message
+
+
+async def test_agent_uses_reported_usage():
+    agent = Agent("qa", {"language": ReportingLLM()}, record_cost=True, config=CONFIG)
+    with track_usage() as tracker:
+        await asyncio.gather(*(agent(question=f"question {i}") for i in range(3)))
+    summary = agent.cost_summary()
+    assert summary["requests"] == 3
+    assert (agent.input_tokens, agent.output_tokens) == (30, 15)
+    assert tracker.summary()["models"]["reporting-model"]["total_tokens"] == 45
+    assert tracker.total.latency == 1.5
+
+
+async def test_nested_trackers():
+    with track_usage() as outer:
+        record_usage("a", {"prompt_tokens": 1, "completion_tokens": 1}, 0.1)
+        with track_usage() as inner:
+            record_usage("b", None, 0.1)
+    assert outer.total.requests == 2
+    assert inner.total.requests == 1 and inner.total.total_tokens == 0